@@ -0,0 +1,255 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Persistent cache of analyzed targets and analyses.
+
+A target is analyzed from its declaration and the analyzed targets it
+depends on, so the digest of its declaration and the digests of its deps
+identify the result. The dependency lists and the rules of analyzed targets
+are saved by that digest, with the symbol table of the workspace which the
+lists are numbered in. Only targets whose digests changed, which are the
+targets of the changed packages and the targets depending on them, are
+analyzed again.
+
+An analysis of a command line is saved with the stamps of the files it was
+loaded from, it is reused while none of them changes.
+'''
+
+import array
+import cPickle
+import cStringIO
+import glob
+import os
+from util import *
+
+_CACHE_VERSION = 7
+
+# Targets and analyses not used in so many runs are dropped.
+_MAX_UNUSED_RUNS = 8
+
+# The symbol table only grows, start over when it is too large.
+_MAX_SYMBOL_NUM = 1 << 22
+
+# Dependency lists of an analyzed target, saved as strings of their numbers.
+_TARGET_ARRAYS = ['recursive_library_list_with_sub', 'dep_library_list',
+        'system_library_list', 'dep_paths', 'dep_header_list', 'sub_objs',
+        'prebuilt_library_list', 'prebuilt_static_library_list',
+        'link_all_symbols_lib_list']
+
+# Other attributes of an analyzed target.
+_TARGET_ATTRIBUTES = ['scons_actions', 'scons_actions_for_install']
+
+# Attributes of some target types, which the commands need.
+_OPTIONAL_TARGET_ATTRIBUTES = ['binary_name', 'test_case',
+        'testdata_copy_pair']
+
+_analysis_cache = None
+
+def GetStamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+class Analysis(object):
+    '''Result of a command line and the stamps of the files it depends on.
+
+    The action files written for it are stamped too, they may be written by
+    other command lines since. Wildcards in srcs are matched again, files
+    they match may be added to any subdir. The recorded inputs of the BUILD
+    files are checked like the build cache does.
+    '''
+    def __init__(self, loader, build_names, result, scons_content,
+            sconscript_names):
+        from build_cache import GetBuildCache
+        from build_index import GetIgnoreFileName
+        self.stamps = {}
+        # BUILD file name -> inputs, for the BUILD files having any.
+        self.build_inputs = {}
+        for path in [GetFlameRootFileName(), GetIgnoreFileName()]:
+            self.stamps[path] = GetStamp(path)
+        for package_dir in loader.packages:
+            # A package dir changes when a file matched by srcs is added.
+            self.stamps[package_dir] = GetStamp(package_dir)
+            build_name = os.path.join(package_dir, 'BUILD')
+            self.stamps[build_name] = GetStamp(build_name)
+            inputs = GetBuildCache().GetInputs(build_name)
+            if inputs != []:
+                self.build_inputs[build_name] = inputs
+        for sconscript_name in sconscript_names:
+            self.stamps[sconscript_name] = GetStamp(sconscript_name)
+        self.globs = loader.globs
+        self.build_names = build_names
+        self.result = result
+        self.scons_content = scons_content
+
+    def IsValid(self, build_names):
+        if build_names != self.build_names:
+            return False
+        for path, stamp in self.stamps.items():
+            if GetStamp(path) != stamp:
+                return False
+        for pattern, file_names in self.globs.items():
+            if sorted(glob.glob(pattern)) != file_names:
+                return False
+        from build_cache import CheckInputs
+        for inputs in self.build_inputs.values():
+            if not CheckInputs(inputs):
+                return False
+        return True
+
+class AnalysisCache(object):
+    '''Digest -> analyzed target, and command line -> Analysis, saved in
+    |cache_file|.
+    '''
+    def __init__(self, cache_file, config_digest):
+        self.cache_file = cache_file
+        self.config_digest = config_digest
+        self.run = 0
+        # Digest -> (run, attributes).
+        self.targets = {}
+        # Command line -> (run, Analysis).
+        self.analyses = {}
+        # Pickled symbol table and targets, not loaded until BUILD files are.
+        self.targets_content = None
+        self.changed = False
+        self.reuse_num = 0
+        self.analyze_num = 0
+        self.Load()
+
+    def Load(self):
+        '''The file is the pickled analyses, then the pickled targets.'''
+        if not os.path.isfile(self.cache_file):
+            return
+        f = open(self.cache_file, 'rb')
+        try:
+            try:
+                content = cPickle.load(f)
+                if content[0] != _CACHE_VERSION:
+                    return
+                _, config_digest, run, analyses = content
+                if config_digest != self.config_digest:
+                    return
+                targets_content = f.read()
+            except Exception:
+                Warning('Analysis cache %s is broken, ignore it.' %
+                        self.cache_file)
+                return
+        finally:
+            f.close()
+        self.run = run
+        self.analyses = analyses
+        self.targets_content = targets_content
+
+    def LoadTargets(self):
+        '''Load the saved targets, before any symbol is added.'''
+        if self.targets_content == None:
+            return
+        symbols, targets = cPickle.loads(self.targets_content)
+        self.targets_content = None
+        # Numbers in the saved lists are only valid in the saved symbol table.
+        if GetWorkspace().LoadSymbols(symbols):
+            self.targets = targets
+
+    def Save(self):
+        '''Save if targets or analyses are added.
+
+        Entries used by the runs which do not save may be dropped earlier.
+        '''
+        if not self.changed:
+            return
+        self.changed = False
+        self.run += 1
+        for cache in [self.targets, self.analyses]:
+            for key, (run, _) in cache.items():
+                if run + _MAX_UNUSED_RUNS < self.run:
+                    del cache[key]
+        targets_content = self.targets_content
+        if targets_content == None:
+            symbols = GetWorkspace().symbols
+            targets = self.targets
+            if len(symbols) > _MAX_SYMBOL_NUM:
+                symbols = []
+                targets = {}
+            # Objects are not shared between the targets, not memoizing
+            # them saves much memory.
+            output = cStringIO.StringIO()
+            pickler = cPickle.Pickler(output, cPickle.HIGHEST_PROTOCOL)
+            pickler.fast = 1
+            pickler.dump((symbols, targets))
+            targets_content = output.getvalue()
+        content = cPickle.dumps((_CACHE_VERSION, self.config_digest, self.run,
+                self.analyses), cPickle.HIGHEST_PROTOCOL)
+        # The targets are not pickled again into a copy.
+        WriteFileAtomically(self.cache_file, [content, targets_content])
+
+    def RestoreTarget(self, target):
+        '''Set the analyzed attributes of |target|, False if not cached.'''
+        entry = self.targets.get(target.analysis_digest)
+        if entry == None:
+            self.analyze_num += 1
+            return False
+        arrays, values, optional_attributes = entry[1]
+        for name, value in zip(_TARGET_ARRAYS, arrays):
+            setattr(target, name, array.array('i', value))
+        for name, value in zip(_TARGET_ATTRIBUTES, values):
+            setattr(target, name, value)
+        for name, value in optional_attributes.items():
+            setattr(target, name, value)
+        self.targets[target.analysis_digest] = (self.run, entry[1])
+        self.reuse_num += 1
+        return True
+
+    def StoreTarget(self, target):
+        '''Attributes are saved in the order of their names, the names are
+        not saved for every target.
+        '''
+        arrays = tuple([getattr(target, name).tostring()
+                for name in _TARGET_ARRAYS])
+        values = tuple([getattr(target, name) for name in _TARGET_ATTRIBUTES])
+        optional_attributes = {}
+        for name in _OPTIONAL_TARGET_ATTRIBUTES:
+            if hasattr(target, name):
+                optional_attributes[name] = getattr(target, name)
+        self.targets[target.analysis_digest] = (self.run,
+                (arrays, values, optional_attributes))
+        self.changed = True
+
+    def FindAnalysis(self, key, build_names):
+        '''Analysis of the command line |key|, None if it is not valid.'''
+        entry = self.analyses.get(key)
+        if entry == None or not entry[1].IsValid(build_names):
+            return None
+        self.analyses[key] = (self.run, entry[1])
+        return entry[1]
+
+    def StoreAnalysis(self, key, analysis):
+        self.analyses[key] = (self.run, analysis)
+        self.changed = True
+
+    def Report(self):
+        Info('Analysis cache: %d targets reused, %d targets analyzed.' % (
+                self.reuse_num, self.analyze_num))
+        self.reuse_num = 0
+        self.analyze_num = 0
+
+def GetAnalysisCache():
+    '''Get AnalysisCache singleton.'''
+    global _analysis_cache
+    if _analysis_cache == None:
+        cache_file = os.path.join(GetCacheDir(), 'analysis_cache')
+        config = [ReadFile(GetFlameRootFileName()), GetFlameRootDir(),
+                Platform()]
+        # Rules change with the code writing them, when flame is upgraded.
+        # Every module of flame is digested, the targets, the backends and
+        # the helpers they call all contribute to the actions.
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        for source_name in sorted(glob.glob(os.path.join(source_dir,
+                '*.py'))):
+            config.append(ReadFile(source_name))
+        config_digest = Digest('\0'.join(config))
+        _analysis_cache = AnalysisCache(cache_file, config_digest)
+    return _analysis_cache
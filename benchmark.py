@@ -0,0 +1,471 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Benchmarks of flame on synthetic workspaces.
+
+Usage: python benchmark.py <benchmark> [args...]
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from util import *
+
+def MakeWorkspace(package_num, library_num=3, fanout=10):
+    '''Create a workspace of |package_num| packages in a temporary dir.
+
+    Packages form a tree, every library depends on the libraries of the
+    parent package.
+    '''
+    root_dir = tempfile.mkdtemp(prefix='flame_benchmark_')
+    open(os.path.join(root_dir, 'FLAME_ROOT'), 'w').close()
+    for i in range(package_num):
+        package_dir = os.path.join(root_dir, GetPackagePath(i))
+        os.makedirs(package_dir)
+        build_file = open(os.path.join(package_dir, 'BUILD'), 'w')
+        for j in range(library_num):
+            deps = []
+            if i > 0:
+                parent_path = GetPackagePath((i - 1) / fanout)
+                deps = ['//%s:l%d' % (parent_path, k)
+                        for k in range(library_num)]
+            build_file.write('cc_library(name=%r, srcs=%r, deps=%r)\n' % (
+                    'l%d' % j, ['l%d.cc' % j], deps))
+        build_file.close()
+    return root_dir
+
+def GetPackagePath(i):
+    return 'p%d/p%d' % (i / 100, i)
+
+def Measure(func, *args):
+    start_time = time.time()
+    result = func(*args)
+    return time.time() - start_time, result
+
+def BenchmarkLoading(package_num=2000, jobs=0):
+    import build_cache
+    root_dir = MakeWorkspace(package_num)
+    try:
+        build_names = []
+        for dir_name, _, _ in os.walk(root_dir):
+            build_name = os.path.join(dir_name, 'BUILD')
+            if os.path.isfile(build_name):
+                build_names.append(build_name)
+        def Load(jobs):
+            cache_file = os.path.join(root_dir, 'cache.%d' % jobs)
+            cache = build_cache.BuildCache(cache_file, '')
+            if jobs > 1:
+                cache.Prefetch(build_names, jobs)
+            for build_name in build_names:
+                cache.GetDeclarations(build_name)
+            return cache
+        serial_time, serial_cache = Measure(Load, 1)
+        jobs = jobs or GetCpuCount()
+        parallel_time, parallel_cache = Measure(Load, jobs)
+        if serial_cache.entries != parallel_cache.entries:
+            ErrorExit('Parallel loading differs from serial loading.')
+        Info('Loaded %d BUILD files: serial %.3fs, %d processes %.3fs.' % (
+                len(build_names), serial_time, jobs, parallel_time))
+    finally:
+        shutil.rmtree(root_dir)
+
+def CountSyscalls(func, *args):
+    '''Run |func|, return the number of file system calls it made.'''
+    counts = {}
+    originals = {}
+    def Wrap(name, original):
+        def Call(*args):
+            counts[name] = counts.get(name, 0) + 1
+            return original(*args)
+        return Call
+    for name in ['stat', 'lstat', 'chdir', 'getcwd', 'listdir']:
+        originals[name] = getattr(os, name)
+        setattr(os, name, Wrap(name, originals[name]))
+    try:
+        func(*args)
+    finally:
+        for name, original in originals.items():
+            setattr(os, name, original)
+    return counts
+
+def BenchmarkAnalysis(package_num=3334):
+    '''Load and analyze every package, 3 targets per package.'''
+    import build_loader
+    import target_pool
+    root_dir = MakeWorkspace(package_num)
+    current_dir = os.getcwd()
+    try:
+        os.chdir(root_dir)
+        loader = build_loader.BuildLoader('')
+        def Analyze():
+            for i in range(package_num):
+                loader.AddPackage(os.path.join(root_dir, GetPackagePath(i)))
+            loader.Load()
+            target_pool.WriteRuleForAllTargets()
+        seconds, counts = Measure(CountSyscalls, Analyze)
+        Info('Analyzed %d targets in %.2fs, file system calls: %s.' % (
+                loader.target_num, seconds, ', '.join(['%s %d' % item
+                        for item in sorted(counts.items())])))
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(root_dir)
+
+def BenchmarkClosure(package_num=200, library_num=3):
+    '''Complement the deps of a chain of packages of export_static libraries.'''
+    import build_loader
+    import target_pool
+    root_dir = MakeWorkspace(package_num, library_num, fanout=1)
+    current_dir = os.getcwd()
+    try:
+        os.chdir(root_dir)
+        for i in range(package_num):
+            build_name = os.path.join(root_dir, GetPackagePath(i), 'BUILD')
+            content = ReadFile(build_name).replace(')\n',
+                    ', export_static=1)\n')
+            WriteFileAtomically(build_name, content)
+        loader = build_loader.BuildLoader('')
+        loader.AddPackage(os.path.join(root_dir,
+                GetPackagePath(package_num - 1)))
+        loader.Load()
+        target_pool.GenerateRecursiveForSort()
+        targets = target_pool.GetAllTargets()
+        seconds, _ = Measure(target_pool.ComplementSubDeps, targets)
+        link_seconds, _ = Measure(target_pool.GenerateLinkAllSymbolsList,
+                targets)
+        sub_obj_num = max([len(target.sub_objs) for target in targets])
+        Info('Complemented deps of %d targets in %.3fs, at most %d sub objs '
+                'per target, link all symbols lists in %.3fs.' % (
+                        len(targets), seconds, sub_obj_num, link_seconds))
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(root_dir)
+
+def BenchmarkQuery(package_num=10000):
+    '''Index the dependencies of a workspace, then query rdeps of the root.'''
+    import query
+    root_dir = MakeWorkspace(package_num)
+    current_dir = os.getcwd()
+    try:
+        os.chdir(root_dir)
+        build_names = []
+        for dir_name, _, _ in os.walk(root_dir):
+            build_name = os.path.join(dir_name, 'BUILD')
+            if os.path.isfile(build_name):
+                build_names.append(build_name)
+        index_file = os.path.join(root_dir, 'dependency_index')
+        def Index():
+            index = query.DependencyIndex(index_file, '')
+            index.Update(build_names, GetCpuCount())
+            return index
+        index_seconds, _ = Measure(Index)
+        update_seconds, index = Measure(Index)
+        key = os.path.join(root_dir, GetPackagePath(0), 'l0')
+        seconds, keys = Measure(query.Reach, index.rdeps, [key])
+        Info('Indexed %d packages in %.2fs, loaded and checked the index in '
+                '%.3fs, found %d rdeps in %.3fs.' % (package_num, index_seconds,
+                        update_seconds, len(keys), seconds))
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(root_dir)
+
+def BenchmarkIncremental(package_num=3334):
+    '''Analyze every package, then again with the analysis cache, without
+    changes, after a leaf package changed and after the root package changed.
+    '''
+    import analysis_cache
+    import build_cache
+    import build_loader
+    import target_pool
+    import workspace
+    root_dir = MakeWorkspace(package_num)
+    current_dir = os.getcwd()
+    try:
+        os.chdir(root_dir)
+        def Analyze():
+            # A new process starts with an empty symbol table.
+            workspace._workspace = None
+            analysis_cache._analysis_cache = None
+            target_pool.ResetTargetPool()
+            build_cache.GetBuildCache().Refresh()
+            cache = analysis_cache.GetAnalysisCache()
+            cache.LoadTargets()
+            loader = build_loader.BuildLoader('')
+            for i in range(package_num):
+                loader.AddPackage(os.path.join(root_dir, GetPackagePath(i)))
+            loader.Load()
+            target_pool.WriteRuleForAllTargets()
+            cache.Save()
+            return ''.join([''.join(target.scons_actions)
+                    for target in target_pool.GetAllTargets()])
+        def Change(i):
+            build_name = os.path.join(root_dir, GetPackagePath(i), 'BUILD')
+            content = ReadFile(build_name).replace('srcs=', 'defs=[], srcs=')
+            WriteFileAtomically(build_name, content)
+        times = []
+        cold_seconds, _ = Measure(Analyze)
+        times.append(Measure(Analyze)[0])
+        Change(package_num - 1)
+        times.append(Measure(Analyze)[0])
+        Change(0)
+        seconds, rules = Measure(Analyze)
+        times.append(seconds)
+        shutil.rmtree(GetCacheDir())
+        if Analyze() != rules:
+            ErrorExit('Incremental analysis differs from full analysis.')
+        Info('Analyzed %d targets in %.2fs, again in %.2fs without changes, '
+                '%.2fs after a leaf changed, %.2fs after the root changed.' % (
+                        package_num * 3, cold_seconds, times[0], times[1],
+                        times[2]))
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(root_dir)
+
+def BenchmarkWildcardSrcs(file_num=1000):
+    '''Check a saved analysis with srcs matched in a subdir, time checking
+    it, and check it is not reused after a file is added to the subdir.
+    '''
+    import analysis_cache
+    import build_cache
+    import build_loader
+    import target_pool
+    root_dir = MakeWorkspace(1)
+    current_dir = os.getcwd()
+    try:
+        os.chdir(root_dir)
+        package_dir = os.path.join(root_dir, GetPackagePath(0))
+        src_dir = os.path.join(package_dir, 'src')
+        os.mkdir(src_dir)
+        for i in range(file_num):
+            open(os.path.join(src_dir, 's%d.cc' % i), 'w').close()
+        WriteFileAtomically(os.path.join(package_dir, 'BUILD'),
+                'cc_library(name="l", srcs=["src/*.cc"])\n')
+        target_pool.ResetTargetPool()
+        build_cache.GetBuildCache().Refresh()
+        loader = build_loader.BuildLoader('')
+        loader.AddPackage(package_dir)
+        loader.Load()
+        analysis = analysis_cache.Analysis(loader, None, None, None, [])
+        seconds, valid = Measure(analysis.IsValid, None)
+        if not valid:
+            ErrorExit('Unchanged analysis is not reused.')
+        open(os.path.join(src_dir, 'added.cc'), 'w').close()
+        if analysis.IsValid(None):
+            ErrorExit('Analysis is reused after a src is added to a subdir.')
+        Info('Checked the analysis matching %d srcs in %.3fs.' % (
+                file_num, seconds))
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(root_dir)
+
+def BenchmarkSconsRead(package_num=3334):
+    '''Time scons to read the rules of every package, the libraries of a
+    package are built with one of 10 macros.
+    '''
+    import re
+    import subprocess
+    import flame
+    root_dir = MakeWorkspace(package_num)
+    current_dir = os.getcwd()
+    try:
+        os.chdir(root_dir)
+        for i in range(package_num):
+            build_name = os.path.join(root_dir, GetPackagePath(i), 'BUILD')
+            content = ReadFile(build_name).replace(')\n',
+                    ', defs=[%r])\n' % ('M%d' % (i % 10)))
+            WriteFileAtomically(build_name, content)
+        sys.argv = [sys.argv[0], 'build', '...']
+        flame.ChooseDebugOrRelease()
+        flame.LoadBuildFiles()
+        sconscript_names = flame.GenerateBuildRules('build')
+        rules_size = sum([os.path.getsize(name)
+                for name in ['SConstruct'] + sconscript_names])
+        output = subprocess.Popen(['scons', '-h', '--debug=time'],
+                stdout=subprocess.PIPE).communicate()[0]
+        match = re.search(r'SConscript file execution time: ([0-9.]+)', output)
+        if not match:
+            ErrorExit('scons did not report its time.')
+        Info('scons read the rules of %d targets, %d bytes, in %.2fs.' % (
+                package_num * 3, rules_size, float(match.group(1))))
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(root_dir)
+
+def BenchmarkBackends(package_num=300, jobs=0):
+    '''Build with scons, ninja and flame itself: a full build, a build without
+    changes, and a build after a source of the root package changed.
+    '''
+    import subprocess
+    root_dir = MakeWorkspace(package_num)
+    flame_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'flame')
+    current_dir = os.getcwd()
+    try:
+        os.chdir(root_dir)
+        for i in range(package_num):
+            package_dir = os.path.join(root_dir, GetPackagePath(i))
+            for j in range(3):
+                WriteFileAtomically(os.path.join(package_dir, 'l%d.cc' % j),
+                        'int F%d_%d() { return %d; }\n' % (i, j, j))
+        main_dir = os.path.join(root_dir, GetPackagePath(package_num - 1))
+        WriteFileAtomically(os.path.join(main_dir, 'main.cc'),
+                'int F0_0();\nint main() { return F0_0(); }\n')
+        build_name = os.path.join(main_dir, 'BUILD')
+        WriteFileAtomically(build_name, ReadFile(build_name) +
+                'cc_binary(name=\'main\', srcs=[\'main.cc\'], '
+                'deps=[\':l0\'])\n')
+        source_name = os.path.join(root_dir, GetPackagePath(0), 'l0.cc')
+        source = ReadFile(source_name)
+        jobs = jobs or GetCpuCount()
+        null_file = open(os.devnull, 'w')
+        def Build(backend):
+            ret_code = subprocess.call([flame_file, 'build', '...',
+                    '--backend=%s' % backend, '-j', str(jobs)],
+                    stdout=null_file, stderr=null_file)
+            if ret_code != 0:
+                ErrorExit('Build with %s failed.' % backend)
+        for backend in ['scons', 'ninja', 'native']:
+            # Build dirs of the workspace, the caches are in them too.
+            for build_dir in ['flame-bin', 'build_release']:
+                if os.path.islink(build_dir):
+                    os.remove(build_dir)
+                elif os.path.isdir(build_dir):
+                    shutil.rmtree(build_dir)
+            full_seconds, _ = Measure(Build, backend)
+            no_op_seconds, _ = Measure(Build, backend)
+            WriteFileAtomically(source_name, source + '// Changed.\n')
+            changed_seconds, _ = Measure(Build, backend)
+            WriteFileAtomically(source_name, source)
+            Build(backend)
+            Info('%s built %d targets in %.2fs, again in %.2fs without '
+                    'changes, %.2fs after a source changed.' % (backend,
+                            package_num * 3 + 1, full_seconds, no_op_seconds,
+                            changed_seconds))
+        null_file.close()
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(root_dir)
+
+def BenchmarkCriticalPath(chain_num=10, jobs=2):
+    '''Run a long action and |chain_num| chains of two short actions with
+    |jobs| jobs, without and with the durations of the first run.
+
+    Counted by actions, the short chains are longer and start first.
+    '''
+    import native_backend
+    root_dir = tempfile.mkdtemp(prefix='flame_benchmark_')
+    current_dir = os.getcwd()
+    try:
+        os.chdir(root_dir)
+        actions = [(['long'], 'sleep 2 && touch long', [], [], [], False,
+                'compile')]
+        for i in range(chain_num):
+            first = 's%d_0' % i
+            second = 's%d_1' % i
+            actions.append(([first], 'sleep 0.1 && touch ' + first, [], [],
+                    [], False, 'compile'))
+            actions.append(([second], 'sleep 0.1 && touch ' + second,
+                    [first], [], [], False, 'compile'))
+        state = native_backend.BuildState(os.path.join(root_dir, 'state'))
+        for history in ['without', 'with']:
+            for action in actions:
+                if os.path.isfile(action[0][0]):
+                    os.remove(action[0][0])
+            executor = native_backend.Executor(actions,
+                    {'compile': jobs, 'link': 1}, GetCpuCount() * 100, state)
+            seconds, _ = Measure(executor.Run, [action[0][0]
+                    for action in actions])
+            Info('%.2fs %s the durations, the critical path is %.2fs.' % (
+                    seconds, history, max(executor.achieved_dict.values())))
+    finally:
+        os.chdir(current_dir)
+        shutil.rmtree(root_dir)
+
+def GetPeakRss():
+    '''Peak resident set size of this process in MB.'''
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def BenchmarkMemory(package_num=33334):
+    '''Analyze 100k targets, report the peak RSS.'''
+    BenchmarkAnalysis(package_num)
+    Info('Peak RSS %dMB.' % GetPeakRss())
+
+class FakeTarget(object):
+    def __init__(self, recursive_library_list):
+        self.recursive_library_list_for_sort = recursive_library_list
+
+def MakeTargetGraph(node_num, dep_num=5):
+    '''Targets depending on up to |dep_num| random earlier targets.'''
+    rand = random.Random(node_num)
+    keys = ['/root/p%d/t%d' % (i / 100, i) for i in range(node_num)]
+    graph = {}
+    for i in range(node_num):
+        deps = set()
+        for _ in range(min(i, dep_num)):
+            deps.add(keys[rand.randrange(i)])
+        graph[keys[i]] = FakeTarget(sorted(deps))
+    return graph
+
+def BenchmarkTopologySort(node_num=0):
+    '''Sort graphs of 1k, 10k and 100k targets, or of |node_num| targets.'''
+    import dependence_analyser
+    node_nums = [1000, 10000, 100000]
+    if node_num > 0:
+        node_nums = [node_num]
+    for node_num in node_nums:
+        graph = MakeTargetGraph(node_num)
+        seconds, node_list = Measure(dependence_analyser.TopologySort, graph)
+        position_dict = {}
+        for i, node in enumerate(node_list):
+            position_dict[node.key] = i
+        for key, target in graph.items():
+            for dep in target.recursive_library_list_for_sort:
+                if position_dict[dep] > position_dict[key]:
+                    ErrorExit('%s is sorted before its dep %s.' % (key, dep))
+        Info('Sorted %d targets in %.3fs.' % (node_num, seconds))
+
+def BenchmarkCircles(node_num=10000):
+    '''Find the circles after the first target depends on the last one.'''
+    import dependence_analyser
+    graph = MakeTargetGraph(node_num)
+    keys = sorted(graph.keys(), key=lambda key: int(key.split('/t')[-1]))
+    graph[keys[0]].recursive_library_list_for_sort = [keys[-1]]
+    node_list = [dependence_analyser.TargetNode(key,
+            graph[key].recursive_library_list_for_sort) for key in keys]
+    edge_num = sum([len(node.recursive_library_list) for node in node_list])
+    seconds, (circle_list, left_num) = Measure(
+            dependence_analyser.FindCircles, node_list)
+    Info('Found %d circles and %d more targets in circles, in %d targets '
+            'with %d deps in %.3fs.' % (len(circle_list), left_num, node_num,
+                    edge_num, seconds))
+
+_benchmarks = {
+    'analysis': BenchmarkAnalysis,
+    'backends': BenchmarkBackends,
+    'circles': BenchmarkCircles,
+    'closure': BenchmarkClosure,
+    'critical_path': BenchmarkCriticalPath,
+    'incremental': BenchmarkIncremental,
+    'loading': BenchmarkLoading,
+    'memory': BenchmarkMemory,
+    'query': BenchmarkQuery,
+    'scons_read': BenchmarkSconsRead,
+    'topology_sort': BenchmarkTopologySort,
+    'wildcard_srcs': BenchmarkWildcardSrcs,
+}
+
+def Main():
+    if len(sys.argv) < 2 or sys.argv[1] not in _benchmarks:
+        ErrorExit('Usage: python benchmark.py {%s} [args...]' %
+                ','.join(sorted(_benchmarks.keys())))
+    args = [int(arg) for arg in sys.argv[2:]]
+    _benchmarks[sys.argv[1]](*args)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(Main())
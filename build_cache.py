@@ -0,0 +1,334 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Persistent cache of parsed BUILD files.
+
+A BUILD file is evaluated with recorders in place of the rule functions, the
+result is the list of its rule declarations. Declarations are cached on disk
+keyed by the digest of the BUILD file and FLAME_ROOT, so unchanged packages
+are loaded without executing python. Wildcards in srcs are kept as written
+and expanded when the targets are created, so they are always up to date.
+
+BUILD files may still use glob, os, sys and the helpers of util, like when
+they were executed in flame's namespace. The files matched by glob, the
+environment variables and the paths tested with os.path are recorded with
+the declarations, which are reused while the results are the same. Other
+helpers have unknown inputs, BUILD files using them are evaluated in every
+run.
+'''
+
+import cPickle
+import glob
+import inspect
+import os
+import sys
+import traceback
+import util
+from util import *
+
+_CACHE_VERSION = 2
+
+RULE_NAMES = ['cc_library', 'cc_binary', 'cc_test', 'extra_export',
+        'proto_library']
+
+_build_cache = None
+
+# Functions whose results are the recorded inputs of BUILD files.
+_INPUT_FUNCTIONS = {
+    'exists': os.path.exists,
+    'getenv': os.environ.get,
+    'glob': lambda pattern: sorted(glob.glob(pattern)),
+    'isdir': os.path.isdir,
+    'isfile': os.path.isfile,
+}
+
+class BuildFileError(Exception):
+    '''A BUILD file uses a name which is not defined for it.'''
+    pass
+
+def CheckInputs(inputs):
+    '''True if the recorded |inputs| of a BUILD file have the same results,
+    never for unknown inputs.
+    '''
+    if inputs == None:
+        return False
+    for function_name, argument, result in inputs:
+        if _INPUT_FUNCTIONS[function_name](argument) != result:
+            return False
+    return True
+
+class BuildInputs(object):
+    '''Inputs of a BUILD file besides its content, recorded while it is
+    evaluated. Relative paths are in the package dir, which flame ran BUILD
+    files in.
+    '''
+    def __init__(self, package_dir):
+        self.package_dir = package_dir
+        self.inputs = []
+        self.known = True
+
+    def Record(self, function_name, argument):
+        result = _INPUT_FUNCTIONS[function_name](argument)
+        self.inputs.append((function_name, argument, result))
+        return result
+
+    def GetPath(self, path):
+        return os.path.join(self.package_dir, path)
+
+    def GetInputs(self):
+        '''Recorded inputs, None if they are unknown.'''
+        if not self.known:
+            return None
+        return self.inputs
+
+class _UntrackedObject(object):
+    '''|value| for BUILD files, its attributes have unknown inputs.'''
+    def __init__(self, value, build_inputs):
+        self._value = value
+        self._build_inputs = build_inputs
+
+    def __getattr__(self, name):
+        self._build_inputs.known = False
+        return getattr(self._value, name)
+
+class _GlobModule(_UntrackedObject):
+    def glob(self, pattern):
+        build_inputs = self._build_inputs
+        file_names = build_inputs.Record('glob', build_inputs.GetPath(pattern))
+        if os.path.isabs(pattern):
+            return file_names
+        return [os.path.relpath(file_name, build_inputs.package_dir)
+                for file_name in file_names]
+
+    def iglob(self, pattern):
+        return iter(self.glob(pattern))
+
+class _OsModule(_UntrackedObject):
+    def __init__(self, build_inputs):
+        _UntrackedObject.__init__(self, os, build_inputs)
+        self.environ = _Environ(build_inputs)
+        self.path = _OsPathModule(build_inputs)
+        self.sep = os.sep
+
+    def getenv(self, name, default=None):
+        return self.environ.get(name, default)
+
+class _OsPathModule(_UntrackedObject):
+    def __init__(self, build_inputs):
+        _UntrackedObject.__init__(self, os.path, build_inputs)
+        for name in ['basename', 'dirname', 'isabs', 'join', 'normpath',
+                'split', 'splitext']:
+            setattr(self, name, getattr(os.path, name))
+
+    def abspath(self, path):
+        return os.path.normpath(self._build_inputs.GetPath(path))
+
+    def exists(self, path):
+        return self._build_inputs.Record('exists',
+                self._build_inputs.GetPath(path))
+
+    def isdir(self, path):
+        return self._build_inputs.Record('isdir',
+                self._build_inputs.GetPath(path))
+
+    def isfile(self, path):
+        return self._build_inputs.Record('isfile',
+                self._build_inputs.GetPath(path))
+
+class _Environ(_UntrackedObject):
+    def __init__(self, build_inputs):
+        _UntrackedObject.__init__(self, os.environ, build_inputs)
+
+    def get(self, name, default=None):
+        value = self._build_inputs.Record('getenv', name)
+        if value == None:
+            return default
+        return value
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value == None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name) != None
+
+    has_key = __contains__
+
+    def __iter__(self):
+        self._build_inputs.known = False
+        return iter(os.environ)
+
+def _UntrackedFunction(function, build_inputs):
+    def Call(*args, **kwargs):
+        build_inputs.known = False
+        return function(*args, **kwargs)
+    return Call
+
+def _RuleRecorder(rule_name, declarations):
+    def Record(*args, **kwargs):
+        declarations.append((rule_name, args, kwargs))
+    return Record
+
+def EvaluateBuildFile(build_name, content=None):
+    '''Execute a BUILD file, return its (rule_name, args, kwargs) list and
+    its inputs, None if they are unknown.
+    '''
+    if content == None:
+        content = ReadFile(build_name)
+    declarations = []
+    build_inputs = BuildInputs(os.path.dirname(build_name))
+    build_globals = {'__file__': build_name}
+    for name, value in vars(util).items():
+        if not name.startswith('_') and inspect.isfunction(value) and \
+                value.__module__ == util.__name__:
+            build_globals[name] = _UntrackedFunction(value, build_inputs)
+    build_globals['glob'] = _GlobModule(glob, build_inputs)
+    build_globals['os'] = _OsModule(build_inputs)
+    build_globals['sys'] = _UntrackedObject(sys, build_inputs)
+    for rule_name in RULE_NAMES:
+        build_globals[rule_name] = _RuleRecorder(rule_name, declarations)
+    try:
+        exec compile(content, build_name, 'exec') in build_globals
+    except NameError, e:
+        raise BuildFileError('%s: %s, only the rules, glob, os, sys and the '
+                'helpers of util can be used in BUILD files.' % (
+                        build_name, e))
+    return declarations, build_inputs.GetInputs()
+
+def _EvaluateInWorker(build_name):
+    '''Evaluate a BUILD file in a loading process, errors are returned.'''
+    try:
+        declarations, inputs = EvaluateBuildFile(build_name)
+        return build_name, declarations, inputs, None
+    except BuildFileError, e:
+        return build_name, None, None, str(e)
+    except Exception:
+        return build_name, None, None, 'Failed to load %s:\n%s' % (
+                build_name, traceback.format_exc())
+
+class BuildCache(object):
+    '''BUILD file name -> (digest, declarations, inputs), saved in
+    |cache_file|.
+    '''
+    def __init__(self, cache_file, config_digest):
+        self.cache_file = cache_file
+        self.config_digest = config_digest
+        self.entries = {}
+        self.hit_num = 0
+        self.miss_num = 0
+        # BUILD files with unknown inputs evaluated in this run.
+        self.unknown_num = 0
+        self.dirty = False
+        # BUILD files already validated or evaluated in this run.
+        self.fresh = set()
+        self.Load()
+
+    def Load(self):
+        if not os.path.isfile(self.cache_file):
+            return
+        try:
+            version, entries = cPickle.loads(ReadFile(self.cache_file))
+        except Exception:
+            Warning('BUILD cache %s is broken, ignore it.' % self.cache_file)
+            return
+        if version == _CACHE_VERSION:
+            self.entries = entries
+
+    def Save(self):
+        if not self.dirty:
+            return
+        content = cPickle.dumps((_CACHE_VERSION, self.entries),
+                cPickle.HIGHEST_PROTOCOL)
+        WriteFileAtomically(self.cache_file, content)
+        self.dirty = False
+
+    def Refresh(self):
+        '''Check the BUILD files again, they may be changed since the last
+        run of a resident process.
+        '''
+        self.fresh.clear()
+        self.hit_num = 0
+        self.miss_num = 0
+        self.unknown_num = 0
+
+    def BuildDigest(self, content):
+        return Digest(self.config_digest + content)
+
+    def IsFresh(self, build_name, digest):
+        entry = self.entries.get(build_name)
+        return entry != None and entry[0] == digest and CheckInputs(entry[2])
+
+    def Update(self, build_name, digest, declarations, inputs):
+        self.entries[build_name] = (digest, declarations, inputs)
+        self.fresh.add(build_name)
+        self.miss_num += 1
+        if inputs == None:
+            self.unknown_num += 1
+        self.dirty = True
+
+    def GetInputs(self, build_name):
+        '''Inputs of a loaded BUILD file, None if they are unknown.'''
+        return self.entries[build_name][2]
+
+    def GetDeclarations(self, build_name):
+        if build_name in self.fresh:
+            return self.entries[build_name][1]
+        content = ReadFile(build_name)
+        digest = self.BuildDigest(content)
+        if self.IsFresh(build_name, digest):
+            self.fresh.add(build_name)
+            self.hit_num += 1
+            return self.entries[build_name][1]
+        try:
+            declarations, inputs = EvaluateBuildFile(build_name, content)
+        except BuildFileError, e:
+            ErrorExit(str(e))
+        self.Update(build_name, digest, declarations, inputs)
+        return self.entries[build_name][1]
+
+    def Prefetch(self, build_names, jobs):
+        '''Evaluate the stale ones of |build_names| in |jobs| processes.'''
+        digests = {}
+        for build_name in build_names:
+            if build_name in self.fresh:
+                continue
+            digest = self.BuildDigest(ReadFile(build_name))
+            if self.IsFresh(build_name, digest):
+                self.fresh.add(build_name)
+                self.hit_num += 1
+            else:
+                digests[build_name] = digest
+        if len(digests) <= 1 or jobs <= 1:
+            return
+        import multiprocessing
+        stale_names = sorted(digests.keys())
+        pool = multiprocessing.Pool(min(jobs, len(stale_names)))
+        try:
+            results = pool.map(_EvaluateInWorker, stale_names)
+        finally:
+            pool.close()
+            pool.join()
+        for build_name, declarations, inputs, error in results:
+            if error != None:
+                ErrorExit(error)
+            self.Update(build_name, digests[build_name], declarations, inputs)
+
+    def Report(self, seconds):
+        Info('BUILD cache: %d hits, %d misses, loaded in %.2fs.' % (
+                self.hit_num, self.miss_num, seconds))
+        if self.unknown_num:
+            Info('%d BUILD files use helpers with unknown inputs, they are '
+                    'loaded in every run.' % self.unknown_num)
+
+def GetBuildCache():
+    '''Get BuildCache singleton.'''
+    global _build_cache
+    if _build_cache == None:
+        cache_file = os.path.join(GetCacheDir(), 'build_cache')
+        config_digest = Digest(ReadFile(GetFlameRootFileName()))
+        _build_cache = BuildCache(cache_file, config_digest)
+    return _build_cache
@@ -0,0 +1,157 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Index of BUILD file locations in the workspace.
+
+The workspace walker skips version control dirs, flame's output dirs and
+everything matched by .flameignore. The dirs it visits are saved with their
+mtime, a dir whose mtime is unchanged is not listed again in the next run.
+'''
+
+import cPickle
+import fnmatch
+import os
+import stat
+from util import *
+
+_INDEX_VERSION = 1
+
+_VCS_DIRS = ['.git', '.svn', '.hg']
+
+_build_index = None
+
+def GetIgnoreFileName():
+    return os.path.join(GetFlameRootDir(), '.flameignore')
+
+def ParseIgnorePatterns(content):
+    '''One pattern per line, relative to FLAME_ROOT or a dir name.'''
+    patterns = []
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        patterns.append(line.strip('/'))
+    return patterns
+
+class BuildIndex(object):
+    '''Dir -> (mtime, has BUILD or not, sub dirs), saved in |index_file|.'''
+    def __init__(self, index_file, root_dir, ignore_content):
+        self.index_file = index_file
+        self.root_dir = root_dir
+        self.ignore_digest = Digest(ignore_content)
+        self.ignore_patterns = ParseIgnorePatterns(ignore_content)
+        self.ignored_paths = set([os.path.join(root_dir, GetBuildDirName()),
+                GetBuildDebugRootDir(), GetBuildReleaseRootDir(), GetCacheDir()])
+        self.entries = {}
+        self.scan_num = 0
+        self.dirty = False
+        self.Load()
+
+    def Load(self):
+        if not os.path.isfile(self.index_file):
+            return
+        try:
+            version, ignore_digest, entries = cPickle.loads(
+                    ReadFile(self.index_file))
+        except Exception:
+            Warning('BUILD index %s is broken, ignore it.' % self.index_file)
+            return
+        if version == _INDEX_VERSION and ignore_digest == self.ignore_digest:
+            self.entries = entries
+
+    def Save(self):
+        if not self.dirty:
+            return
+        content = cPickle.dumps(
+                (_INDEX_VERSION, self.ignore_digest, self.entries),
+                cPickle.HIGHEST_PROTOCOL)
+        WriteFileAtomically(self.index_file, content)
+        self.dirty = False
+
+    def IsIgnored(self, dir_name):
+        if dir_name in self.ignored_paths:
+            return True
+        base_name = os.path.basename(dir_name)
+        if base_name in _VCS_DIRS:
+            return True
+        relative_dir = GetWorkspace().GetRelativeDir(dir_name)
+        for pattern in self.ignore_patterns:
+            if (fnmatch.fnmatch(relative_dir, pattern) or
+                    fnmatch.fnmatch(base_name, pattern)):
+                return True
+        return False
+
+    def ScanDir(self, dir_name, mtime):
+        self.scan_num += 1
+        has_build = False
+        sub_dirs = []
+        try:
+            names = sorted(os.listdir(dir_name))
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(dir_name, name)
+            try:
+                mode = os.lstat(path).st_mode
+            except OSError:
+                continue
+            if name == 'BUILD' and stat.S_ISREG(mode):
+                has_build = True
+            elif stat.S_ISDIR(mode) and not self.IsIgnored(path):
+                sub_dirs.append(name)
+        entry = (mtime, has_build, sub_dirs)
+        self.entries[dir_name] = entry
+        self.dirty = True
+        return entry
+
+    def FindBuildFiles(self, start_dir):
+        '''BUILD files under |start_dir|, parent dirs first.'''
+        build_names = []
+        visited = set()
+        dir_stack = [start_dir]
+        while dir_stack:
+            dir_name = dir_stack.pop()
+            try:
+                mtime = os.stat(dir_name).st_mtime
+            except OSError:
+                continue
+            visited.add(dir_name)
+            entry = self.entries.get(dir_name)
+            if entry == None or entry[0] != mtime:
+                entry = self.ScanDir(dir_name, mtime)
+            _, has_build, sub_dirs = entry
+            if has_build:
+                build_names.append(os.path.join(dir_name, 'BUILD'))
+            for sub_dir in reversed(sub_dirs):
+                dir_stack.append(os.path.join(dir_name, sub_dir))
+        # Forget dirs removed under |start_dir|.
+        prefix = start_dir.rstrip('/') + '/'
+        for dir_name in self.entries.keys():
+            if dir_name.startswith(prefix) and dir_name not in visited:
+                del self.entries[dir_name]
+                self.dirty = True
+        self.Save()
+        return build_names
+
+    def GetIndexedBuildFiles(self):
+        '''BUILD files found by the last walks, without rescanning.'''
+        if self.root_dir not in self.entries:
+            return []
+        build_names = []
+        for dir_name, (_, has_build, _) in self.entries.items():
+            if has_build:
+                build_names.append(os.path.join(dir_name, 'BUILD'))
+        return build_names
+
+def GetBuildIndex():
+    '''Get BuildIndex singleton.'''
+    global _build_index
+    if _build_index == None:
+        ignore_content = ''
+        if os.path.isfile(GetIgnoreFileName()):
+            ignore_content = ReadFile(GetIgnoreFileName())
+        _build_index = BuildIndex(os.path.join(GetCacheDir(), 'build_index'),
+                GetFlameRootDir(), ignore_content)
+    return _build_index
@@ -0,0 +1,137 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+BUILD file loader.
+
+Each BUILD file is evaluated once into a Package. The targets of a
+declaration are created and added to the target pool only when the
+declaration is requested or depended on.
+'''
+
+import collections
+import os
+import build_cache
+import build_index
+import target
+import target_pool
+from util import *
+
+def GetDeclarationName(declaration):
+    rule_name, args, kwargs = declaration
+    if rule_name == 'extra_export':
+        return 'extra_export'
+    if 'name' in kwargs:
+        return kwargs['name']
+    return args[0]
+
+class Package(object):
+    '''Declarations of a BUILD file, indexed by target name.'''
+    def __init__(self, package_dir, declarations):
+        self.package_dir = package_dir
+        self.names = []
+        self.declarations = {}
+        for declaration in declarations:
+            name = GetDeclarationName(declaration)
+            if name not in self.declarations:
+                self.names.append(name)
+                self.declarations[name] = []
+            self.declarations[name].append(declaration)
+        self.loaded_names = set()
+
+class BuildLoader(object):
+    '''Loads requested targets and the targets they depend on.
+
+    Labels to load are put in a work queue and loaded breadth first, so only
+    the closure of the requested targets is evaluated.
+    '''
+    def __init__(self, release_prefix):
+        self.release_prefix = release_prefix
+        self.packages = {}
+        # Wildcards in srcs of the loaded targets, see BuildContext.
+        self.globs = {}
+        self.queue = collections.deque()
+        self.target_num = 0
+
+    def GetPackage(self, package_dir):
+        package = self.packages.get(package_dir)
+        if package == None:
+            build_name = os.path.join(package_dir, 'BUILD')
+            declarations = build_cache.GetBuildCache().GetDeclarations(
+                    build_name)
+            package = Package(package_dir, declarations)
+            self.packages[package_dir] = package
+        return package
+
+    def AddPackage(self, package_dir):
+        for name in self.GetPackage(package_dir).names:
+            self.queue.append((package_dir, name))
+
+    def AddTarget(self, package_dir, name):
+        self.queue.append((package_dir, name))
+
+    def Load(self):
+        '''Load the queued labels and everything they depend on.'''
+        while self.queue:
+            package_dir, name = self.queue.popleft()
+            package = self.GetPackage(package_dir)
+            if name in package.loaded_names:
+                continue
+            package.loaded_names.add(name)
+            context = target.BuildContext(package_dir, self.release_prefix)
+            for rule_name, args, kwargs in package.declarations.get(name, []):
+                context.Declare(rule_name, args, kwargs)
+            self.globs.update(context.globs)
+            for new_target in context.targets:
+                new_target.ParseAndAddTarget()
+                self.AddDeps(new_target)
+            self.target_num += len(context.targets)
+
+    def AddDeps(self, dependent):
+        targets = target_pool.GetTargetPool()
+        for target_key in dependent.recursive_library_list:
+            if target_key in targets:
+                continue
+            library_path = os.path.dirname(target_key)
+            library_name = os.path.basename(target_key)
+            if library_path not in self.packages and \
+                    not os.path.isfile(os.path.join(library_path, 'BUILD')):
+                relative_dir = GetWorkspace().GetRelativeDir(library_path)
+                ErrorExit('//%s/BUILD not find. required by //%s:%s.' % (
+                        relative_dir, dependent.relative_dir, dependent.name))
+            if dependent.data.get('export_dynamic') == 1:
+                if library_name[-6:] == '_share':
+                    library_name = library_name[:len(library_name)-6]
+            self.queue.append((library_path, library_name))
+
+    def Report(self):
+        label_num = 0
+        for package in self.packages.values():
+            label_num += len(package.loaded_names)
+        message = 'Loaded %d targets (%d labels) in %d packages' % (
+                self.target_num, label_num, len(self.packages))
+        # Totals are counted from the BUILD index and the BUILD cache, they
+        # are not known before a command walks and loads the workspace.
+        workspace_build_names = build_index.GetBuildIndex().GetIndexedBuildFiles()
+        if not workspace_build_names:
+            Info(message + ', workspace totals are unknown until a command '
+                    'finds the BUILD files under FLAME_ROOT, like flame query.')
+            return
+        cache = build_cache.GetBuildCache()
+        workspace_label_num = 0
+        cached_num = 0
+        for build_name in workspace_build_names:
+            entry = cache.entries.get(build_name)
+            if entry != None:
+                workspace_label_num += len(
+                        Package(os.path.dirname(build_name), entry[1]).names)
+                cached_num += 1
+        if cached_num == len(workspace_build_names):
+            message += ', workspace has %d labels in %d packages' % (
+                    workspace_label_num, len(workspace_build_names))
+        else:
+            message += (', workspace has %d packages, %d labels in the %d '
+                    'loaded before' % (len(workspace_build_names),
+                            workspace_label_num, cached_num))
+        Info(message + '.')
@@ -3,7 +3,7 @@
 # Author: Chao Xiong <fancysimon@gmail.com>
 
 import argparse
-import parser
+import os
 from util import *
 
 _cmd_parser = None
@@ -15,8 +15,8 @@ class CmdParser(object):
     flame {command} [options] targets
 
     """
-    def __init__(self):
-        (self.options, self.targets) = self.CmdParse()
+    def __init__(self, args=None):
+        (self.options, self.targets) = self.CmdParse(args)
 
         for t in self.targets:
             if t.startswith('-'):
@@ -29,11 +29,15 @@ class CmdParser(object):
             'run': self.CheckRunCommand,
             'test': self.CheckTestCommand,
             'clean': self.CheckCleanCommand,
-            'install': self.CheckInstallCommand
+            'install': self.CheckInstallCommand,
+            'watch': self.CheckWatchCommand,
+            'query': self.CheckQueryCommand
         }
         actions[command]()
+        if command in ['build', 'test']:
+            self.CheckAffectedOptions()
 
-    def CmdParse(self):
+    def CmdParse(self, args):
         cmd_help = 'flame <subcommand> [options...] [targets...]'
         arg_parser = argparse.ArgumentParser(prog='flame', description=cmd_help)
 
@@ -55,32 +59,97 @@ class CmdParser(object):
         install_parser = sub_parser.add_parser(
                 'install', help='Install package')
 
+        watch_parser = sub_parser.add_parser(
+                'watch', help='Build or test again when the sources change')
+        watch_parser.add_argument('watch_command', choices=['build', 'test'],
+                help='Command to run when the sources change')
+
+        query_parser = sub_parser.add_parser(
+                'query', help='Query the dependencies of targets')
+        query_parser.add_argument('query_function',
+                choices=['deps', 'rdeps', 'somepath', 'allpaths'],
+                help='deps and rdeps of a target, somepath and allpaths '
+                'from a target to another')
+        self.AddQueryArgs(query_parser)
+
         self.AddBuildArgs(build_parser)
         self.AddBuildArgs(run_parser)
         self.AddBuildArgs(test_parser)
         self.AddBuildArgs(install_parser)
         self.AddBuildArgs(clean_parser)
+        self.AddBuildArgs(watch_parser)
+
+        self.AddAffectedArgs(build_parser)
+        self.AddAffectedArgs(test_parser)
 
         self.AddRunArgs(run_parser)
         self.AddRunArgs(test_parser)
+        self.AddRunArgs(watch_parser)
+        self.AddWatchArgs(watch_parser)
         self.AddInstallArgs(install_parser)
         self.AddInstallArgs(clean_parser)
 
-        return arg_parser.parse_known_args()
+        return arg_parser.parse_known_args(args)
 
     def AddBuildArgs(self, parser):
         parser.add_argument("-j", "--jobs", type=int, dest='jobs',
                 default=0, help="Number of jobs to run simultaneously.")
+        parser.add_argument("--compile-jobs", type=int, dest='compile_jobs',
+                default=0, help="Number of compile jobs to run simultaneously, "
+                "default is the number of jobs, or chosen from the cpus and "
+                "the available memory.")
+        parser.add_argument("--link-jobs", type=int, dest='link_jobs',
+                default=0, help="Number of link jobs to run simultaneously, "
+                "default is chosen from the jobs and the available memory.")
+        parser.add_argument("--max-load", type=float, dest='max_load',
+                default=0, help="Do not start new jobs while the load average "
+                "is above it, default is twice the number of cpus.")
+        parser.add_argument("--loading-jobs", type=int, dest='loading_jobs',
+                default=0, help="Number of processes to load BUILD files, "
+                "default is the number of jobs.")
         parser.add_argument("-p", "--profile", type=str, dest='profile',
                 default='release', help="Build profile: debug or release.")
         parser.add_argument("--generate-scons", dest='generate_scons',
-                action="store_true", help="Generate scons file.")
+                action="store_true",
+                help="Kept for compatibility, the SConstruct is always kept.")
+        parser.add_argument("--backend", type=str, dest='backend',
+                default='scons', choices=['scons', 'ninja', 'native'],
+                help="Build tool to run, scons, ninja or native.")
+        parser.add_argument("--startup-timing", dest='startup_timing',
+                action="store_true",
+                help="Report the time spent before the build starts.")
+        parser.add_argument("--server", dest='server', action="store_true",
+                help="Load and analyze in a resident flame server.")
+        parser.add_argument("--server-idle-timeout", type=int,
+                dest='server_idle_timeout', default=3600,
+                help="Seconds the flame server waits for requests before "
+                "it exits.")
 
     def AddRunArgs(self, parser):
         parser.add_argument("--args", type=str, dest='args',
                 default='',
                 help="Command line arguments to be passed run or test targets.")
 
+    def AddAffectedArgs(self, parser):
+        parser.add_argument("--affected-by", type=str, dest='affected_by',
+                action='append', default=[],
+                help="Only targets affected by the changed files, "
+                "separated by comma.")
+        parser.add_argument("--since", type=str, dest='since', default='',
+                help="Only targets affected by the files changed since "
+                "the git revision.")
+
+    def AddWatchArgs(self, parser):
+        parser.add_argument("--poll", dest='poll', action="store_true",
+                help="Poll for changes instead of using inotify.")
+
+    def AddQueryArgs(self, parser):
+        parser.add_argument("--kind", type=str, dest='kind', default='',
+                help="Only output targets of the rule, wildcards are allowed.")
+        parser.add_argument("--loading-jobs", type=int, dest='loading_jobs',
+                default=0, help="Number of processes to load BUILD files, "
+                "default is the number of cpus.")
+
     def AddInstallArgs(self, parser):
         parser.add_argument("--prefix", type=str, dest='prefix',
                 default='release', help="Install prefix path.")
@@ -91,6 +160,13 @@ class CmdParser(object):
             self.options.profile != 'release'):
             ErrorExit('--profile must be "debug" or "release".')
 
+    def CheckAffectedOptions(self):
+        """check options to select affected targets. """
+        if ((self.options.affected_by or self.options.since) and
+                self.options.server):
+            ErrorExit('--server can not be used with --affected-by or '
+                    '--since.')
+
     def CheckRunCommand(self):
         """check run options and the run targets. """
         self.CheckBuildCommand()
@@ -101,13 +177,32 @@ class CmdParser(object):
         """check test optios. """
         self.CheckBuildCommand()
 
+    def CheckWatchCommand(self):
+        """check watch options. """
+        self.CheckBuildCommand()
+        if self.options.server:
+            ErrorExit('--server can not be used with watch, '
+                    'flame watch keeps the analysis itself.')
+
+    def CheckQueryCommand(self):
+        """check query options. """
+        pass
+
     def CheckCleanCommand(self):
         """check clean options. """
-        self.CheckBuildCommand()
+        self.CheckInstallCommand()
 
     def CheckInstallCommand(self):
         """check install options. """
         self.CheckBuildCommand()
+        # Change reletive path to abspath
+        self.options.prefix = os.path.abspath(self.options.prefix)
+
+def ParseCmdLine(args):
+    '''Parse |args| instead of sys.argv, used by the flame server.'''
+    global _cmd_parser
+    _cmd_parser = CmdParser(args)
+    return _cmd_parser
 
 def GetCmdParser():
     '''Get CmdParser singleton.'''
@@ -115,3 +210,12 @@ def GetCmdParser():
     if _cmd_parser == None:
         _cmd_parser = CmdParser()
     return _cmd_parser
+
+def SelectLoadingJobs():
+    '''Processes loading BUILD files, --loading-jobs, -j or the cpus.'''
+    options = GetCmdParser().options
+    if options.loading_jobs > 0:
+        return options.loading_jobs
+    if getattr(options, 'jobs', 0) > 0:
+        return options.jobs
+    return GetCpuCount()
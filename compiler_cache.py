@@ -0,0 +1,130 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Compiler cache.
+
+compiler_cache in FLAME_ROOT is the launcher compiles run with, ccache,
+sccache or another launcher taking the compile command as its arguments.
+Paths in the commands are relative to FLAME_ROOT. ccache is told FLAME_ROOT
+is its base dir, and debug info maps FLAME_ROOT to ., so checkouts at other
+paths hit the same cache entries.
+
+ccache writes the result of each compile to a stats log next to the object,
+the logs are counted after the build with the sizes of the objects served
+from the cache. sccache reports the difference of its statistics, without
+the bytes.
+'''
+
+import json
+import os
+import subprocess
+from util import *
+
+_STATS_SUFFIX = '.cache_stats'
+
+_HIT_IDS = ['direct_cache_hit', 'preprocessed_cache_hit']
+
+_MISS_IDS = ['cache_miss']
+
+def GetCompilerCache():
+    '''Launcher command set by compiler_cache in FLAME_ROOT, [] if not set.'''
+    compiler_cache = GetFlameRootConfig().get('compiler_cache')
+    if not compiler_cache:
+        return []
+    return VarToList(compiler_cache)
+
+def IsCcache():
+    return os.path.basename(GetCompilerCache()[0]) == 'ccache'
+
+def IsSccache():
+    return os.path.basename(GetCompilerCache()[0]) == 'sccache'
+
+def GetCompilePrefix(target):
+    '''Prefix of the command compiling |target|, '' without a launcher.'''
+    launcher = GetCompilerCache()
+    if not launcher:
+        return ''
+    prefix = ' '.join(launcher) + ' '
+    if IsCcache():
+        prefix = 'CCACHE_STATSLOG=%s%s %s' % (target, _STATS_SUFFIX, prefix)
+    return prefix
+
+def GetCompilerCacheFlags(cpp_flags):
+    '''Flags added to |cpp_flags|, debug info has no absolute paths.'''
+    if GetCompilerCache() and '-g' in cpp_flags:
+        return ['-fdebug-prefix-map=%s=.' % GetFlameRootDir()]
+    return []
+
+def CompilerCacheRules():
+    '''Scons rules compiling with the launcher. Scons clears the environment
+    of commands, the variables of the launcher are passed.
+    '''
+    compile_prefix = GetCompilePrefix('${TARGET}')
+    if not compile_prefix:
+        return []
+    return ['import os\n\n'
+            'for name in ["SHCCCOM", "SHCXXCOM"]:\n'
+            '    env[name] = %r + env[name]\n\n'
+            'for name, value in os.environ.items():\n'
+            '    if (name == "HOME" or name.startswith("CCACHE_") or\n'
+            '            name.startswith("SCCACHE_")):\n'
+            '        env["ENV"][name] = value\n\n' % compile_prefix]
+
+def GetSccacheStats():
+    '''(hits, misses) counted by the sccache server, None if unknown.'''
+    try:
+        output = subprocess.Popen(GetCompilerCache() + ['--show-stats',
+                '--stats-format=json'], stdout=subprocess.PIPE).communicate()[0]
+        stats = json.loads(output)['stats']
+        return (sum(stats['cache_hits']['counts'].values()),
+                sum(stats['cache_misses']['counts'].values()))
+    except Exception:
+        return None
+
+def ExportBaseDir():
+    '''ccache rewrites the absolute paths in FLAME_ROOT to relative paths.'''
+    os.environ['CCACHE_BASEDIR'] = GetFlameRootDir()
+
+class CompilerCacheStats(object):
+    '''Hits, misses and bytes served by the compiler cache in a build.'''
+    def __init__(self):
+        self.start_stats = None
+        if IsSccache():
+            self.start_stats = GetSccacheStats()
+
+    def CountStatsLogs(self):
+        '''Count and remove the stats logs written in the build dir.'''
+        hits = misses = served_bytes = 0
+        for dir_name, dir_names, file_names in os.walk(GetBuildRootDir()):
+            if dir_name == GetBuildRootDir() and '.cache' in dir_names:
+                dir_names.remove('.cache')
+            for file_name in file_names:
+                if not file_name.endswith(_STATS_SUFFIX):
+                    continue
+                stats_name = os.path.join(dir_name, file_name)
+                ids = ReadFile(stats_name).split()
+                os.remove(stats_name)
+                if [stat_id for stat_id in ids if stat_id in _HIT_IDS]:
+                    hits += 1
+                    object_name = stats_name[:-len(_STATS_SUFFIX)]
+                    if os.path.isfile(object_name):
+                        served_bytes += os.path.getsize(object_name)
+                elif [stat_id for stat_id in ids if stat_id in _MISS_IDS]:
+                    misses += 1
+        return hits, misses, served_bytes
+
+    def Report(self):
+        if IsCcache():
+            hits, misses, served_bytes = self.CountStatsLogs()
+            Info('Compiler cache: %d hits, %d misses, %d bytes served.' % (
+                    hits, misses, served_bytes))
+            return
+        if self.start_stats == None:
+            return
+        stats = GetSccacheStats()
+        if stats == None:
+            return
+        Info('Compiler cache: %d hits, %d misses.' % (
+                stats[0] - self.start_stats[0], stats[1] - self.start_stats[1]))
@@ -6,17 +6,22 @@
 Dependence analyser.
 '''
 
-import copy
 import os
 import sys
 from util import *
 
 _sorted_target_node_list = []
 
-class TargetNode:
+# A large component has too many circles to report all of them.
+_MAX_CIRCLES_PER_COMPONENT = 10
+
+class TargetNode(object):
+    __slots__ = ('key', 'recursive_library_list')
+
     def __init__(self, key, recursive_library_list):
         self.key = key
-        self.recursive_library_list = copy.copy(recursive_library_list)
+        # Not copied, the sort does not change it.
+        self.recursive_library_list = recursive_library_list
 
 def ToString(target_node_list):
     ans = ''
@@ -24,6 +29,11 @@ def ToString(target_node_list):
         ans += '[\n    key:' + target_node.key + '\n    lib:' + ',\n    '.join(target_node.recursive_library_list) + '\n]\n'
     return ans
 
+def GetTargetLabel(target_key):
+    relative_dir = GetWorkspace().GetRelativeDir(target_key)
+    return '//%s:%s' % (os.path.dirname(relative_dir),
+            os.path.basename(target_key))
+
 def OutputRequiredErrorAndExit(target_node_list):
     target_key = target_node_list[0].key
     target_key_dict = {}
@@ -35,36 +45,64 @@ def OutputRequiredErrorAndExit(target_node_list):
             if required_library not in target_key_dict:
                 target_required_list.append([target.key, required_library])
     for target_key, required_library in target_required_list:
-        flame_dir = GetFlameRootDir()
-        relative_dir = GetRelativeDir(target_key, flame_dir)
-        target_name = '//%s:%s' % (os.path.dirname(relative_dir), os.path.basename(target_key))
-        relative_dir = GetRelativeDir(required_library, flame_dir)
-        required_library_name = '//%s:%s' % (os.path.dirname(relative_dir), os.path.basename(required_library))
-        Error('%s not find. required by %s' % (required_library_name, target_name))
+        Error('%s not find. required by %s' % (GetTargetLabel(required_library),
+                GetTargetLabel(target_key)))
     sys.exit(1)
 
 def TopologySort(target_pool):
+    '''Kahn's algorithm, in rounds of the nodes without pending deps.
+
+    Nodes of a round are in the order of their keys, so the relative order of
+    two targets only depends on their own deps, not on the other targets
+    loaded with them.
+    '''
     target_node_list = []
-    for key, target in target_pool.items():
-        node = TargetNode(key, target.recursive_library_list_for_sort)
+    for key in sorted(target_pool.keys()):
+        node = TargetNode(key, target_pool[key].recursive_library_list_for_sort)
         target_node_list.append(node)
+    # Number of distinct pending deps, and the nodes which depend on a key.
+    degree_list = []
+    dependent_dict = {}
+    for i, node in enumerate(target_node_list):
+        libraries = set(node.recursive_library_list)
+        degree_list.append(len(libraries))
+        for library in libraries:
+            dependent_dict.setdefault(library, []).append(i)
+    zero_degree_list = [i for i, degree in enumerate(degree_list)
+            if degree == 0]
     result_list = []
-    while True:
-        if len(target_node_list) == 0:
-            break
-        zero_degree_list = filter(lambda x:len(x.recursive_library_list)==0, target_node_list)
-        target_node_list = filter(lambda x:len(x.recursive_library_list)>0, target_node_list)
-
-        if len(zero_degree_list) == 0:
-            if CheckCircle(target_node_list):
-                ErrorExit('Library dependency has circle!')
-            OutputRequiredErrorAndExit(target_node_list)
-        for node in zero_degree_list:
-            for node2 in target_node_list:
-                if node.key in node2.recursive_library_list:
-                    node2.recursive_library_list = filter(lambda x:x!=node.key, node2.recursive_library_list)
-        result_list += zero_degree_list
+    while zero_degree_list:
+        next_zero_degree_list = []
+        for i in zero_degree_list:
+            node = target_node_list[i]
+            result_list.append(node)
+            for j in dependent_dict.get(node.key, []):
+                degree_list[j] -= 1
+                if degree_list[j] == 0:
+                    next_zero_degree_list.append(j)
+        next_zero_degree_list.sort()
+        zero_degree_list = next_zero_degree_list
 
+    if len(result_list) < len(target_node_list):
+        sorted_key_dict = {}
+        for node in result_list:
+            sorted_key_dict[node.key] = 1
+        left_node_list = []
+        for i, node in enumerate(target_node_list):
+            if degree_list[i] > 0:
+                node.recursive_library_list = [library for library in
+                        node.recursive_library_list
+                        if library not in sorted_key_dict]
+                left_node_list.append(node)
+        circle_list, left_num = FindCircles(left_node_list)
+        if circle_list:
+            for circle in circle_list:
+                Error('Library dependency has circle: %s' % ' -> '.join(
+                        [GetTargetLabel(key) for key in circle]))
+            if left_num > 0:
+                Error('%d more targets are in circles with them.' % left_num)
+            ErrorExit('Library dependency has circle!')
+        OutputRequiredErrorAndExit(left_node_list)
     return result_list
 
 def GetSortedTargetNodes(target_pool):
@@ -74,18 +112,116 @@ def GetSortedTargetNodes(target_pool):
     _sorted_target_node_list = TopologySort(target_pool)
     return _sorted_target_node_list
 
-def CheckCircle(target_node_list):
-    node_dict = {}
-    #print ToString(target_node_list)
-    for target_node in target_node_list:
-        for library in target_node.recursive_library_list:
-            key = (target_node.key, library)
-            if key in node_dict:
-                return True
-            node_dict[key] = 1
-            key = (library, target_node.key)
-            if key in node_dict:
-                return True
-            node_dict[key] = 1
-    return False
+def ResetSortedTargetNodes():
+    global _sorted_target_node_list
+    _sorted_target_node_list = []
+
+def FindStronglyConnectedComponents(target_node_list):
+    '''Tarjan's algorithm without recursion, return lists of node indexes.
+
+    Only the deps in |target_node_list| are edges.
+    '''
+    index_dict = {}
+    for i, node in enumerate(target_node_list):
+        index_dict[node.key] = i
+    edge_list = []
+    for node in target_node_list:
+        edge_list.append([index_dict[library]
+                for library in node.recursive_library_list
+                if library in index_dict])
+    order_list = [-1] * len(target_node_list)
+    low_list = [0] * len(target_node_list)
+    on_stack_list = [False] * len(target_node_list)
+    stack = []
+    component_list = []
+    order = 0
+    for root in range(len(target_node_list)):
+        if order_list[root] >= 0:
+            continue
+        # Each frame is a node and the position of its next edge.
+        frame_list = [[root, 0]]
+        order_list[root] = low_list[root] = order
+        order += 1
+        stack.append(root)
+        on_stack_list[root] = True
+        while frame_list:
+            frame = frame_list[-1]
+            i = frame[0]
+            if frame[1] < len(edge_list[i]):
+                j = edge_list[i][frame[1]]
+                frame[1] += 1
+                if order_list[j] < 0:
+                    order_list[j] = low_list[j] = order
+                    order += 1
+                    stack.append(j)
+                    on_stack_list[j] = True
+                    frame_list.append([j, 0])
+                elif on_stack_list[j]:
+                    low_list[i] = min(low_list[i], order_list[j])
+                continue
+            frame_list.pop()
+            if frame_list:
+                parent = frame_list[-1][0]
+                low_list[parent] = min(low_list[parent], low_list[i])
+            if low_list[i] == order_list[i]:
+                component = []
+                while True:
+                    j = stack.pop()
+                    on_stack_list[j] = False
+                    component.append(j)
+                    if j == i:
+                        break
+                component_list.append(component)
+    return component_list, edge_list
+
+def FindCircle(start, member_set, edge_list):
+    '''Shortest circle from |start| back to it inside |member_set|.'''
+    parent_dict = {}
+    queue = [start]
+    while start not in parent_dict:
+        next_queue = []
+        for i in queue:
+            for j in edge_list[i]:
+                if j in member_set and j not in parent_dict:
+                    parent_dict[j] = i
+                    next_queue.append(j)
+        queue = next_queue
+    circle = [start]
+    i = parent_dict[start]
+    while i != start:
+        circle.append(i)
+        i = parent_dict[i]
+    circle.append(start)
+    circle.reverse()
+    return circle
+
+def FindCircles(target_node_list):
+    '''Circles of keys, the first key is repeated at the end.
 
+    Circles are reported until every target of a strongly connected component
+    is in one of them, at most _MAX_CIRCLES_PER_COMPONENT circles for each
+    component. Return the circles and the number of targets in circles which
+    are not reported.
+    '''
+    component_list, edge_list = FindStronglyConnectedComponents(
+            target_node_list)
+    circle_list = []
+    left_num = 0
+    for component in component_list:
+        if len(component) == 1 and component[0] not in edge_list[component[0]]:
+            continue
+        member_set = set(component)
+        covered_set = set()
+        circle_num = 0
+        for start in sorted(component):
+            if start in covered_set:
+                continue
+            if circle_num == _MAX_CIRCLES_PER_COMPONENT:
+                left_num += len(member_set - covered_set)
+                break
+            circle = FindCircle(start, member_set, edge_list)
+            covered_set.update(circle)
+            circle_list.append([target_node_list[i].key for i in circle])
+            circle_num += 1
+    circle_list.sort()
+    return circle_list, left_num
@@ -6,86 +6,195 @@
 Flame.
 '''
 
+import time
+# Taken before other imports, to report the startup time.
+_startup_times = [('start', time.time())]
+
 import os
 import subprocess
 import sys
-from target import *
-from target_pool import *
 from util import *
 from cmd_parser import *
 
+# Modules to load and analyze BUILD files are imported by the commands which
+# need them, so --help and command line errors do not pay for them.
+
+def MarkStartupTime(phase):
+    _startup_times.append((phase, time.time()))
+
+def ReportStartupTime():
+    '''Report the time spent before the build tool starts.'''
+    if not GetCmdParser().options.startup_timing:
+        return
+    MarkStartupTime('generating rules')
+    phases = []
+    launch_time = os.environ.get('FLAME_LAUNCH_TIME')
+    if launch_time:
+        seconds = _startup_times[0][1] - float(launch_time)
+        phases.append('launcher %.1fms' % (seconds * 1000))
+    for i in range(1, len(_startup_times)):
+        seconds = _startup_times[i][1] - _startup_times[i - 1][1]
+        phases.append('%s %.1fms' % (_startup_times[i][0], seconds * 1000))
+    seconds = _startup_times[-1][1] - _startup_times[0][1]
+    Info('Startup timing: %s, total %.1fms.' % (', '.join(phases),
+            seconds * 1000))
+
 def Main():
+    MarkStartupTime('imports')
     cmd_parser = GetCmdParser()
+    MarkStartupTime('command line')
     Check()
-    ChooseDebugOrRelease()
-    cmd_dict = {'build':Build, 'test':Test, 'run':Run, 'clean':Clean, 'install':Install}
+    if cmd_parser.options.command != 'query':
+        ChooseDebugOrRelease()
+    elif not os.path.lexists(GetBuildRootDir()):
+        # The caches of the query are in the build dir, which is linked to
+        # the release build dir by default.
+        ChooseDebugOrRelease()
+    cmd_dict = {'build':Build, 'test':Test, 'run':Run, 'clean':Clean, 'install':Install,
+            'watch':Watch, 'query':Query}
     cmd = cmd_dict[cmd_parser.options.command]
     return cmd()
 
 def ChooseDebugOrRelease():
     cmd_parser = GetCmdParser()
-    if cmd_parser.options.profile == 'release':
+    # The query has no --profile.
+    if getattr(cmd_parser.options, 'profile', 'release') == 'release':
         build_dir = GetBuildReleaseRootDir()
     else:
         build_dir = GetBuildDebugRootDir()
     MkdirIfNotExists(build_dir)
     Symlink(build_dir, GetBuildRootDir())
 
+class AnalysisResult(object):
+    '''What the commands need from the analyzed targets, the flame server
+    sends it back instead of the targets.
+    '''
+    def __init__(self, targets):
+        self.test_cases = []
+        self.binary_names = {}
+        self.need_install = False
+        for target in targets:
+            if target.type == 'cc_test':
+                self.test_cases.append((target.test_case,
+                        target.testcase_rundir, target.testdata_copy_pair))
+            elif target.type == 'cc_binary':
+                self.binary_names[target.name] = target.binary_name
+            if target.scons_actions_for_install:
+                self.need_install = True
+
+def Analyze(cmd):
+    '''Load BUILD files and generate scons rules, return AnalysisResult.'''
+    if GetCmdParser().options.server:
+        import flame_server
+        result = flame_server.RequestAnalysis()
+        if result != None:
+            return result
+    return AnalyzeWithCache(cmd, sys.argv[1:])
+
+def AnalyzeWithCache(cmd, args):
+    '''Analyze the command line |args|, reuse its saved analysis while the
+    BUILD files it loaded are unchanged.
+    '''
+    from analysis_cache import Analysis, GetAnalysisCache
+    from build_index import GetBuildIndex
+    from target_pool import GetAllTargets
+    analysis_cache = GetAnalysisCache()
+    key = None
+    build_names = None
+    # Changed files are not in the command line.
+    if not HasAffectedOptions():
+        if '...' in args:
+            build_names = GetBuildIndex().FindBuildFiles(GetCurrentDir())
+        key = (GetCurrentDir(), tuple(args))
+        analysis = analysis_cache.FindAnalysis(key, build_names)
+        if analysis != None:
+            Info('BUILD files are not changed, reuse the analysis.')
+            if analysis.scons_content != None:
+                from sconscript import WriteSconstruct
+                WriteSconstruct([analysis.scons_content])
+            return analysis.result
+    loader = LoadBuildFiles()
+    sconscript_names = GenerateBuildRules(cmd)
+    result = AnalysisResult(GetAllTargets())
+    if key != None:
+        scons_content = None
+        if IsSconsBackend():
+            scons_content = ReadFile(GetSconsFileName(GetFlameRootDir()))
+        analysis_cache.StoreAnalysis(key, Analysis(loader, build_names,
+                result, scons_content, sconscript_names))
+    analysis_cache.Save()
+    return result
+
+def HasAffectedOptions():
+    options = GetCmdParser().options
+    return (options.command in ['build', 'test'] and
+            (options.affected_by or options.since))
+
+def IsSconsBackend():
+    return GetCmdParser().options.backend == 'scons'
+
+def IsNinjaBackend():
+    return GetCmdParser().options.backend == 'ninja'
+
+def IsNativeBackend():
+    return GetCmdParser().options.backend == 'native'
+
 def Build():
-    LoadBuildFiles()
-    GenerateSconsRules('build')
-    RunScons('build')
+    result = Analyze('build')
+    RunBuild('build', result)
     Info('Build success!')
     return 0
 
 def Test():
-    LoadBuildFiles()
-    GenerateSconsRules('test')
-    RunScons('test')
-    return RunTestCases()
+    result = Analyze('test')
+    RunBuild('test', result)
+    return RunTestCases(result)
 
 def Run():
-    LoadBuildFiles()
-    GenerateSconsRules('run')
-    RunScons('run')
-    return RunBinary()
+    result = Analyze('run')
+    RunBuild('run', result)
+    return RunBinary(result)
 
 def Clean():
-    LoadBuildFiles()
-    GenerateSconsRules('clean')
-    RunScons('clean')
+    result = Analyze('clean')
+    RunBuild('clean', result)
     Info('Clean success!')
     return 0
 
 def Install():
-    LoadBuildFiles()
-    GenerateSconsRules('install')
-    RunScons('install')
+    result = Analyze('install')
+    RunBuild('install', result)
     Info('Install success!')
     return 0
 
-def RunTestCases():
+def Watch():
+    import watcher
+    return watcher.Watch()
+
+def Query():
+    import query
+    return query.Query()
+
+def RunTestCases(result):
     cmd_parser = GetCmdParser()
-    targets = GetAllTargets()
     test_case_num = 0
     success_test_case_num = 0
     current_dir = GetCurrentDir()
-    for target in targets:
-        if target.type == 'cc_test':
-            MkdirIfNotExists(target.testcase_rundir)
-            os.chdir(target.testcase_rundir)
-            # Copy testdata symlink to run dir.
-            for pair in target.testdata_copy_pair:
-                target_dir = os.path.dirname(pair[1])
-                MkdirIfNotExists(target_dir)
-                Symlink(pair[0], pair[1])
-            cmd_list = [target.test_case]
-            if cmd_parser.options.args:
-                cmd_list += cmd_parser.options.args.split(' ')
-            ret = subprocess.call(cmd_list)
-            if ret == 0:
-                success_test_case_num += 1
-            test_case_num += 1
+    for test_case, testcase_rundir, testdata_copy_pair in result.test_cases:
+        MkdirIfNotExists(testcase_rundir)
+        os.chdir(testcase_rundir)
+        # Copy testdata symlink to run dir.
+        for pair in testdata_copy_pair:
+            target_dir = os.path.dirname(pair[1])
+            MkdirIfNotExists(target_dir)
+            Symlink(pair[0], pair[1])
+        cmd_list = [test_case]
+        if cmd_parser.options.args:
+            cmd_list += cmd_parser.options.args.split(' ')
+        ret = subprocess.call(cmd_list)
+        if ret == 0:
+            success_test_case_num += 1
+        test_case_num += 1
     os.chdir(current_dir)
     if test_case_num == success_test_case_num:
         Info('All test cases passed!')
@@ -95,7 +204,7 @@ def RunTestCases():
         Error('%d test cases failed!' % (test_case_num - success_test_case_num))
         return test_case_num - success_test_case_num
 
-def RunBinary():
+def RunBinary(result):
     cmd_parser = GetCmdParser()
     # Only run the first target.
     run_target = cmd_parser.targets[0]
@@ -103,12 +212,7 @@ def RunBinary():
     if len(fields) == 2:
         if fields[0] != '':
             ErrorExit('Target format is invalid.')
-        binary_name = ''
-        targets = GetAllTargets()
-        for target in targets:
-            if target.type == 'cc_binary':
-                if target.name == fields[1]:
-                    binary_name = target.binary_name
+        binary_name = result.binary_names.get(fields[1], '')
         if binary_name != '':
             current_dir = GetCurrentDir()
             binary_dir = os.path.dirname(binary_name)
@@ -127,43 +231,40 @@ def RunBinary():
     else:
         ErrorExit('Target format is invalid.')
 
-def LoadBuildFile(target=None):
-    cmd_parser = GetCmdParser()
-    build_name = GetBuildName()
-    if not os.path.isfile(build_name):
+def AddBuildFile(loader, package_dir, target=None):
+    if not os.path.isfile(os.path.join(package_dir, 'BUILD')):
         ErrorExit('BUILD not find.')
-    # Clear targets to load send by sys.argv.
-    sys.argv = []
-    if target != None:
-        sys.argv = [target]
-    if cmd_parser.options.command == 'test':
-        sys.argv.append('-test')
-    if cmd_parser.options.command in ['install', 'clean'] :
-        abs_prefix = os.path.abspath(cmd_parser.options.prefix)
-        sys.argv.append('-prefix=%s' % abs_prefix)
-    execfile(build_name)
+    if target == None:
+        loader.AddPackage(package_dir)
+    else:
+        loader.AddTarget(package_dir, target)
 
 def LoadBuildFiles():
+    from analysis_cache import GetAnalysisCache
+    from build_cache import GetBuildCache
+    from build_index import GetBuildIndex
+    from build_loader import BuildLoader
     Check()
+    # The saved analyzed targets are numbered in the saved symbol table, it is
+    # loaded before the BUILD files add symbols.
+    GetAnalysisCache().LoadTargets()
     cmd_parser = GetCmdParser()
-    # Change reletive path to abspath
+    release_prefix = ''
     if cmd_parser.options.command in ['install', 'clean'] :
-        abs_prefix = os.path.abspath(cmd_parser.options.prefix)
-        cmd_parser.options.prefix = abs_prefix
+        release_prefix = cmd_parser.options.prefix
     Info('Loading BUILDs...')
+    start_time = time.time()
+    loader = BuildLoader(release_prefix)
+    current_dir = GetCurrentDir()
     if len(cmd_parser.targets) == 0:
-        LoadBuildFile()
+        AddBuildFile(loader, current_dir)
     else:
-        current_dir = GetCurrentDir()
         for option_target in cmd_parser.targets:
             if option_target == '...':
-                for target_dir, _, _ in os.walk(current_dir):
-                    os.chdir(target_dir)
-                    build_name = GetBuildName()
-                    if not os.path.isfile(build_name):
-                        continue
-                    LoadBuildFile()
-                os.chdir(current_dir)
+                build_names = GetBuildIndex().FindBuildFiles(current_dir)
+                GetBuildCache().Prefetch(build_names, SelectLoadingJobs())
+                for build_name in build_names:
+                    AddBuildFile(loader, os.path.dirname(build_name))
                 break
             else:
                 fields = option_target.split(':')
@@ -171,32 +272,70 @@ def LoadBuildFiles():
                     target_dir = os.path.join(current_dir, option_target)
                     if not os.path.isdir(target_dir):
                         ErrorExit('Dir is not exists: %s' % target_dir)
-                    os.chdir(target_dir)
-                    LoadBuildFile()
-                    os.chdir(current_dir)
+                    AddBuildFile(loader, os.path.realpath(target_dir))
                 elif len(fields) == 2:
                     target_dir = os.path.join(current_dir, fields[0])
                     if not os.path.isdir(target_dir):
                         ErrorExit('Dir is not exists: %s' % target_dir)
-                    os.chdir(target_dir)
-                    LoadBuildFile(fields[1])
-                    os.chdir(current_dir)
+                    AddBuildFile(loader, os.path.realpath(target_dir),
+                            fields[1])
                 else:
                     ErrorExit('Target format is invalid.')
+    if HasAffectedOptions():
+        import query
+        if query.SelectAffectedTargets(loader) == 0:
+            Info('No targets to build.')
+            sys.exit(0)
+    loader.Load()
+    build_cache = GetBuildCache()
+    build_cache.Save()
+    build_cache.Report(time.time() - start_time)
+    loader.Report()
+    MarkStartupTime('loading')
+    return loader
 
-def GenerateSconsRules(cmd):
+def GenerateBuildRules(cmd):
+    '''Write the action files and the SConstruct, build.ninja for the ninja
+    backend or the action graph for the native backend, return the names of
+    the files the backend loads.
+    '''
+    from sconscript import WriteSconscripts, WriteSconstruct
+    from target_pool import GetAllTargets, WriteRuleForAllTargets
     WriteRuleForAllTargets()
-    scons_rules = GetSconsRules(cmd)
+    MarkStartupTime('analysis')
+    if IsNinjaBackend():
+        from ninja_backend import WriteNinjaFile
+        return [WriteNinjaFile(cmd, GetAllTargets(), GetProfileCppFlags())]
+    if IsNativeBackend():
+        from native_backend import WriteActionGraph
+        return [WriteActionGraph(cmd, GetAllTargets(), GetProfileCppFlags())]
+    sconscript_names = WriteSconscripts(cmd, GetAllTargets())
+    scons_rules = GetSconsRules(cmd, sconscript_names)
     if len(scons_rules) == 0:
         ErrorExit('No targets to build.')
-    flame_root_dir = GetFlameRootDir()
-    scons_file_name = GetSconsFileName(flame_root_dir)
-    scons_file = open(scons_file_name, 'w')
-    for rule in scons_rules:
-        scons_file.write(rule)
-    scons_file.close()
-
-def RunScons(cmd):
+    WriteSconstruct(scons_rules)
+    return sconscript_names
+
+def RunBuild(cmd, result):
+    '''The compiler cache is reported after the build, even if it fails.'''
+    from compiler_cache import CompilerCacheStats, ExportBaseDir
+    from compiler_cache import GetCompilerCache
+    compiler_cache_stats = None
+    if cmd != 'clean' and GetCompilerCache():
+        ExportBaseDir()
+        compiler_cache_stats = CompilerCacheStats()
+    try:
+        if IsNinjaBackend():
+            RunNinja(cmd, result)
+        elif IsNativeBackend():
+            RunNative(cmd, result)
+        else:
+            RunScons(cmd, result)
+    finally:
+        if compiler_cache_stats != None:
+            compiler_cache_stats.Report()
+
+def RunScons(cmd, result):
     cmd_parser = GetCmdParser()
     current_dir = GetCurrentDir()
     blame_root_dir = GetFlameRootDir()
@@ -209,18 +348,53 @@ def RunScons(cmd):
     SelectJobs()
     if cmd_parser.options.jobs > 1:
         cmd_list.append('-j %d' % cmd_parser.options.jobs)
+    ReportStartupTime()
     ret_code = subprocess.call(cmd_list)
     if ret_code != 0:
         ErrorExit('There are some errors!')
-    if cmd == 'install' and NeedInstall():
+    if cmd == 'install' and result.need_install:
         cmd_list.append('install')
         ret_code = subprocess.call(cmd_list)
         if ret_code != 0:
             ErrorExit('There are some errors when install!')
+    os.chdir(current_dir)
+    return 0
+
+def RunNinja(cmd, result):
+    from ninja_backend import GetNinjaFileName, WritePoolFile
+    cmd_parser = GetCmdParser()
+    current_dir = GetCurrentDir()
+    os.chdir(GetFlameRootDir())
+    SelectJobs()
+    WritePoolFile(cmd_parser.options.compile_jobs,
+            cmd_parser.options.link_jobs)
+    cmd_list = ['ninja', '-f', GetNinjaFileName(), '-j',
+            str(cmd_parser.options.compile_jobs +
+                    cmd_parser.options.link_jobs),
+            '-l', str(cmd_parser.options.max_load)]
+    if cmd == 'clean':
+        cmd_list += ['-t', 'clean']
+    ReportStartupTime()
+    ret_code = subprocess.call(cmd_list)
+    if ret_code != 0:
+        ErrorExit('There are some errors!')
+    if cmd == 'install' and result.need_install:
+        ret_code = subprocess.call(cmd_list + ['install'])
+        if ret_code != 0:
+            ErrorExit('There are some errors when install!')
+    os.chdir(current_dir)
+    return 0
 
-    scons_file_name = GetSconsFileName(GetFlameRootDir())
-    if not cmd_parser.options.generate_scons:
-        os.remove(scons_file_name)
+def RunNative(cmd, result):
+    from native_backend import RunActionGraph
+    current_dir = GetCurrentDir()
+    os.chdir(GetFlameRootDir())
+    SelectJobs()
+    ReportStartupTime()
+    options = GetCmdParser().options
+    jobs = {'compile': options.compile_jobs, 'link': options.link_jobs}
+    if not RunActionGraph(cmd, jobs, options.max_load, result.need_install):
+        ErrorExit('There are some errors!')
     os.chdir(current_dir)
     return 0
 
@@ -229,61 +403,68 @@ def Check():
         ErrorExit('FLAME_ROOT not find!')
 
 def SelectJobs():
-    cmd_parser = GetCmdParser()
-    if cmd_parser.options.jobs <= 0:
-        jobs = GetCpuCount()
-        if jobs <= 4:
-            jobs *= 2
-        elif jobs > 8:
-            jobs = 8
-        cmd_parser.options.jobs = jobs
-    Info('Jobs number is %d.' % cmd_parser.options.jobs)
-
-def GetSconsRules(cmd):
-    cmd_parser = GetCmdParser()
-    target_types = ['env', 'cc_library', 'cc_binary', 'proto_library', 'cc_test']
-    if cmd == 'install':
-        target_types += ['extra_export']
-    #elif cmd in ['test', 'clean']:
-    #    target_types += ['cc_test']
+    '''Choose the numbers of compile and link jobs unless they are given.
+
+    Without -j, compiles default to the number of cpus, links to -j or the
+    number of cpus. Both are limited by the memory available to them.
+    '''
+    options = GetCmdParser().options
+    cpu_count = GetCpuCount()
+    memory = GetAvailableMemory()
+    def LimitByMemory(jobs, pool):
+        if memory == None:
+            return jobs
+        return max(1, min(jobs, memory / GetJobMemory(pool)))
+    if options.compile_jobs <= 0:
+        if options.jobs > 0:
+            options.compile_jobs = options.jobs
+        else:
+            options.compile_jobs = LimitByMemory(cpu_count, 'compile')
+    if options.link_jobs <= 0:
+        options.link_jobs = LimitByMemory(options.jobs or cpu_count, 'link')
+    if options.max_load <= 0:
+        options.max_load = cpu_count * 2
+    options.jobs = options.compile_jobs
+    Info('Jobs number is %d, at most %d links.' % (options.compile_jobs,
+            options.link_jobs))
+
+def GetProfileCppFlags():
+    from compiler_cache import GetCompilerCacheFlags
+    cpp_flags = ['-DNDEBUG', '-O2']
+    if GetCmdParser().options.profile == 'debug':
+        cpp_flags = ['-g', '-DDEBUG']
+    return cpp_flags + GetCompilerCacheFlags(cpp_flags)
 
+def GetSconsRules(cmd, sconscript_names):
+    from compiler_cache import CompilerCacheRules
     scons_rules = []
     scons_rules.append('import SCons\n\n')
     scons_rules.append('env = Environment(CPPPATH=[\"%s\", \"%s\"])\n\n' % (GetFlameRootDir(), GetBuildRootDir()))
 
     # Add c++ flags.
-    cpp_flags = ['-DNDEBUG', '-O2']
-    if cmd_parser.options.profile == 'debug':
-        cpp_flags = ['-g', '-DDEBUG']
-    scons_rules.append('env.Append(CPPFLAGS=%s)\n\n' % (cpp_flags))
+    scons_rules.append('env.Append(CPPFLAGS=%s)\n\n' % GetProfileCppFlags())
 
     # Add project flags.
-    flame_root = os.path.join(GetFlameRootDir(), 'FLAME_ROOT')
-    execfile(flame_root)
-    if 'include_paths' in locals():
-        scons_rules.append('env.Append(CPPPATH=%s)\n\n' % VarToList(locals()['include_paths']))
-    if 'lib_paths' in locals():
-        scons_rules.append('env.Append(LIBPATH=%s)\n\n' % VarToList(locals()['lib_paths']))
+    flame_root_config = GetFlameRootConfig()
+    if 'include_paths' in flame_root_config:
+        scons_rules.append('env.Append(CPPPATH=%s)\n\n' % VarToList(flame_root_config['include_paths']))
+    if 'lib_paths' in flame_root_config:
+        scons_rules.append('env.Append(LIBPATH=%s)\n\n' % VarToList(flame_root_config['lib_paths']))
+
+    # Compile with the launcher of the compiler cache.
+    scons_rules += CompilerCacheRules()
 
     # Add builder for protobuf.
     scons_rules += ProtoBuilderRules()
 
-    targets = GetAllTargets()
-    for target in targets:
-        if target.type in target_types:
-            scons_rules += target.scons_rules
-            scons_rules.append('\n')
-        if cmd in ['install', 'clean']:
-            scons_rules += target.scons_rules_for_install
-            scons_rules.append('\n')
-    return scons_rules
+    scons_rules += ActionLoaderRules()
 
-def NeedInstall():
-    targets = GetAllTargets()
-    scons_rules = []
-    for target in targets:
-        scons_rules += target.scons_rules_for_install
-    return len(scons_rules) > 0
+    # Actions of the targets, the nodes are shared by name.
+    scons_rules.append('for file_name in [\n')
+    for sconscript_name in sconscript_names:
+        scons_rules.append('        \"%s\",\n' % sconscript_name)
+    scons_rules.append('        ]:\n    LoadActions(file_name)\n')
+    return scons_rules
 
 if __name__ == '__main__':
     ret = Main()
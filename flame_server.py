@@ -0,0 +1,257 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Flame server.
+
+With --server, a resident process per workspace loads and analyzes the
+BUILD files for the flame command, and keeps the evaluated BUILD files and
+the analysis results in memory. A repeated request is answered from memory
+while its BUILD files, package dirs and FLAME_ROOT are unchanged. Otherwise
+only the changed BUILD files are evaluated again. The command runs scons and
+the tests itself. The server exits after it is idle for
+--server-idle-timeout seconds.
+'''
+
+import cPickle
+import os
+import socket
+import stat
+import struct
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from analysis_cache import GetStamp
+from util import *
+
+# Seconds to wait for a starting server.
+_START_TIMEOUT = 10
+
+def IsPrivate(path, is_dir):
+    '''|path| is owned by the user and others have no access to it.'''
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if is_dir:
+        is_type = stat.S_ISDIR(st.st_mode)
+    else:
+        is_type = stat.S_ISSOCK(st.st_mode)
+    return is_type and st.st_uid == os.getuid() and not (st.st_mode & 077)
+
+def GetSocketDir():
+    '''Directory of the sockets of the user, only the user can access it.
+
+    Messages are unpickled, a socket bound by another user would run code
+    in flame. None if the directory is not private.
+    '''
+    socket_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not socket_dir or not IsPrivate(socket_dir, True):
+        socket_dir = os.path.join(tempfile.gettempdir(),
+                'flame-%d' % os.getuid())
+        if not os.path.lexists(socket_dir):
+            try:
+                os.mkdir(socket_dir, 0700)
+            except OSError:
+                pass
+    if not IsPrivate(socket_dir, True):
+        Warning('%s is not a private directory of the user.' % socket_dir)
+        return None
+    return socket_dir
+
+def GetSocketName(root_dir):
+    '''None if there is no private directory for it.'''
+    # The length of a unix socket path is limited, so it is not in the
+    # workspace.
+    socket_dir = GetSocketDir()
+    if socket_dir == None:
+        return None
+    return os.path.join(socket_dir, 'flame-%s.sock' % Digest(root_dir)[:16])
+
+def IsPeerOfUser(sock):
+    '''The process at the other end runs as the user, checked on linux.'''
+    if not sys.platform.startswith('linux'):
+        return True
+    # SO_PEERCRED is 17 on linux, python 2 does not define it.
+    credentials = sock.getsockopt(socket.SOL_SOCKET,
+            getattr(socket, 'SO_PEERCRED', 17), struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', credentials)
+    return uid == os.getuid()
+
+def SendMessage(sock, message):
+    content = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!I', len(content)) + content)
+
+def ReceiveMessage(sock):
+    header = ReceiveBytes(sock, 4)
+    content = ReceiveBytes(sock, struct.unpack('!I', header)[0])
+    return cPickle.loads(content)
+
+def ReceiveBytes(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('Flame server closed the connection.')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def Connect(socket_name):
+    '''Connect to the socket if it and its server belong to the user.'''
+    if not IsPrivate(socket_name, False):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_name)
+        if IsPeerOfUser(sock):
+            return sock
+    except socket.error:
+        pass
+    sock.close()
+    return None
+
+def StartServer(socket_name):
+    from cmd_parser import GetCmdParser
+    server_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'flame_server.py')
+    idle_timeout = GetCmdParser().options.server_idle_timeout
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen([sys.executable, server_file, str(idle_timeout)],
+            cwd=GetFlameRootDir(), stdin=devnull, stdout=devnull,
+            stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+    devnull.close()
+    deadline = time.time() + _START_TIMEOUT
+    while time.time() < deadline:
+        sock = Connect(socket_name)
+        if sock != None:
+            return sock
+        time.sleep(0.05)
+    return None
+
+def RequestAnalysis():
+    '''Ask the flame server to analyze, start it if it is not running.
+
+    Return the AnalysisResult, None if the command should analyze itself.
+    '''
+    socket_name = GetSocketName(GetFlameRootDir())
+    if socket_name == None:
+        Warning('Flame server is not available, analyze locally.')
+        return None
+    sock = Connect(socket_name)
+    if sock == None:
+        Info('Starting flame server...')
+        sock = StartServer(socket_name)
+        if sock == None:
+            Warning('Flame server is not available, analyze locally.')
+            return None
+    request = {
+        'cwd': GetCurrentDir(),
+        'args': sys.argv[1:],
+        'color': IsColorEnabled(),
+        'environ': dict(os.environ),
+    }
+    try:
+        SendMessage(sock, request)
+        response = ReceiveMessage(sock)
+    except (socket.error, EOFError):
+        Warning('Flame server is not available, analyze locally.')
+        return None
+    finally:
+        sock.close()
+    sys.stderr.write(response['output'])
+    if response['result'] == None and response['code'] == 0:
+        return None
+    if response['code'] != 0:
+        sys.exit(response['code'])
+    return response['result']
+
+class FlameServer(object):
+    def __init__(self, socket_name, idle_timeout):
+        self.socket_name = socket_name
+        self.idle_timeout = idle_timeout
+        self.flame_root_stamp = GetStamp(GetFlameRootFileName())
+        self.stopped = False
+
+    def Serve(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The directory is private, a file in it is left by an old server.
+        if os.path.lexists(self.socket_name):
+            os.remove(self.socket_name)
+        listener.bind(self.socket_name)
+        os.chmod(self.socket_name, 0600)
+        listener.listen(5)
+        listener.settimeout(self.idle_timeout)
+        try:
+            while not self.stopped:
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    break
+                if not IsPeerOfUser(connection):
+                    connection.close()
+                    continue
+                connection.settimeout(None)
+                try:
+                    request = ReceiveMessage(connection)
+                    SendMessage(connection, self.Handle(request))
+                except (socket.error, EOFError):
+                    pass
+                connection.close()
+        finally:
+            listener.close()
+            if os.path.exists(self.socket_name):
+                os.remove(self.socket_name)
+
+    def Handle(self, request):
+        if GetStamp(GetFlameRootFileName()) != self.flame_root_stamp:
+            # Everything evaluated depends on FLAME_ROOT, start over.
+            self.stopped = True
+            return {'output': '', 'code': 0, 'result': None}
+        output = StringIO.StringIO()
+        stderr = sys.stderr
+        sys.stderr = output
+        code = 0
+        result = None
+        try:
+            os.chdir(request['cwd'])
+            SetColorEnabled(request['color'])
+            # BUILD files may read the environment of the command.
+            os.environ.clear()
+            os.environ.update(request['environ'])
+            result = self.Analyze(request['args'])
+        except SystemExit, e:
+            code = e.code
+            if code == None:
+                code = 0
+        except Exception:
+            output.write(traceback.format_exc())
+            code = 1
+        sys.stderr = stderr
+        return {'output': output.getvalue(), 'code': code, 'result': result}
+
+    def Analyze(self, args):
+        import flame
+        import build_cache
+        import cmd_parser
+        import target_pool
+        options = cmd_parser.ParseCmdLine(args).options
+        target_pool.ResetTargetPool()
+        build_cache.GetBuildCache().Refresh()
+        return flame.AnalyzeWithCache(options.command, args)
+
+def Main():
+    idle_timeout = int(sys.argv[1])
+    socket_name = GetSocketName(GetFlameRootDir())
+    if socket_name == None:
+        return 1
+    server = FlameServer(socket_name, idle_timeout)
+    server.Serve()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -0,0 +1,510 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Native backend.
+
+The actions of the targets are turned into the commands ninja runs for
+build.ninja, and saved in the build dir as a marshaled action graph. flame
+runs the graph itself with a pool of processes, no build tool is started.
+
+An action is up to date when its outputs exist and the signature of its
+command, of its inputs and of the headers in its last depfile is the
+signature saved when it ran. Signatures are made of the digests of the
+contents of files, the digests are saved with the stamps of the files and a
+file is only read again when its stamp changes. An output rebuilt with the
+same content does not rebuild the actions using it.
+
+The durations of the actions are saved too. Of the ready actions, the one
+with the longest estimated path of actions after it starts first, so long
+chains like protoc, the generated source, the archive and the test link do
+not start late.
+'''
+
+import collections
+import cPickle
+import hashlib
+import heapq
+import marshal
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from analysis_cache import GetStamp
+from ninja_backend import AddTargets, NinjaWriter
+from sconscript import GetSconscriptCache
+from util import *
+
+_GRAPH_FILE_NAME = 'flame.graph'
+
+_STATE_VERSION = 2
+
+# Seconds an action of a pool is estimated to take, if no action of the pool
+# has run.
+_DEFAULT_DURATION = 1.0
+
+# $$, $ , $:, ${name} and $name in the values of ninja.
+_VARIABLE_PATTERN = re.compile(r'\$(?:([$ :])|\{([^}]*)\}|([a-zA-Z0-9_-]+))')
+
+# Paths with other chars are quoted in $in and $out, like ninja does.
+_SHELL_SAFE_PATTERN = re.compile(r'^[a-zA-Z0-9_+./-]*$')
+
+_build_state = None
+
+def GetGraphFileName():
+    return os.path.join(GetBuildRootDir(), _GRAPH_FILE_NAME)
+
+def ShellEscape(path):
+    if _SHELL_SAFE_PATTERN.match(path):
+        return path
+    return "'%s'" % path.replace("'", "'\\''")
+
+def Evaluate(value, scopes):
+    '''Expand the variables of the ninja |value|, they are looked up in the
+    dicts |scopes| in order.
+    '''
+    def Replace(match):
+        if match.group(1):
+            return match.group(1)
+        name = match.group(2) or match.group(3)
+        for scope in scopes:
+            if name in scope:
+                return scope[name]
+        return ''
+    return _VARIABLE_PATTERN.sub(Replace, value)
+
+class ActionGraphWriter(NinjaWriter):
+    '''Records the build lines of build.ninja as actions with the commands
+    ninja would run for them.
+
+    An action is (outputs, command, inputs, implicit deps, order-only deps,
+    has depfile, pool).
+    '''
+    def __init__(self, cpp_flags):
+        NinjaWriter.__init__(self, cpp_flags)
+        self.variables = {}
+        self.rules = {}
+        self.actions = []
+
+    def AddVariable(self, name, value):
+        self.variables[name] = Evaluate(value, [self.variables])
+
+    def AddRule(self, name, command, has_depfile, pool):
+        self.rules[name] = (command, has_depfile, pool)
+
+    def AddBuild(self, outputs, rule, inputs, implicit_deps=[],
+            order_only_deps=[], variables=[]):
+        command, has_depfile, pool = self.rules[rule]
+        scope = {'in': ' '.join(map(ShellEscape, inputs)),
+                'out': ' '.join(map(ShellEscape, outputs))}
+        for name, value in variables:
+            scope[name] = Evaluate(value, [self.variables])
+        self.actions.append((list(outputs), Evaluate(command,
+                [scope, self.variables]), list(inputs), list(implicit_deps),
+                list(order_only_deps), has_depfile, pool))
+
+    def Finish(self):
+        pass
+
+def WriteActionGraph(cmd, targets, cpp_flags):
+    '''Write the action graph of |targets| sorted after their deps, return
+    the name of its file.
+    '''
+    writer = ActionGraphWriter(cpp_flags)
+    AddTargets(writer, cmd, targets)
+    graph_file_name = GetGraphFileName()
+    content = marshal.dumps((writer.actions, writer.defaults,
+            writer.installs))
+    if GetSconscriptCache().Write(graph_file_name, [content]):
+        GetSconscriptCache().Save()
+        Info('%s written.' % _GRAPH_FILE_NAME)
+    return graph_file_name
+
+def ParseDepfile(depfile_name):
+    '''Prerequisites of the rule gcc writes with -MMD.'''
+    content = ReadFile(depfile_name).replace('\\\n', ' ')
+    content = content[content.find(':') + 1:]
+    return [os.path.normpath(path.replace('\\ ', ' '))
+            for path in re.findall(r'(?:\\ |\S)+', content)]
+
+class BuildState(object):
+    '''Digests of files and signatures of the actions run, saved in
+    |state_file|.
+    '''
+    def __init__(self, state_file):
+        self.state_file = state_file
+        # Path -> (stamp, digest).
+        self.files = {}
+        # First output -> (signature, headers in the depfile).
+        self.actions = {}
+        # First output -> seconds it took the last time it ran.
+        self.durations = {}
+        self.changed = False
+        self.Load()
+
+    def Load(self):
+        if not os.path.isfile(self.state_file):
+            return
+        try:
+            content = cPickle.loads(ReadFile(self.state_file))
+        except Exception:
+            Warning('Build state %s is broken, ignore it.' % self.state_file)
+            return
+        if content[0] != _STATE_VERSION:
+            return
+        _, self.files, self.actions, self.durations = content
+
+    def Save(self):
+        if not self.changed:
+            return
+        content = cPickle.dumps((_STATE_VERSION, self.files, self.actions,
+                self.durations), cPickle.HIGHEST_PROTOCOL)
+        WriteFileAtomically(self.state_file, content)
+        self.changed = False
+
+    def GetDigest(self, path):
+        '''Digest of the content of |path|, None if it does not exist.'''
+        stamp = GetStamp(path)
+        if stamp == None:
+            return None
+        entry = self.files.get(path)
+        if entry != None and entry[0] == stamp:
+            return entry[1]
+        sha1 = hashlib.sha1()
+        f = open(path, 'rb')
+        try:
+            while True:
+                content = f.read(1 << 20)
+                if not content:
+                    break
+                sha1.update(content)
+        finally:
+            f.close()
+        digest = sha1.hexdigest()
+        self.files[path] = (stamp, digest)
+        self.changed = True
+        return digest
+
+    def Forget(self, path):
+        '''|path| is rewritten, maybe within the resolution of its stamp.'''
+        if self.files.pop(path, None) != None:
+            self.changed = True
+
+    def GetSignature(self, action, headers):
+        '''None if an input of |action| is missing.'''
+        outputs, command, inputs, implicit_deps, _, _, _ = action
+        sha1 = hashlib.sha1(command)
+        for path in inputs + implicit_deps + headers:
+            digest = self.GetDigest(path)
+            if digest == None:
+                return None
+            sha1.update('\0%s\0%s' % (path, digest))
+        return sha1.hexdigest()
+
+    def IsUpToDate(self, action):
+        outputs = action[0]
+        entry = self.actions.get(outputs[0])
+        if entry == None:
+            return False
+        for output in outputs:
+            if GetStamp(output) == None:
+                return False
+        return entry[0] == self.GetSignature(action, entry[1])
+
+    def Record(self, action, duration):
+        '''Save the signature and the |duration| of |action| which has just
+        run.
+        '''
+        outputs, _, inputs, _, _, has_depfile, _ = action
+        for output in outputs:
+            self.Forget(output)
+        headers = []
+        if has_depfile:
+            depfile_name = outputs[0] + '.d'
+            if os.path.isfile(depfile_name):
+                headers = [path for path in ParseDepfile(depfile_name)
+                        if path not in inputs]
+                os.remove(depfile_name)
+        self.actions[outputs[0]] = (self.GetSignature(action, headers),
+                headers)
+        self.durations[outputs[0]] = duration
+        self.changed = True
+
+    def Discard(self, action):
+        for output in action[0]:
+            self.Forget(output)
+        if self.actions.pop(action[0][0], None) != None:
+            self.changed = True
+
+def GetBuildState():
+    '''Get BuildState singleton.'''
+    global _build_state
+    if _build_state == None:
+        _build_state = BuildState(os.path.join(GetCacheDir(),
+                'native_build_state'))
+    return _build_state
+
+class Executor(object):
+    '''Runs the actions building some outputs.
+
+    At most |jobs|[pool] actions of a pool run at a time. While the load
+    average is above |max_load| or the available memory is below what a job
+    of the pool may take, no action starts until another one finishes.
+    '''
+    def __init__(self, actions, jobs, max_load, state):
+        self.actions = actions
+        self.jobs = jobs
+        self.max_load = max_load
+        self.state = state
+        # Output -> index of the action building it.
+        self.output_dict = {}
+        for i, action in enumerate(actions):
+            for output in action[0]:
+                self.output_dict[output] = i
+        # Pool -> the most actions of it running at a time.
+        self.peak_dict = dict.fromkeys(jobs, 0)
+        self.hold_num = 0
+        # Index -> estimated seconds of the action, and seconds of the
+        # estimated and the achieved paths ending with it.
+        self.estimate_dict = {}
+        self.estimated_dict = {}
+        self.achieved_dict = {}
+        self.start_time = time.time()
+
+    def GetDeps(self, action):
+        outputs, _, inputs, implicit_deps, order_only_deps, _, _ = action
+        return inputs + implicit_deps + order_only_deps
+
+    def Select(self, names):
+        '''Indexes of the actions building |names| and the actions they
+        depend on.
+        '''
+        selected = set()
+        stack = []
+        for name in names:
+            if name not in self.output_dict:
+                ErrorExit('No action builds %s.' % name)
+            stack.append(self.output_dict[name])
+        while stack:
+            i = stack.pop()
+            if i in selected:
+                continue
+            selected.add(i)
+            for path in self.GetDeps(self.actions[i]):
+                j = self.output_dict.get(path)
+                if j != None:
+                    stack.append(j)
+                elif GetStamp(path) == None:
+                    ErrorExit('%s needed by %s is missing, no action '
+                            'builds it.' % (path, self.actions[i][0][0]))
+        return sorted(selected)
+
+    def IsThrottled(self, pool):
+        if os.getloadavg()[0] > self.max_load:
+            return True
+        memory = GetAvailableMemory()
+        return memory != None and memory < GetJobMemory(pool)
+
+    def GetPriorities(self, selected, pending_dict, dependent_dict):
+        '''Index -> estimated seconds of the longest path from the action to
+        the end, through the actions using it.
+        '''
+        durations = self.state.durations
+        # Pool -> [seconds, number] of the actions which ran before.
+        total_dict = dict([(pool, [0.0, 0]) for pool in self.jobs])
+        for i in selected:
+            action = self.actions[i]
+            duration = durations.get(action[0][0])
+            if duration != None:
+                total_dict[action[6]][0] += duration
+                total_dict[action[6]][1] += 1
+        default_dict = {}
+        for pool, (seconds, number) in total_dict.items():
+            default_dict[pool] = _DEFAULT_DURATION
+            if number > 0:
+                default_dict[pool] = seconds / number
+        # Actions after the actions they depend on.
+        order = [i for i in selected if pending_dict[i] == 0]
+        pending_dict = dict(pending_dict)
+        for i in order:
+            for j in dependent_dict.get(i, []):
+                pending_dict[j] -= 1
+                if pending_dict[j] == 0:
+                    order.append(j)
+        priority_dict = {}
+        for i in reversed(order):
+            action = self.actions[i]
+            self.estimate_dict[i] = durations.get(action[0][0],
+                    default_dict[action[6]])
+            priority_dict[i] = self.estimate_dict[i] + max([0] + [
+                    priority_dict[j] for j in dependent_dict.get(i, [])])
+        return priority_dict
+
+    def Run(self, names):
+        '''Build |names|, return False if an action fails.'''
+        selected = self.Select(names)
+        # Deps of an action, the number of its deps not built yet, and the
+        # actions using an action.
+        deps_dict = {}
+        pending_dict = {}
+        dependent_dict = {}
+        for i in selected:
+            deps = set()
+            for path in self.GetDeps(self.actions[i]):
+                j = self.output_dict.get(path)
+                if j != None and j != i:
+                    deps.add(j)
+            deps_dict[i] = deps
+            pending_dict[i] = len(deps)
+            for j in deps:
+                dependent_dict.setdefault(j, []).append(i)
+        priority_dict = self.GetPriorities(selected, pending_dict,
+                dependent_dict)
+        # Pool -> heap of the actions to run, the highest priority first.
+        ready_dict = dict([(pool, []) for pool in self.jobs])
+        def Finish(i, duration):
+            '''Action |i| took |duration|, 0 if it was up to date.
+
+            The achieved path of an action is the longest chain of actions
+            run before it ends, the estimated path the same chain estimated
+            from the history.
+            '''
+            achieved = estimated = 0
+            for j in deps_dict[i]:
+                achieved = max(achieved, self.achieved_dict[j])
+                estimated = max(estimated, self.estimated_dict[j])
+            self.achieved_dict[i] = achieved + duration
+            self.estimated_dict[i] = estimated
+            if duration > 0:
+                self.estimated_dict[i] += self.estimate_dict[i]
+            ready_list = []
+            for j in dependent_dict.get(i, []):
+                pending_dict[j] -= 1
+                if pending_dict[j] == 0:
+                    ready_list.append(j)
+            return ready_list
+        def Ready(ready_list):
+            '''Actions which are up to date finish at once.'''
+            while ready_list:
+                i = ready_list.pop()
+                action = self.actions[i]
+                if self.state.IsUpToDate(action):
+                    ready_list += Finish(i, 0)
+                else:
+                    heapq.heappush(ready_dict[action[6]],
+                            (-priority_dict[i], i))
+        Ready([i for i in selected if pending_dict[i] == 0])
+        # Pid -> (action index, process, output file, start time).
+        running = {}
+        running_num_dict = dict.fromkeys(self.jobs, 0)
+        run_num = 0
+        failed = False
+        while True:
+            for pool in sorted(self.jobs):
+                ready_list = ready_dict[pool]
+                while (ready_list and not failed and
+                        running_num_dict[pool] < self.jobs[pool]):
+                    if running and self.IsThrottled(pool):
+                        self.hold_num += 1
+                        break
+                    i = heapq.heappop(ready_list)[1]
+                    process, output_file = self.Start(self.actions[i])
+                    running[process.pid] = (i, process, output_file,
+                            time.time())
+                    running_num_dict[pool] += 1
+                    self.peak_dict[pool] = max(self.peak_dict[pool],
+                            running_num_dict[pool])
+                    run_num += 1
+            if not running:
+                break
+            pid, status = os.wait()
+            if pid not in running:
+                continue
+            i, process, output_file, start_time = running.pop(pid)
+            duration = time.time() - start_time
+            if os.WIFSIGNALED(status):
+                process.returncode = -os.WTERMSIG(status)
+            else:
+                process.returncode = os.WEXITSTATUS(status)
+            output_file.seek(0)
+            sys.stdout.write(output_file.read())
+            sys.stdout.flush()
+            output_file.close()
+            action = self.actions[i]
+            running_num_dict[action[6]] -= 1
+            if process.returncode != 0:
+                Error('%s failed with exit code %d.' % (action[0][0],
+                        process.returncode))
+                self.state.Discard(action)
+                failed = True
+                continue
+            self.state.Record(action, duration)
+            Ready(Finish(i, duration))
+        Info('%d actions run, %d up to date.' % (run_num,
+                len(selected) - run_num))
+        return not failed
+
+    def Report(self):
+        Info('Peak jobs: %d of %d compiles, %d of %d links, held %d times '
+                'for the load or the memory.' % (self.peak_dict['compile'],
+                        self.jobs['compile'], self.peak_dict['link'],
+                        self.jobs['link'], self.hold_num))
+        if self.achieved_dict:
+            Info('Critical path: %.2fs estimated, %.2fs achieved, %.2fs of '
+                    'wall time.' % (max(self.estimated_dict.values()),
+                            max(self.achieved_dict.values()),
+                            time.time() - self.start_time))
+
+    def Start(self, action):
+        '''Commands are printed when they start, their output when they
+        finish, so the outputs of parallel commands are not mixed.
+        '''
+        outputs, command = action[0], action[1]
+        for output in outputs:
+            dir_name = os.path.dirname(output)
+            if dir_name:
+                MkdirIfNotExists(dir_name)
+        print command
+        sys.stdout.flush()
+        output_file = tempfile.TemporaryFile()
+        process = subprocess.Popen(command, shell=True, stdout=output_file,
+                stderr=subprocess.STDOUT)
+        return process, output_file
+
+    def Clean(self):
+        '''Remove every output and depfile of the actions.'''
+        removed_num = 0
+        for action in self.actions:
+            paths = list(action[0])
+            if action[5]:
+                paths.append(action[0][0] + '.d')
+            for path in paths:
+                if os.path.isfile(path) or os.path.islink(path):
+                    os.remove(path)
+                    removed_num += 1
+            self.state.Discard(action)
+        Info('%d files removed.' % removed_num)
+
+def RunActionGraph(cmd, jobs, max_load, need_install):
+    '''Run the action graph for |cmd| in FLAME_ROOT with the numbers of jobs
+    of the pools |jobs|, return False if an action fails.
+    '''
+    actions, defaults, installs = marshal.loads(ReadFile(GetGraphFileName()))
+    state = GetBuildState()
+    executor = Executor(actions, jobs, max_load, state)
+    try:
+        if cmd == 'clean':
+            executor.Clean()
+            return True
+        if not executor.Run(defaults):
+            return False
+        if cmd == 'install' and need_install:
+            return executor.Run(installs)
+        return True
+    finally:
+        state.Save()
+        if cmd != 'clean':
+            executor.Report()
@@ -0,0 +1,348 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Ninja backend.
+
+build.ninja is written in the build dir from the actions of the targets,
+the same actions the SConstruct loads. Commands are the commands scons runs
+with paths relative to FLAME_ROOT, so the outputs are the same. Objects also
+write depfiles, ninja tracks the headers with them instead of scanning.
+Targets with the same flags share the variables of the flags, like they
+share environments in scons.
+'''
+
+import marshal
+import os
+from compiler_cache import GetCompilePrefix
+from sconscript import GetRuleTargetTypes, GetSconscriptCache
+from util import *
+
+_NINJA_FILE_NAME = 'build.ninja'
+
+# Depths of the pools, written before each run.
+_POOL_FILE_NAME = 'pools.ninja'
+
+_CXX_SUFFIXES = ['.cc', '.cpp', '.cxx', '.c++', '.C']
+
+def GetNinjaFileName():
+    return os.path.join(GetBuildRootDir(), _NINJA_FILE_NAME)
+
+def WritePoolFile(compile_jobs, link_jobs):
+    '''Set the depths of the pools of build.ninja, build.ninja is not
+    written again when the jobs change.
+    '''
+    content = ''.join(['pool %s_pool\n  depth = %d\n\n' % (pool, jobs)
+            for pool, jobs in [('compile', compile_jobs),
+                    ('link', link_jobs)]])
+    pool_file_name = os.path.join(GetBuildRootDir(), _POOL_FILE_NAME)
+    if not os.path.isfile(pool_file_name) or (
+            ReadFile(pool_file_name) != content):
+        WriteFileAtomically(pool_file_name, content)
+
+def Escape(path):
+    '''Escape |path| in the build lines of ninja.'''
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+def QuoteArgument(argument):
+    '''Quote an argument with blanks like scons, escape it for ninja.'''
+    if ' ' in argument or '\t' in argument:
+        argument = argument.replace('\\', '\\\\')
+        for char in '"$':
+            argument = argument.replace(char, '\\' + char)
+        argument = '"%s"' % argument
+    return argument.replace('$', '$$')
+
+def JoinArguments(arguments):
+    return ' '.join([QuoteArgument(argument) for argument in arguments])
+
+def LeadingSpace(value):
+    '''Value of a variable after a space of the command unless it is empty,
+    ninja strips the spaces at the beginning of values unless escaped.
+    '''
+    if value:
+        return '$ ' + value
+    return ''
+
+def SplitExt(path):
+    '''Extension of |path| as scons sees it, it has a non-digit char.'''
+    dot = path.rfind('.')
+    if dot > path.rfind(os.sep) and path[dot:].strip('0123456789.'):
+        return path[dot:]
+    return ''
+
+def AdjustIxes(path, prefix, suffix):
+    '''Name of the file scons builds for the target |path|.'''
+    if prefix:
+        dir_name, base_name = os.path.split(os.path.normpath(path))
+        if base_name[:len(prefix)] != prefix:
+            path = os.path.join(dir_name, prefix + base_name)
+    if suffix and path[-len(suffix):] != suffix and not SplitExt(path):
+        path += suffix
+    return path
+
+class NinjaWriter(object):
+    '''Turns the actions of targets into the lines of build.ninja.'''
+    def __init__(self, cpp_flags):
+        self.root_dir = GetFlameRootDir()
+        flame_root_config = GetFlameRootConfig()
+        self.cpp_flags = cpp_flags
+        self.include_paths = [GetFlameRootDir(), GetBuildRootDir()]
+        self.lib_paths = []
+        if 'include_paths' in flame_root_config:
+            self.include_paths += VarToList(flame_root_config['include_paths'])
+        if 'lib_paths' in flame_root_config:
+            self.lib_paths += VarToList(flame_root_config['lib_paths'])
+        self.shared_library_suffix = '.so'
+        self.shared_flag = '-shared'
+        self.whole_archive = '-Wl,--whole-archive'
+        self.no_whole_archive = '-Wl,--no-whole-archive'
+        if Platform() == 'darwin':
+            self.shared_library_suffix = '.dylib'
+            self.shared_flag = '-dynamiclib'
+            self.whole_archive = '-Wl,-all_load'
+            self.no_whole_archive = '-Wl,-noall_load'
+        # Appends of an environment -> its number.
+        self.env_dict = {}
+        # Node name -> path, and the objects of c++ sources.
+        self.paths = {}
+        self.cxx_objects = set()
+        # Target key -> headers generated by the target.
+        self.generated_headers = {}
+        self.defaults = []
+        self.installs = []
+        self.lines = []
+
+    def RelativePath(self, path):
+        '''Path as scons prints it, relative to FLAME_ROOT if it is inside.'''
+        path = os.path.normpath(os.path.join(self.root_dir, path))
+        if path == self.root_dir:
+            return '.'
+        if path.startswith(self.root_dir + os.sep):
+            return path[len(self.root_dir) + 1:]
+        return path
+
+    def Paths(self, names):
+        return [self.paths[name] for name in names]
+
+    def AddRules(self):
+        '''Links run in the link pool, the other commands in the compile
+        pool.
+        '''
+        compile_prefix = GetCompilePrefix('$out')
+        rule_list = [
+                ('cc', compile_prefix + 'gcc -o $out -c -fPIC $cppflags '
+                        '$includes $in -MMD -MF $out.d', True, 'compile'),
+                ('cxx', compile_prefix + 'g++ -o $out -c -fPIC $cppflags '
+                        '$includes $in -MMD -MF $out.d', True, 'compile'),
+                # Scons removes an archive before it is built again.
+                ('ar', 'rm -f $out && ar rc $out $in && ranlib $out', False,
+                        'compile'),
+                ('link', '$ld -o $out$linkflags $in$libdirs$libs', False,
+                        'link'),
+                ('shared_link', '$ld -o $out$linkflags %s $in$libdirs$libs'
+                        % self.shared_flag, False, 'link'),
+                ('protoc', GetProtocCommand('$in'), False, 'compile'),
+                ('copy', 'cp -f $in $out', False, 'compile')]
+        self.AddVariable('builddir', GetBuildDirName())
+        self.AddVariable('ld', 'g++')
+        self.lines.append('include %s\n\n' % Escape(os.path.join(
+                GetBuildDirName(), _POOL_FILE_NAME)))
+        for name, command, has_depfile, pool in rule_list:
+            self.AddRule(name, command, has_depfile, pool)
+
+    def AddVariable(self, name, value):
+        self.lines.append('%s = %s\n\n' % (name, value))
+
+    def AddRule(self, name, command, has_depfile, pool):
+        self.lines.append('rule %s\n  command = %s\n  pool = %s_pool\n' % (
+                name, command, pool))
+        if has_depfile:
+            self.lines.append('  depfile = $out.d\n  deps = gcc\n')
+        self.lines.append('\n')
+
+    def AddBuild(self, outputs, rule, inputs, implicit_deps=[],
+            order_only_deps=[], variables=[]):
+        line = 'build %s: %s %s' % (' '.join(map(Escape, outputs)), rule,
+                ' '.join(map(Escape, inputs)))
+        if implicit_deps:
+            line += ' | ' + ' '.join(map(Escape, implicit_deps))
+        if order_only_deps:
+            line += ' || ' + ' '.join(map(Escape, order_only_deps))
+        self.lines.append(line + '\n')
+        for name, value in variables:
+            self.lines.append('  %s = %s\n' % (name, value))
+
+    def GetEnv(self, appends):
+        '''Number of the environment with |appends|, its variables are added
+        the first time.
+        '''
+        key = repr(sorted(appends.items()))
+        env = self.env_dict.get(key)
+        if env != None:
+            return env
+        env = len(self.env_dict)
+        self.env_dict[key] = env
+        cpp_flags = self.cpp_flags + appends.get('CPPFLAGS', [])
+        include_paths = self.include_paths + appends.get('CPPPATH', [])
+        lib_paths = self.lib_paths + appends.get('LIBPATH', [])
+        self.AddVariable('cppflags_%d' % env, JoinArguments(cpp_flags))
+        self.AddVariable('includes_%d' % env, self.FormatPaths('-I',
+                include_paths))
+        self.AddVariable('libdirs_%d' % env, LeadingSpace(
+                self.FormatPaths('-L', lib_paths)))
+        return env
+
+    def FormatPaths(self, prefix, paths):
+        return JoinArguments([prefix + self.RelativePath(path)
+                for path in paths])
+
+    def FormatLibraries(self, library_nodes, libraries):
+        '''Libraries as scons passes them, names are stripped like libfoo.a.'''
+        arguments = self.Paths(library_nodes)
+        for library in libraries:
+            if library[:3] == 'lib':
+                library = library[3:]
+            for suffix in ['.a', self.shared_library_suffix]:
+                if library[-len(suffix):] == suffix:
+                    library = library[:-len(suffix)]
+                    break
+            arguments.append('-l' + library)
+        return JoinArguments(arguments)
+
+    def AddTarget(self, target, generated_headers):
+        '''Add the build lines of the actions of |target|.
+
+        Objects are built after the headers generated by the deps of the
+        target, the depfiles are not written before they are compiled.
+        '''
+        env = 0
+        link = None
+        implicit_deps = []
+        for action in target.scons_actions:
+            action = marshal.loads(action)
+            kind = action[0]
+            if kind == 'env':
+                env = self.GetEnv(action[1])
+            elif kind == 'object':
+                _, name, obj, source = action
+                obj = self.RelativePath(obj)
+                source = self.RelativePath(source)
+                self.paths[name] = obj
+                rule = 'cc'
+                if os.path.splitext(source)[1] in _CXX_SUFFIXES:
+                    rule = 'cxx'
+                    self.cxx_objects.add(name)
+                self.AddBuild([obj], rule, [source],
+                        order_only_deps=generated_headers,
+                        variables=[('cppflags', '$cppflags_%d' % env),
+                                ('includes', '$includes_%d' % env)])
+            elif kind == 'link':
+                link = action
+            elif kind == 'depends':
+                implicit_deps += self.Paths(action[2])
+            elif kind == 'proto':
+                _, outputs, proto = action
+                outputs = [self.RelativePath(output) for output in outputs]
+                self.generated_headers.setdefault(target.key, []).append(
+                        outputs[0])
+                self.AddBuild(outputs, 'protoc', [self.RelativePath(proto)])
+            elif kind == 'prebuilt':
+                _, name, prebuilt_target, prebuilt_source = action
+                self.paths[name] = self.RelativePath(prebuilt_target)
+                self.AddBuild([self.paths[name]], 'copy',
+                        [self.RelativePath(prebuilt_source)])
+                self.defaults.append(self.paths[name])
+        if link != None:
+            self.AddLink(env, link, implicit_deps)
+
+    def AddLink(self, env, link, implicit_deps):
+        (_, builder, name, full_name, objs, library_nodes, libraries,
+                lib_paths, link_all_symbols_list) = link
+        full_name = self.RelativePath(full_name)
+        obj_paths = self.Paths(objs)
+        library_paths = self.Paths(library_nodes)
+        link_all_symbols_paths = self.Paths(link_all_symbols_list)
+        implicit_deps = MergeUnique([library_paths, link_all_symbols_paths,
+                implicit_deps])
+        if builder == 'Library':
+            self.paths[name] = AdjustIxes(full_name, 'lib', '.a')
+            self.AddBuild([self.paths[name]], 'ar', obj_paths, implicit_deps)
+            self.defaults.append(self.paths[name])
+            return
+        if builder == 'SharedLibrary':
+            self.paths[name] = AdjustIxes(full_name, 'lib',
+                    self.shared_library_suffix)
+            rule = 'shared_link'
+        else:
+            self.paths[name] = full_name
+            rule = 'link'
+        link_flags = ''
+        if link_all_symbols_paths:
+            link_flags = JoinArguments([self.whole_archive] +
+                    link_all_symbols_paths + [self.no_whole_archive])
+        lib_dirs = '$libdirs_%d' % env
+        if lib_paths != None:
+            lib_dirs = LeadingSpace(self.FormatPaths('-L', lib_paths))
+        variables = [('linkflags', LeadingSpace(link_flags)),
+                ('libdirs', lib_dirs), ('libs', LeadingSpace(
+                        self.FormatLibraries(library_nodes, libraries)))]
+        # Scons links with the c compiler if there are no c++ objects.
+        if not [obj for obj in objs if obj in self.cxx_objects]:
+            variables.append(('ld', 'gcc'))
+        self.AddBuild([self.paths[name]], rule, obj_paths, implicit_deps,
+                variables=variables)
+        self.defaults.append(self.paths[name])
+
+    def AddInstalls(self, target):
+        for action in target.scons_actions_for_install:
+            action = marshal.loads(action)
+            if action[0] == 'install':
+                source = self.paths[action[2]]
+                install_name = os.path.join(self.RelativePath(action[1]),
+                        os.path.basename(source))
+            else:
+                install_name = self.RelativePath(action[1])
+                source = self.RelativePath(action[2])
+            self.AddBuild([install_name], 'copy', [source])
+            self.installs.append(install_name)
+
+    def Finish(self):
+        self.lines.append('\nbuild install: phony %s\n' % ' '.join(
+                map(Escape, self.installs)))
+        if self.defaults:
+            self.lines.append('\ndefault %s\n' % ' '.join(
+                    map(Escape, self.defaults)))
+
+def AddTargets(writer, cmd, targets):
+    '''Add the rules and the actions of |targets| sorted after their deps to
+    |writer|.
+    '''
+    workspace = GetWorkspace()
+    target_types = GetRuleTargetTypes(cmd)
+    writer.AddRules()
+    for target in targets:
+        if target.type not in target_types:
+            continue
+        generated_headers = []
+        for key in workspace.GetSymbols(
+                target.recursive_library_list_with_sub):
+            generated_headers += writer.generated_headers.get(key, [])
+        writer.AddTarget(target, generated_headers)
+    if cmd in ['install', 'clean']:
+        for target in targets:
+            writer.AddInstalls(target)
+    writer.Finish()
+
+def WriteNinjaFile(cmd, targets, cpp_flags):
+    '''Write build.ninja for |targets| sorted after their deps, return its
+    name.
+    '''
+    writer = NinjaWriter(cpp_flags)
+    AddTargets(writer, cmd, targets)
+    ninja_file_name = GetNinjaFileName()
+    if GetSconscriptCache().Write(ninja_file_name, writer.lines):
+        GetSconscriptCache().Save()
+        Info('%s written.' % _NINJA_FILE_NAME)
+    return ninja_file_name
@@ -0,0 +1,381 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Flame query.
+
+deps, somepath and allpaths load the closure of the first target like a
+build does, without writing the SConstruct. rdeps searches the whole
+workspace in a dependency index saved in the cache dir, only the BUILD
+files whose stamps changed are read again. The index also maps source files
+to the targets declaring them, to find the targets affected by changes.
+'''
+
+import collections
+import cPickle
+import fnmatch
+import os
+import subprocess
+import sys
+import build_cache
+import build_index
+import build_loader
+import target
+import target_pool
+from analysis_cache import GetStamp
+from cmd_parser import GetCmdParser, SelectLoadingJobs
+from dependence_analyser import GetTargetLabel
+from util import *
+
+_INDEX_VERSION = 3
+
+_dependency_index = None
+
+def GetTargetKey(new_target):
+    '''Key of a label, the same for its shared and static targets.'''
+    return os.path.join(new_target.current_dir, new_target.name)
+
+def GetFileName(package_dir, file_name):
+    '''Path of a file in srcs, testdata or extra_export.'''
+    file_name = VarToList(file_name)[0]
+    if file_name.startswith('//'):
+        return os.path.join(GetFlameRootDir(), file_name[2:])
+    return os.path.normpath(os.path.join(package_dir, file_name))
+
+def GetTargetFiles(new_target):
+    '''Files declared by a target.'''
+    file_names = list(new_target.srcs)
+    if new_target.type == 'cc_test':
+        file_names += new_target.testdata
+    elif new_target.type == 'extra_export':
+        file_names += (new_target.export_headers + new_target.export_confs +
+                new_target.export_files)
+    return [GetFileName(new_target.current_dir, file_name)
+            for file_name in file_names]
+
+def GetPackageDependencies(package_dir, declarations):
+    '''(key, kind, dep keys, files) of the targets declared in a package.'''
+    context = target.BuildContext(package_dir, '')
+    for rule_name, args, kwargs in declarations:
+        context.Declare(rule_name, args, kwargs)
+    dependencies = collections.OrderedDict()
+    for new_target in context.targets:
+        if isinstance(new_target, target.CcTarget):
+            new_target.ParseDeps()
+        key = GetTargetKey(new_target)
+        if key not in dependencies:
+            dependencies[key] = (new_target.type, [], [])
+        _, deps, file_names = dependencies[key]
+        for dep in new_target.recursive_library_list:
+            if dep not in deps:
+                deps.append(dep)
+        for file_name in GetTargetFiles(new_target):
+            if file_name not in file_names:
+                file_names.append(file_name)
+    return [(key, kind, deps, file_names)
+            for key, (kind, deps, file_names) in dependencies.items()]
+
+class DependencyIndex(object):
+    '''Dependencies of every BUILD file in the workspace, and the reverse
+    dependencies, saved in |index_file|.
+    '''
+    def __init__(self, index_file, config_digest):
+        self.index_file = index_file
+        self.config_digest = config_digest
+        # BUILD file name -> (stamp, [(key, kind, dep keys, files)], inputs).
+        self.entries = {}
+        self.kinds = {}
+        self.rdeps = {}
+        # File name -> keys of the targets declaring it.
+        self.owners = {}
+        self.dirty = False
+        self.Load()
+
+    def Load(self):
+        if not os.path.isfile(self.index_file):
+            return
+        try:
+            content = cPickle.loads(ReadFile(self.index_file))
+        except Exception:
+            Warning('Dependency index %s is broken, ignore it.' %
+                    self.index_file)
+            return
+        if content[0] != _INDEX_VERSION:
+            return
+        _, config_digest, entries, kinds, rdeps, owners = content
+        if config_digest == self.config_digest:
+            self.entries = entries
+            self.kinds = kinds
+            self.rdeps = rdeps
+            self.owners = owners
+
+    def Save(self):
+        if not self.dirty:
+            return
+        content = cPickle.dumps((_INDEX_VERSION, self.config_digest,
+                self.entries, self.kinds, self.rdeps, self.owners),
+                cPickle.HIGHEST_PROTOCOL)
+        WriteFileAtomically(self.index_file, content)
+        self.dirty = False
+
+    def Remove(self, build_name):
+        for key, _, deps, file_names in self.entries.pop(build_name)[1]:
+            del self.kinds[key]
+            RemoveFromSets(self.rdeps, deps, key)
+            RemoveFromSets(self.owners, file_names, key)
+        self.dirty = True
+
+    def Add(self, build_name, stamp, dependencies, inputs):
+        self.entries[build_name] = (stamp, dependencies, inputs)
+        for key, kind, deps, file_names in dependencies:
+            self.kinds[key] = kind
+            for dep in deps:
+                self.rdeps.setdefault(dep, set()).add(key)
+            for file_name in file_names:
+                self.owners.setdefault(file_name, set()).add(key)
+        self.dirty = True
+
+    def Update(self, build_names, jobs):
+        '''Index the changed ones of |build_names|, forget removed ones.'''
+        stamps = {}
+        for build_name in build_names:
+            stamp = GetStamp(build_name)
+            entry = self.entries.get(build_name)
+            if entry == None or entry[0] != stamp or \
+                    not build_cache.CheckInputs(entry[2]):
+                stamps[build_name] = stamp
+        for build_name in set(self.entries.keys()) - set(build_names):
+            self.Remove(build_name)
+        if stamps:
+            cache = build_cache.GetBuildCache()
+            cache.Prefetch(stamps.keys(), jobs)
+            for build_name in sorted(stamps.keys()):
+                dependencies = GetPackageDependencies(
+                        os.path.dirname(build_name),
+                        cache.GetDeclarations(build_name))
+                if build_name in self.entries:
+                    self.Remove(build_name)
+                self.Add(build_name, stamps[build_name], dependencies,
+                        cache.GetInputs(build_name))
+            cache.Save()
+        self.Save()
+
+    def GetOwners(self, file_name):
+        '''Keys of the targets a changed file belongs to.
+
+        A BUILD file belongs to all targets of its package. Files not declared
+        by any target, like headers, belong to all targets of the package
+        they are in.
+        '''
+        if os.path.basename(file_name) != 'BUILD':
+            owners = self.owners.get(file_name)
+            if owners:
+                return owners
+        dir_name = os.path.dirname(file_name)
+        root_dir = GetFlameRootDir()
+        while dir_name.startswith(root_dir):
+            entry = self.entries.get(os.path.join(dir_name, 'BUILD'))
+            if entry != None:
+                return set([dependency[0] for dependency in entry[1]])
+            parent_dir = os.path.dirname(dir_name)
+            if parent_dir == dir_name:
+                break
+            dir_name = parent_dir
+        return set()
+
+    def GetAffectedKeys(self, file_names):
+        '''Keys of the targets depending on |file_names|.'''
+        owners = set()
+        for file_name in file_names:
+            owners |= self.GetOwners(file_name)
+        return Reach(self.rdeps, list(owners))
+
+def RemoveFromSets(set_dict, names, key):
+    for name in names:
+        key_set = set_dict[name]
+        key_set.discard(key)
+        if not key_set:
+            del set_dict[name]
+
+def GetDependencyIndex():
+    '''Get DependencyIndex singleton, up to date with the workspace.'''
+    global _dependency_index
+    if _dependency_index == None:
+        index_file = os.path.join(GetCacheDir(), 'dependency_index')
+        config_digest = Digest(ReadFile(GetFlameRootFileName()))
+        _dependency_index = DependencyIndex(index_file, config_digest)
+        build_names = build_index.GetBuildIndex().FindBuildFiles(
+                GetFlameRootDir())
+        _dependency_index.Update(build_names, SelectLoadingJobs())
+    return _dependency_index
+
+def ParseLabel(label):
+    '''Key of a //dir:name, dir:name or :name label.'''
+    fields = label.split(':')
+    if len(fields) != 2 or not fields[1]:
+        ErrorExit('Target format is invalid: %s' % label)
+    if fields[0].startswith('//'):
+        package_dir = os.path.join(GetFlameRootDir(), fields[0][2:])
+    else:
+        package_dir = os.path.join(GetCurrentDir(), fields[0])
+    package_dir = os.path.normpath(package_dir)
+    if not os.path.isfile(os.path.join(package_dir, 'BUILD')):
+        ErrorExit('//%s/BUILD not find.' %
+                GetWorkspace().GetRelativeDir(package_dir))
+    return os.path.join(package_dir, fields[1])
+
+def LoadDependencies(key):
+    '''Forward dependencies of the closure of |key|: key -> dep keys.'''
+    loader = build_loader.BuildLoader('')
+    loader.AddTarget(os.path.dirname(key), os.path.basename(key))
+    loader.Load()
+    cache = build_cache.GetBuildCache()
+    cache.Save()
+    loader.Report()
+    graph = {}
+    kinds = {}
+    for new_target in target_pool.GetTargetPool().values():
+        target_key = GetTargetKey(new_target)
+        deps = graph.setdefault(target_key, [])
+        for dep in new_target.recursive_library_list:
+            if dep not in deps:
+                deps.append(dep)
+        kinds[target_key] = new_target.type
+    if key not in graph:
+        ErrorExit('%s not find.' % GetTargetLabel(key))
+    return graph, kinds
+
+def Reach(graph, keys):
+    '''Keys reachable from |keys| in |graph|, |keys| included.'''
+    reached = set(keys)
+    queue = collections.deque(keys)
+    while queue:
+        key = queue.popleft()
+        for next_key in graph.get(key, []):
+            if next_key not in reached:
+                reached.add(next_key)
+                queue.append(next_key)
+    return reached
+
+def FindPath(graph, start, end):
+    '''A shortest path from |start| to |end|, None if there is none.'''
+    parents = {start: None}
+    queue = collections.deque([start])
+    while queue:
+        key = queue.popleft()
+        if key == end:
+            path = []
+            while key != None:
+                path.append(key)
+                key = parents[key]
+            path.reverse()
+            return path
+        for next_key in graph.get(key, []):
+            if next_key not in parents:
+                parents[next_key] = key
+                queue.append(next_key)
+    return None
+
+def FilterKind(keys, kinds):
+    kind = GetCmdParser().options.kind
+    if not kind:
+        return keys
+    return [key for key in keys if fnmatch.fnmatch(kinds.get(key, ''), kind)]
+
+def OutputLabels(keys):
+    for key in keys:
+        print GetTargetLabel(key)
+
+def QueryDeps(keys):
+    graph, kinds = LoadDependencies(keys[0])
+    OutputLabels(FilterKind(sorted(Reach(graph, keys[:1])), kinds))
+
+def QueryRdeps(keys):
+    index = GetDependencyIndex()
+    if keys[0] not in index.kinds:
+        ErrorExit('%s not find.' % GetTargetLabel(keys[0]))
+    OutputLabels(FilterKind(sorted(Reach(index.rdeps, keys[:1])),
+            index.kinds))
+
+def QuerySomePath(keys):
+    graph, kinds = LoadDependencies(keys[0])
+    path = FindPath(graph, keys[0], keys[1])
+    if path == None:
+        ErrorExit('%s does not depend on %s.' % (GetTargetLabel(keys[0]),
+                GetTargetLabel(keys[1])))
+    OutputLabels(path)
+
+def QueryAllPaths(keys):
+    graph, kinds = LoadDependencies(keys[0])
+    reverse_graph = {}
+    for key, deps in graph.items():
+        for dep in deps:
+            reverse_graph.setdefault(dep, []).append(key)
+    on_paths = Reach(graph, keys[:1]) & Reach(reverse_graph, keys[1:2])
+    if not on_paths:
+        ErrorExit('%s does not depend on %s.' % (GetTargetLabel(keys[0]),
+                GetTargetLabel(keys[1])))
+    OutputLabels(FilterKind(sorted(on_paths), kinds))
+
+def RunGit(args):
+    '''Output lines of a git command run in the flame root dir.'''
+    try:
+        process = subprocess.Popen(['git'] + args, cwd=GetFlameRootDir(),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        ErrorExit('git is not found.')
+    output, error = process.communicate()
+    if process.returncode != 0:
+        ErrorExit('git %s failed: %s' % (' '.join(args), error.strip()))
+    return [line for line in output.splitlines() if line]
+
+def GetChangedFiles():
+    '''Files of --affected-by, and files changed since --since.'''
+    options = GetCmdParser().options
+    file_names = set()
+    for names in options.affected_by:
+        for name in names.split(','):
+            if name:
+                file_names.add(os.path.abspath(name))
+    if options.since:
+        top_dir = RunGit(['rev-parse', '--show-toplevel'])[0]
+        names = RunGit(['diff', '--name-only', options.since, '--'])
+        names += RunGit(['ls-files', '--others', '--exclude-standard',
+                '--full-name'])
+        for name in names:
+            file_names.add(os.path.join(top_dir, name))
+    return sorted(file_names)
+
+def SelectAffectedTargets(loader):
+    '''Keep only the queued targets affected by the changed files.'''
+    file_names = GetChangedFiles()
+    affected_keys = GetDependencyIndex().GetAffectedKeys(file_names)
+    all_keys = MergeUnique([[os.path.join(package_dir, name)
+            for package_dir, name in loader.queue]])
+    keys = [key for key in all_keys if key in affected_keys]
+    Info('%d of %d targets are affected by %d changed files.' % (len(keys),
+            len(all_keys), len(file_names)))
+    for key in keys:
+        Info('    %s' % GetTargetLabel(key), prefix=False)
+    loader.queue.clear()
+    for key in keys:
+        loader.AddTarget(os.path.dirname(key), os.path.basename(key))
+    return len(keys)
+
+_query_functions = {
+    'deps': (QueryDeps, 1),
+    'rdeps': (QueryRdeps, 1),
+    'somepath': (QuerySomePath, 2),
+    'allpaths': (QueryAllPaths, 2),
+}
+
+def Query():
+    cmd_parser = GetCmdParser()
+    query_function, label_num = _query_functions[
+            cmd_parser.options.query_function]
+    if len(cmd_parser.targets) != label_num:
+        ErrorExit('%s needs %d targets.' % (cmd_parser.options.query_function,
+                label_num))
+    query_function([ParseLabel(label) for label in cmd_parser.targets])
+    return 0
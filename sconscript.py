@@ -0,0 +1,168 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Action files of packages.
+
+The marshaled actions of the targets of a package are written one after
+another to the action file in the build dir of the package, and its install
+actions to the install action file. The loader in the SConstruct loads them after the files of the packages
+they depend on, actions refer to the nodes of other packages by name.
+Packages depending on each other share the file of the first one of them.
+
+SCons reads the small fixed loader and the data instead of executing the
+rules of every target as python code, which is much faster on large graphs.
+
+The files are kept between runs. The digests and stamps of the written files
+are saved in the cache dir, a file is only written again when its content
+changes, so unchanged packages keep their files and stamps. Actions are
+written from the targets, the content of a file is never joined in memory.
+'''
+
+import cPickle
+import hashlib
+import os
+from analysis_cache import GetStamp
+from dependence_analyser import FindStronglyConnectedComponents, TargetNode
+from target_pool import GetTargetPool
+from util import *
+
+_CACHE_VERSION = 1
+
+_SCONSCRIPT_NAME = 'flame.actions'
+
+_SCONSCRIPT_INSTALL_NAME = 'flame.install_actions'
+
+_sconscript_cache = None
+
+class SconscriptCache(object):
+    '''Action file name -> (digest, stamp), saved in |cache_file|.'''
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.changed = False
+        self.Load()
+
+    def Load(self):
+        if not os.path.isfile(self.cache_file):
+            return
+        try:
+            content = cPickle.loads(ReadFile(self.cache_file))
+        except Exception:
+            Warning('Action file cache %s is broken, ignore it.' %
+                    self.cache_file)
+            return
+        if content[0] != _CACHE_VERSION:
+            return
+        self.entries = content[1]
+
+    def Save(self):
+        if not self.changed:
+            return
+        content = cPickle.dumps((_CACHE_VERSION, self.entries),
+                cPickle.HIGHEST_PROTOCOL)
+        WriteFileAtomically(self.cache_file, content)
+        self.changed = False
+
+    def Write(self, file_name, actions):
+        '''Write the list of marshaled |actions| unless the file has them,
+        return True if written.
+        '''
+        sha1 = hashlib.sha1()
+        for action in actions:
+            sha1.update(action)
+        digest = sha1.hexdigest()
+        entry = self.entries.get(file_name)
+        if entry != None and entry == (digest, GetStamp(file_name)):
+            return False
+        WriteFileAtomically(file_name, actions)
+        self.entries[file_name] = (digest, GetStamp(file_name))
+        self.changed = True
+        return True
+
+def GetSconscriptCache():
+    '''Get SconscriptCache singleton.'''
+    global _sconscript_cache
+    if _sconscript_cache == None:
+        _sconscript_cache = SconscriptCache(
+                os.path.join(GetCacheDir(), 'sconscript_cache'))
+    return _sconscript_cache
+
+def WriteSconstruct(scons_rules):
+    '''Write the SConstruct in FLAME_ROOT unless it has |scons_rules|.'''
+    sconscript_cache = GetSconscriptCache()
+    sconscript_cache.Write(GetSconsFileName(GetFlameRootDir()), scons_rules)
+    sconscript_cache.Save()
+
+def GetPackageGroups(targets):
+    '''Lists of |targets| of packages, after the lists they depend on.
+
+    |targets| are sorted after their deps. Packages depending on each other
+    are in one list, in the order of |targets|.
+    '''
+    target_pool = GetTargetPool()
+    package_targets = {}
+    position_dict = {}
+    for i, target in enumerate(targets):
+        package_targets.setdefault(target.current_dir, []).append(target)
+        position_dict[target.key] = i
+    node_list = []
+    for package_dir in sorted(package_targets.keys()):
+        dep_dirs = set()
+        for target in package_targets[package_dir]:
+            for key in target.recursive_library_list:
+                dep_dirs.add(target_pool[key].current_dir)
+        dep_dirs.discard(package_dir)
+        node_list.append(TargetNode(package_dir, sorted(dep_dirs)))
+    # Components are found after the components they reach.
+    component_list, _ = FindStronglyConnectedComponents(node_list)
+    group_list = []
+    for component in component_list:
+        group = []
+        for i in sorted(component):
+            group += package_targets[node_list[i].key]
+        if len(component) > 1:
+            group.sort(key=lambda target: position_dict[target.key])
+        group_list.append(group)
+    return group_list
+
+def GetSconscriptName(target, file_name):
+    workspace = GetWorkspace()
+    return os.path.normpath(os.path.join(workspace.build_root_dir,
+            target.relative_dir, file_name))
+
+def GetRuleTargetTypes(cmd):
+    '''Types of the targets whose actions are built for |cmd|.'''
+    target_types = ['cc_library', 'cc_binary', 'proto_library', 'cc_test']
+    if cmd == 'install':
+        target_types += ['extra_export']
+    return target_types
+
+def WriteSconscripts(cmd, targets):
+    '''Write the action files of |targets| for |cmd|, return their names in
+    the order to load them.
+    '''
+    target_types = GetRuleTargetTypes(cmd)
+    sconscript_cache = GetSconscriptCache()
+    sconscript_names = []
+    written_num = 0
+    for group in GetPackageGroups(targets):
+        actions = []
+        install_actions = []
+        for target in group:
+            if target.type in target_types:
+                actions += target.scons_actions
+            install_actions += target.scons_actions_for_install
+        sconscript_list = [(_SCONSCRIPT_NAME, actions)]
+        if cmd in ['install', 'clean']:
+            sconscript_list.append((_SCONSCRIPT_INSTALL_NAME, install_actions))
+        for file_name, file_actions in sconscript_list:
+            sconscript_name = GetSconscriptName(group[0], file_name)
+            if sconscript_cache.Write(sconscript_name, file_actions):
+                written_num += 1
+            sconscript_names.append(sconscript_name)
+    sconscript_cache.Save()
+    Info('Action files: %d written, %d unchanged.' % (written_num,
+            len(sconscript_names) - written_num))
+    return sconscript_names
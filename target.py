@@ -2,20 +2,73 @@
 # All rights reserved.
 # Author: Chao Xiong <fancysimon@gmail.com>
 
+import array
+import marshal
 import os
-import copy
 from util import *
 import glob
 import string
 import target_pool
 
+# BuildContext of the declaration being evaluated.
+_build_context = None
+
+class BuildContext(object):
+    '''Package dir and options which the targets of a package are declared
+    with, the targets declared and the files the wildcards in their srcs
+    matched.
+    '''
+    def __init__(self, current_dir, release_prefix):
+        self.current_dir = current_dir
+        self.release_prefix = release_prefix
+        self.targets = []
+        # Pattern with path -> sorted files matched.
+        self.globs = {}
+
+    def Declare(self, rule_name, args, kwargs):
+        global _build_context
+        _build_context = self
+        target_num = len(self.targets)
+        try:
+            _build_rules[rule_name](*args, **kwargs)
+        finally:
+            _build_context = None
+        # The analysis of a target is reused while its declaration, with the
+        # files matched by srcs, is unchanged.
+        for target in self.targets[target_num:]:
+            target.input_digest = Digest(repr((rule_name, args,
+                    sorted(kwargs.items()), target.key, target.srcs,
+                    self.release_prefix)))
+
 class Target(object):
     '''Base class of Target.
+
+    Dependency lists hold the numbers of their strings in the symbol table of
+    the workspace, the strings are got back when the rules are written.
+
+    Rules are actions, tuples of an action name and its arguments, which the
+    loader in the SConstruct turns into scons nodes. Nodes are named by the
+    variables of the objects and targets. Actions are kept marshaled, they
+    are written to the action files as they are.
     '''
+    __slots__ = ('name', 'type', 'current_dir', 'incs', 'srcs', 'deps', 'defs',
+            'scons_target_type', 'build_root_dir', 'relative_dir',
+            'relative_build_dir', 'flame_root_dir', 'key', 'relative_name',
+            'target_name', 'full_name', 'dl_suffix', 'system_library_list',
+            'prebuilt_library_list', 'prebuilt_static_library_list',
+            'dep_library_list', 'link_all_symbols_lib_list', 'dep_paths',
+            'dep_header_list', 'recursive_library_list',
+            'recursive_library_list_for_sort', 'recursive_library_list_with_sub',
+            'scons_actions', 'scons_actions_for_install', 'objs', 'sub_objs',
+            'data', 'extra_include_paths', 'extra_lib_paths', 'release_prefix',
+            'input_digest', 'analysis_digest')
+
     def __init__(self, name, target_type, srcs, deps, scons_target_type,
             incs, defs, extra_include_paths, extra_lib_paths):
         self.name = name
         self.type = target_type
+        self.current_dir = _build_context.current_dir
+        workspace = GetWorkspace()
         self.incs = VarToList(incs)
         self.srcs = VarToList(srcs)
         self.SrcReplaceRegex()
@@ -23,11 +76,11 @@ class Target(object):
         self.defs = VarToList(defs)
         self.scons_target_type = scons_target_type
 
-        self.current_dir = GetCurrentDir()
-        self.build_root_dir = GetBuildRootDir()
-        self.relative_dir = GetRelativeDir(self.current_dir, GetFlameRootDir())
-        self.relative_build_dir = os.path.join(GetBuildDirName(), self.relative_dir)
-        self.flame_root_dir = GetFlameRootDir()
+        self.build_root_dir = workspace.build_root_dir
+        self.relative_dir = workspace.GetRelativeDir(self.current_dir)
+        self.relative_build_dir = os.path.join(workspace.build_dir_name,
+                self.relative_dir)
+        self.flame_root_dir = workspace.root_dir
 
         self.key = os.path.join(self.current_dir, self.name)
         self.relative_name = os.path.join(self.relative_dir, self.name)
@@ -37,33 +90,34 @@ class Target(object):
             self.relative_dir, self.name)
         self.dl_suffix = ''
 
-        self.system_library_list = []
-        self.prebuilt_library_list = []
-        self.prebuilt_static_library_list = []
-        self.dep_library_list = []
-        self.link_all_symbols_lib_list = []
-        self.dep_paths = []
-        self.dep_header_list = []
+        self.system_library_list = array.array('i')
+        self.prebuilt_library_list = array.array('i')
+        self.prebuilt_static_library_list = array.array('i')
+        self.dep_library_list = array.array('i')
+        self.link_all_symbols_lib_list = array.array('i')
+        self.dep_paths = array.array('i')
+        self.dep_header_list = array.array('i')
         self.recursive_library_list = []  # Save dep library's target keys.
-        self.recursive_library_list_sort = []
+        self.recursive_library_list_for_sort = []
         # Save dep library's target keys and dep sub target keys.
-        self.recursive_library_list_with_sub = []
-        self.scons_rules = []
-        self.scons_rules_for_install = []
+        self.recursive_library_list_with_sub = array.array('i')
+        self.scons_actions = []
+        self.scons_actions_for_install = []
         self.objs = []
-        self.sub_objs = []
+        self.sub_objs = array.array('i')
         self.data = {}
 
         self.extra_include_paths = VarToList(extra_include_paths)
         self.extra_lib_paths = VarToList(extra_lib_paths)
 
-        self.release_prefix = ParseReleasePrefix(sys.argv)
+        self.release_prefix = _build_context.release_prefix
 
     def WriteRule(self):
-        self.env = self.relative_name + self.dl_suffix + '_env'
-        self.env = RemoveSpecialChar(self.env)
-        rule = '%s = env.Clone()' % (self.env)
-        self.AddRule(rule)
+        # Targets with the same flags share an environment, cloning one for
+        # every target is slow in scons. Actions of the target after it use
+        # the environment.
+        workspace = GetWorkspace()
+        appends = {}
         macros = []
         # Warning.
         if self.data.get('warning') == 'no':
@@ -72,56 +126,37 @@ class Target(object):
         if self.defs:
             macros += [('-D' + macro) for macro in self.defs]
         if macros:
-            rule = '%s.Append(CPPFLAGS=%s)' % (self.env, macros)
-            self.AddRule(rule)
-        # Include path.
-        if self.dep_header_list:
-            rule = '%s.Append(CPPPATH=%s)' % (self.env, self.dep_header_list)
-            self.AddRule(rule)
-        # Extra include path.
-        if self.extra_include_paths:
-            rule = '%s.Append(CPPPATH=%s)' % (self.env, self.extra_include_paths)
-            self.AddRule(rule)
-
+            appends['CPPFLAGS'] = macros
+        # Include path and extra include path.
+        include_paths = workspace.GetSymbols(self.dep_header_list)
+        include_paths += self.extra_include_paths
+        if include_paths:
+            appends['CPPPATH'] = include_paths
         # Extra lib path.
         if self.extra_lib_paths:
-            rule = '%s.Append(LIBPATH=%s)' % (self.env, self.extra_lib_paths)
-            self.AddRule(rule)
-
-        # Link all symbols.
-        if self.link_all_symbols_lib_list:
-            link_all_symbols_str = ','.join(self.link_all_symbols_lib_list)
-            whole_archive = "-Wl,--whole-archive"
-            no_whole_archive = "-Wl,--no-whole-archive"
-            if Platform() == "darwin":
-                whole_archive = "-Wl,-all_load"
-                no_whole_archive = "-Wl,-noall_load"
-            rule = '%s.Append(LINKFLAGS=["%s", %s , "%s"])' % (
-                    self.env, whole_archive, link_all_symbols_str, no_whole_archive)
-            self.AddRule(rule)
+            appends['LIBPATH'] = list(self.extra_lib_paths)
+        self.AddAction('env', appends)
 
     def FormatDepLibrary(self):
-        res = '['
+        '''Nodes and names of the libraries to link.'''
+        workspace = GetWorkspace()
+        library_nodes = []
+        libraries = []
         if self.data.get('export_dynamic') == 1:
-            for library in self.prebuilt_library_list:
-                library = '\"%s\"' % library
-                res += library + ','
+            libraries += workspace.GetSymbols(self.prebuilt_library_list)
         elif self.data.get('export_static') == 1:
-            for library in self.prebuilt_static_library_list:
-                res += library + ','
+            library_nodes += workspace.GetSymbols(
+                    self.prebuilt_static_library_list)
         else:
-            for library in self.dep_library_list:
-                res += library + ','
-        for library in self.system_library_list:
-            res += '\"%s\",' % library
-        res += ']'
-        return res
+            library_nodes += workspace.GetSymbols(self.dep_library_list)
+        libraries += workspace.GetSymbols(self.system_library_list)
+        return library_nodes, libraries
 
-    def AddRule(self, rule):
-        self.scons_rules.append(rule + '\n')
+    def AddAction(self, *action):
+        self.scons_actions.append(marshal.dumps(action))
 
-    def AddRuleForInstall(self, rule):
-        self.scons_rules_for_install.append(rule + '\n')
+    def AddActionForInstall(self, *action):
+        self.scons_actions_for_install.append(marshal.dumps(action))
 
     def AddToTargetPool(self):
         targets = target_pool.GetTargetPool()
@@ -130,31 +165,34 @@ class Target(object):
 
     def ParseDepHeader(self):
         if self.incs:
+            workspace = GetWorkspace()
             for inc in self.incs:
                 inc_with_path = os.path.join(self.current_dir, inc)
-                self.dep_header_list.append(inc_with_path)
+                self.dep_header_list.append(workspace.Intern(inc_with_path))
 
     def SrcReplaceRegex(self):
         new_srcs = []
         for src in self.srcs:
             if '*' in src:
-                src_list = glob.glob(src)
-                new_srcs += src_list
+                pattern = os.path.join(self.current_dir, src)
+                src_list = glob.glob(pattern)
+                _build_context.globs[pattern] = sorted(src_list)
+                new_srcs += [GetRelativeDir(src_with_path, self.current_dir)
+                        for src_with_path in src_list]
             else:
                 new_srcs.append(src)
         self.srcs = new_srcs
 
     def RegisterTarget(self):
-        # build targets are send by sys.argv
-        build_target_list = \
-                filter(lambda x:(len(x) > 0 and x[0] != '-'), sys.argv)
-        if len(build_target_list) == 0 or self.name in build_target_list:
-            self.ParseAndAddTarget()
+        # Parsed when the loader finds it reachable.
+        _build_context.targets.append(self)
 
     def ParseAndAddTarget(self):
         pass
 
 class CcTarget(Target):
+    __slots__ = ('srcs_with_path', 'obj_target_names')
+
     def __init__(self, name, target_type, srcs, deps, scons_target_type,
             incs, defs, extra_include_paths, extra_lib_paths):
         Target.__init__(self, name, target_type, srcs, deps, scons_target_type,
@@ -162,47 +200,44 @@ class CcTarget(Target):
 
     def WriteRule(self):
         Target.WriteRule(self)
+        workspace = GetWorkspace()
         for i in range(len(self.objs)):
-            obj = self.objs[i]
-            obj_target_name = self.obj_target_names[i]
-            src_with_path = self.srcs_with_path[i]
-            rule = '%s = %s.SharedObject(target = \"%s\", source = \"%s\")' % (
-                    obj, self.env, obj_target_name, src_with_path)
-            self.AddRule(rule)
+            self.AddAction('object', self.objs[i], self.obj_target_names[i],
+                    self.srcs_with_path[i])
 
-        objs_name = self.relative_dir + '_' + self.name + '_objs' + self.dl_suffix
-        objs_name = RemoveSpecialChar(objs_name)
         if self.data.get('export_dynamic') == 1 or self.data.get('export_static') == 1:
-            rule = '%s = [%s]' % (objs_name, ','.join(self.objs + self.sub_objs))
+            objs = self.objs + workspace.GetSymbols(self.sub_objs)
         else:
-            rule = '%s = [%s]' % (objs_name, ','.join(self.objs))
-        self.AddRule(rule)
-        deps = self.FormatDepLibrary()
-        if self.data.get('export_dynamic') == 1:
-            # Dynamic dependence library can not link with absolutive path.
-            rule = '%s = %s.%s(\"%s\", %s, LIBS=%s, LIBPATH=%s)' % (
-                    self.target_name, self.env, self.scons_target_type,
-                    self.full_name, objs_name, deps, self.dep_paths)
+            objs = self.objs
+        link_all_symbols_list = workspace.GetSymbols(
+                self.link_all_symbols_lib_list)
+        if self.scons_target_type == 'Library':
+            # Archives are not linked, the overrides would only cost scons
+            # an environment for each of them.
+            self.AddAction('link', 'Library', self.target_name,
+                    self.full_name, objs, [], [], None, [])
         else:
-            rule = '%s = %s.%s(\"%s\", %s, LIBS=%s)' % (
-                    self.target_name, self.env, self.scons_target_type,
-                    self.full_name, objs_name, deps)
-        self.AddRule(rule)
+            library_nodes, libraries = self.FormatDepLibrary()
+            lib_paths = None
+            if self.data.get('export_dynamic') == 1:
+                # Dynamic dependence library can not link with absolutive path.
+                lib_paths = workspace.GetSymbols(self.dep_paths)
+            self.AddAction('link', self.scons_target_type, self.target_name,
+                    self.full_name, objs, library_nodes, libraries, lib_paths,
+                    link_all_symbols_list)
 
         # Depend relation.
-        if self.link_all_symbols_lib_list:
+        if link_all_symbols_list:
             if self.type == 'cc_binary' or \
                     self.data.get('export_dynamic') == 1 or \
                     self.data.get('export_static') == 1:
-                link_all_symbols_str = '[' + ','.join(self.link_all_symbols_lib_list) + ']'
-                rule = '%s.Depends(%s, %s)' % (self.env, self.target_name, link_all_symbols_str)
-                self.AddRule(rule)
+                self.AddAction('depends', self.target_name,
+                        link_all_symbols_list)
 
     def ParseAndAddTarget(self):
         self.AddObjs()
         self.ParseDeps()
         self.ParseDepHeader()
-        self.ParseDepsRecursive()
         self.AddToTargetPool()
 
     def AddObjs(self):
@@ -222,25 +257,26 @@ class CcTarget(Target):
             self.objs.append(obj)
 
     def ParseDeps(self):
-        self.dep_library_list = []
-        self.dep_paths = []
-        self.dep_header_list = []
+        workspace = GetWorkspace()
+        self.dep_library_list = array.array('i')
+        self.dep_paths = array.array('i')
+        self.dep_header_list = array.array('i')
         for dep in self.deps:
             if len(dep) == 0:
                 continue
             if dep[0] == '#':
-                self.system_library_list.append(dep[1:])
+                self.system_library_list.append(workspace.Intern(dep[1:]))
             elif dep[0] == ':':
                 dep_library = os.path.join(self.relative_dir, dep[1:])
                 dep_library = RemoveSpecialChar(dep_library)
                 if self.data.get('export_dynamic') == 1:
-                    self.dep_library_list.append(dep[1:])
+                    self.dep_library_list.append(workspace.Intern(dep[1:]))
                 else:
-                    self.dep_library_list.append(dep_library)
-                target_key = os.path.join(self.current_dir, dep[1:])
+                    self.dep_library_list.append(workspace.Intern(dep_library))
+                target_key = intern(os.path.join(self.current_dir, dep[1:]))
                 self.recursive_library_list.append(target_key)
                 dep_path = os.path.join(self.build_root_dir, self.relative_dir)
-                self.dep_paths.append(dep_path)
+                self.dep_paths.append(workspace.Intern(dep_path))
             elif dep[0:2] == '//':
                 fields = dep[2:].split(':')
                 if len(fields) != 2:
@@ -250,52 +286,21 @@ class CcTarget(Target):
                 library_name = fields[1]
                 dep_library = RemoveSpecialChar(library_path + ':' + library_name)
                 if self.data.get('export_dynamic') == 1:
-                    self.dep_library_list.append(library_name)
+                    self.dep_library_list.append(workspace.Intern(library_name))
                 else:
-                    self.dep_library_list.append(dep_library)
+                    self.dep_library_list.append(workspace.Intern(dep_library))
 
-                target_key = os.path.join(self.flame_root_dir,
-                        library_path, library_name)
+                target_key = intern(os.path.join(self.flame_root_dir,
+                        library_path, library_name))
                 self.recursive_library_list.append(target_key)
                 dep_path = os.path.join(self.build_root_dir, library_path)
-                self.dep_paths.append(dep_path)
+                self.dep_paths.append(workspace.Intern(dep_path))
             else:
                 ErrorExit('The format of deps(%s) is invalid.' % (dep))
 
-    def ParseDepsRecursive(self):
-        targets = target_pool.GetTargetPool()
-        for target_key in self.recursive_library_list:
-            if target_key in targets:
-                continue
-            library_path = os.path.dirname(target_key)
-            library_name = os.path.basename(target_key)
-            current_dir = GetCurrentDir()
-            os.chdir(library_path)
-            build_name = GetBuildName()
-            if not os.path.isfile(build_name):
-                relative_dir = GetRelativeDir(library_path, GetFlameRootDir())
-                ErrorExit('//%s/BUILD not find. required by //%s:%s.' % (
-                        relative_dir, self.relative_dir, self.name))
-            build_library_pool = target_pool.GetBuildLibraryPool()
-            if (build_name, library_name) in build_library_pool:
-                os.chdir(current_dir)
-                continue
-            build_library_pool[(build_name, library_name)] = 1
-            # Only build |library_name|
-            argv_backup = copy.copy(sys.argv)
-            prefix_list = filter(lambda x:('-prefix=' in x), sys.argv)
-            sys.argv = [library_name]
-            if self.data.get('export_dynamic') == 1:
-                if library_name[-6:] == '_share':
-                    library_name = library_name[:len(library_name)-6]
-                    sys.argv = [library_name]
-            sys.argv += prefix_list
-            execfile(build_name)
-            # Clear build targets, restore old argv.
-            sys.argv = argv_backup
-            os.chdir(current_dir)
-
 class CcLibraryTarget(CcTarget):
+    __slots__ = ()
+
     def __init__(self, name, target_type, srcs, deps, scons_target_type,
             incs, defs, extra_include_paths, extra_lib_paths,
             export_dynamic, export_static, warning,
@@ -317,11 +322,11 @@ class CcLibraryTarget(CcTarget):
         CcTarget.WriteRule(self)
         if self.data.get('export_dynamic') == 1 or self.data.get('export_static') == 1:
             release_dir = os.path.join(self.release_prefix, 'lib')
-            rule = '%s.Alias(\'install\', %s.Install(\'%s\', %s))' % (
-                    self.env, self.env, release_dir, self.target_name)
-            self.AddRuleForInstall(rule)
+            self.AddActionForInstall('install', release_dir, self.target_name)
 
 class CcBinaryTarget(CcTarget):
+    __slots__ = ('binary_name',)
+
     def __init__(self, name, target_type, srcs, deps, scons_target_type, defs,
             extra_include_paths, extra_lib_paths):
         CcTarget.__init__(self, name, target_type, srcs, deps, scons_target_type,
@@ -331,11 +336,12 @@ class CcBinaryTarget(CcTarget):
         CcTarget.WriteRule(self)
         self.binary_name = self.full_name
         release_dir = os.path.join(self.release_prefix, 'bin')
-        rule = '%s.Alias(\'install\', %s.Install(\'%s\', %s))' % (
-                self.env, self.env, release_dir, self.target_name)
-        self.AddRuleForInstall(rule)
+        self.AddActionForInstall('install', release_dir, self.target_name)
 
 class CcTestTarget(CcTarget):
+    __slots__ = ('testdata', 'testcase_rundir', 'testdata_copy_pair',
+            'test_case')
+
     def __init__(self, name, target_type, srcs, deps, scons_target_type,
                 defs, testdata):
         CcTarget.__init__(self, name, target_type, srcs, deps,
@@ -370,6 +376,8 @@ class CcTestTarget(CcTarget):
             self.testdata_copy_pair.append((source_file_name, link_file_name))
 
 class CcPrebuiltLibraryTarget(CcTarget):
+    __slots__ = ()
+
     def __init__(self, name, target_type, srcs, deps, scons_target_type,
                 incs, defs, export_dynamic, export_static, warning):
         CcTarget.__init__(self, name, target_type, srcs, deps, scons_target_type,
@@ -392,19 +400,18 @@ class CcPrebuiltLibraryTarget(CcTarget):
         prebuilt_name = 'lib%s.%s' % (self.name, prebuilt_suffix)
         prebuilt_target = os.path.join(self.build_root_dir, self.relative_dir, prebuilt_name)
         prebuilt_source = os.path.join(self.flame_root_dir, self.relative_dir, 'lib', prebuilt_name)
-        rule = 'Command(\"%s\", \"%s\", Copy(\"$TARGET\", \"$SOURCE\"))' % (prebuilt_target, prebuilt_source)
-        self.AddRule(rule)
-        rule = '%s = env.File(\"%s\")' % (self.target_name, prebuilt_target)
-        self.AddRule(rule)
+        self.AddAction('prebuilt', self.target_name, prebuilt_target,
+                prebuilt_source)
 
     def ParseAndAddTarget(self):
         self.ParseDepHeader()
         self.ParseDeps()
         self.ParseDepHeader()
-        self.ParseDepsRecursive()
         self.AddToTargetPool()
 
 class ExtraExportTarget(Target):
+    __slots__ = ('export_headers', 'export_confs', 'export_files')
+
     def __init__(self, headers, confs, files):
         Target.__init__(self, 'extra_export', 'extra_export',
                 [], [], '', [], [], [], [])
@@ -432,13 +439,15 @@ class ExtraExportTarget(Target):
                 release_name = os.path.join(release_dir, extra_file_list[1])
             else:
                 release_name = os.path.join(release_dir, source_name)
-            rule = 'env.Alias(\'install\', env.InstallAs(\'%s\', \'%s\'))' % (release_name, extra_file_name)
-            self.AddRuleForInstall(rule)
+            self.AddActionForInstall('install_as', release_name,
+                    extra_file_name)
 
     def ParseAndAddTarget(self):
         self.AddToTargetPool()
 
 class ProtoLibraryTarget(CcTarget):
+    __slots__ = ('incs_with_path', 'protos_with_path')
+
     def __init__(self, name, target_type, srcs, deps, scons_target_type):
         CcTarget.__init__(self, name, target_type, srcs, deps, scons_target_type,
                 [], [], [], [])
@@ -446,27 +455,14 @@ class ProtoLibraryTarget(CcTarget):
     def WriteRule(self):
         Target.WriteRule(self)
         for i in range(len(self.objs)):
-            obj = self.objs[i]
-            obj_target_name = self.obj_target_names[i]
             src_with_path = self.srcs_with_path[i]
-            proto_with_path = self.protos_with_path[i]
-            inc_with_path = self.incs_with_path[i]
-            proto_list = [inc_with_path, src_with_path]
-            rule = '%s.%s(%s, \"%s\")' % (
-                    self.env, self.scons_target_type, proto_list, proto_with_path)
-            self.AddRule(rule)
-            rule = '%s = %s.SharedObject(target = \"%s\", source = \"%s\")' % (
-                    obj, self.env, obj_target_name, src_with_path)
-            self.AddRule(rule)
-
-        objs_name = self.relative_dir + '_' + self.name + '_objs'
-        objs_name = RemoveSpecialChar(objs_name)
-        rule = '%s = [%s]' % (objs_name, ','.join(self.objs))
-        self.AddRule(rule)
-        deps = self.FormatDepLibrary()
-        rule = '%s = %s.Library(\"%s\", %s, LIBS=%s)' % (
-                self.target_name, self.env, self.full_name, objs_name, deps)
-        self.AddRule(rule)
+            proto_list = [self.incs_with_path[i], src_with_path]
+            self.AddAction('proto', proto_list, self.protos_with_path[i])
+            self.AddAction('object', self.objs[i], self.obj_target_names[i],
+                    src_with_path)
+
+        self.AddAction('link', 'Library', self.target_name, self.full_name,
+                self.objs, [], [], None, [])
 
     def AddObjs(self):
         self.srcs_with_path = []
@@ -520,8 +516,9 @@ def cc_binary(name, srcs, deps=[], defs=[], extra_include_paths=[],
     target.RegisterTarget()
 
 def cc_test(name, srcs, deps=[], defs=[], testdata=[]):
-    deps = VarToList(deps)
-    deps += ['//thirdparty/gtest:gtest', '//thirdparty/gtest:gtest_main']
+    # Do not extend |deps| in place, it may be shared by cached declarations.
+    deps = VarToList(deps) + ['//thirdparty/gtest:gtest',
+            '//thirdparty/gtest:gtest_main']
     target = CcTestTarget(name, 'cc_test', srcs, deps, 'Program', defs, testdata)
     target.RegisterTarget()
 
@@ -530,8 +527,14 @@ def extra_export(headers=[], confs=[], files=[]):
     target.RegisterTarget()
 
 def proto_library(name, srcs=[], deps=[]):
-    deps = VarToList(deps)
-    deps += ['//thirdparty/protobuf:protobuf',]
+    deps = VarToList(deps) + ['//thirdparty/protobuf:protobuf',]
     target = ProtoLibraryTarget(name, 'proto_library', srcs, deps, 'Proto')
     target.RegisterTarget()
 
+_build_rules = {
+    'cc_library': cc_library,
+    'cc_binary': cc_binary,
+    'cc_test': cc_test,
+    'extra_export': extra_export,
+    'proto_library': proto_library,
+}
@@ -6,24 +6,42 @@
 Target pool.
 '''
 
+import array
 import os
-import copy
 from util import *
 from dependence_analyser import *
 
 _target_pool = {}
-_build_library_pool = {}
 
 def WriteRuleForAllTargets():
+    '''Analyze the targets after their deps and write their rules.
+
+    A target is analyzed from its declaration and its analyzed deps, the
+    digest of them finds it in the analysis cache, only the targets not found
+    are analyzed.
+    '''
     global _target_pool
+    from analysis_cache import GetAnalysisCache
+    analysis_cache = GetAnalysisCache()
     GenerateRecursiveForSort()
     sorted_target_node_list = GetSortedTargetNodes(_target_pool)
-    ComplementSubDeps(sorted_target_node_list)
-    SortDepLibraryForAllTargets()
-    GenerateLinkAllSymbolsList()
+    dep_library_map = None
     for node in sorted_target_node_list:
         target = _target_pool[node.key]
+        target.analysis_digest = Digest(target.input_digest + ''.join(
+                [_target_pool[key].analysis_digest
+                        for key in target.recursive_library_list]))
+        if analysis_cache.RestoreTarget(target):
+            continue
+        if dep_library_map == None:
+            dep_library_map, position_map = GetDepLibraryMap(
+                    sorted_target_node_list)
+        ComplementSubDeps([target])
+        SortDepLibrary(target, dep_library_map, position_map)
+        GenerateLinkAllSymbolsList([target])
         target.WriteRule()
+        analysis_cache.StoreTarget(target)
+    analysis_cache.Report()
 
 def GetAllTargets():
     global _target_pool
@@ -34,95 +52,132 @@ def GetAllTargets():
         targets.append(target)
     return targets
 
-def ComplementSubDeps(sorted_target_node_list):
+def ComplementSubDeps(targets):
+    '''Merge the lists of the deps of |targets|, deps go first.'''
     global _target_pool
-    for node in sorted_target_node_list:
-        target = _target_pool[node.key]
-        # First copy recursive_library_list to sub.
-        target.recursive_library_list_with_sub = copy.copy(target.recursive_library_list)
+    workspace = GetWorkspace()
+    for target in targets:
+        recursive_library_ids = [workspace.Intern(key)
+                for key in target.recursive_library_list]
         if target.type == 'extra_export':
+            target.recursive_library_list_with_sub = array.array('i',
+                    recursive_library_ids)
             continue
-        recursive_library_list_str = ''
-        sub_recursive_library_list = []
+        # Lists of this target go first, then the lists of every sub target,
+        # the first one of duplicate items is kept.
+        recursive_library_lists = [recursive_library_ids]
+        dep_library_lists = [target.dep_library_list]
+        system_library_lists = [target.system_library_list]
+        dep_paths_lists = [target.dep_paths]
+        dep_header_lists = [target.dep_header_list]
+        sub_objs_lists = [target.sub_objs]
+        prebuilt_library_list = list(target.prebuilt_library_list)
+        prebuilt_static_library_list = list(target.prebuilt_static_library_list)
         for key in target.recursive_library_list:
             sub_target = _target_pool[key]
             # Dependant sub library must be put after this library,
             # or there will be link error(undefined reference to).
-            target.dep_library_list += sub_target.dep_library_list
-            target.system_library_list += sub_target.system_library_list
-            target.dep_paths += sub_target.dep_paths
-            target.dep_header_list += sub_target.dep_header_list
+            dep_library_lists.append(sub_target.dep_library_list)
+            system_library_lists.append(sub_target.system_library_list)
+            dep_paths_lists.append(sub_target.dep_paths)
+            dep_header_lists.append(sub_target.dep_header_list)
             # If the library not allow export, export static or dynamic
             # will not archive the objs.
             if not sub_target.data.has_key('allow_export') or sub_target.data.get('allow_export') == 1:
-                target.sub_objs += sub_target.sub_objs + sub_target.objs
+                sub_objs_lists.append(sub_target.sub_objs)
+                sub_objs_lists.append([workspace.Intern(obj)
+                        for obj in sub_target.objs])
             if sub_target.data.get('prebuilt') == 1:
-                target.prebuilt_library_list.append(sub_target.name)
-                target.prebuilt_static_library_list.append(sub_target.target_name)
-            recursive_library_list_str += sub_target.name + ','
-            sub_recursive_library_list += sub_target.recursive_library_list_with_sub
-        target.recursive_library_list_with_sub = target.recursive_library_list_with_sub + sub_recursive_library_list
-        target.recursive_library_list_with_sub = RemoveDuplicate(target.recursive_library_list_with_sub)
-        target.dep_header_list = RemoveDuplicate(target.dep_header_list)
-        target.dep_library_list = RemoveDuplicate(target.dep_library_list)
-        target.system_library_list = RemoveDuplicate(target.system_library_list)
-        target.dep_paths = RemoveDuplicate(target.dep_paths)
-        target.sub_objs = RemoveDuplicate(target.sub_objs)
-        target.prebuilt_library_list = RemoveDuplicate(target.prebuilt_library_list)
-        target.prebuilt_static_library_list = RemoveDuplicate(target.prebuilt_static_library_list)
+                prebuilt_library_list.append(workspace.Intern(sub_target.name))
+                prebuilt_static_library_list.append(
+                        workspace.Intern(sub_target.target_name))
+            recursive_library_lists.append(sub_target.recursive_library_list_with_sub)
+        target.recursive_library_list_with_sub = array.array('i',
+                MergeUnique(recursive_library_lists))
+        target.dep_header_list = array.array('i', MergeUnique(dep_header_lists))
+        target.dep_library_list = array.array('i', MergeUnique(dep_library_lists))
+        target.system_library_list = array.array('i',
+                MergeUnique(system_library_lists))
+        target.dep_paths = array.array('i', MergeUnique(dep_paths_lists))
+        target.sub_objs = array.array('i', MergeUnique(sub_objs_lists))
+        target.prebuilt_library_list = array.array('i',
+                RemoveDuplicate(prebuilt_library_list))
+        target.prebuilt_static_library_list = array.array('i',
+                RemoveDuplicate(prebuilt_static_library_list))
 
 # Dynamic library only dependent prebuild and system library.
 def GenerateRecursiveForSort():
     global _target_pool
     for target in _target_pool.values():
-        target.recursive_library_list_for_sort = \
-                copy.copy(target.recursive_library_list)
+        # The sort does not change the lists, they are not copied.
+        target.recursive_library_list_for_sort = target.recursive_library_list
+
+def ResetTargetPool():
+    '''Forget all targets, to load and analyze again.'''
+    global _target_pool
+    _target_pool.clear()
+    ResetSortedTargetNodes()
 
 def GetTargetPool():
     global _target_pool
     return _target_pool
 
-def GetBuildLibraryPool():
-    global _build_library_pool
-    return _build_library_pool
-
-def SortDepLibraryForAllTargets():
-    # There will be wrong if dep library list in disorder.
-    global _target_pool
-    sorted_target_node_list = GetSortedTargetNodes(_target_pool)
+def GetDepLibraryMap(sorted_target_node_list):
+    '''Dep library name -> position of its target in the sort, and target
+    key -> its position and its name for share.
+    '''
     dep_library_map = {}
-    flame_root_dir = GetFlameRootDir()
-    i = 0
-    for node in sorted_target_node_list:
-        relative_dir = GetRelativeDir(node.key, flame_root_dir)
-        dep_library = RemoveSpecialChar(relative_dir)
-        dep_library_map[dep_library] = i
-        dep_library_for_share = os.path.basename(node.key)
+    position_map = {}
+    workspace = GetWorkspace()
+    for i, node in enumerate(sorted_target_node_list):
+        relative_dir = workspace.GetRelativeDir(node.key)
+        dep_library = workspace.MangleName(relative_dir)
+        dep_library_map[workspace.Intern(dep_library)] = i
+        dep_library_for_share = workspace.Intern(os.path.basename(node.key))
         dep_library_map[dep_library_for_share] = i
-        i += 1
-    for target in _target_pool.values():
-        target.dep_library_list.sort(key=lambda x:dep_library_map[x], reverse=True)
-        target.prebuilt_library_list.sort(key=lambda x:dep_library_map[x], reverse=True)
-        target.prebuilt_static_library_list.sort(key=lambda x:dep_library_map[x], reverse=True)
+        position_map[node.key] = (i, dep_library_for_share)
+    return dep_library_map, position_map
+
+def SortDepLibrary(target, dep_library_map, position_map):
+    # There will be wrong if dep library list in disorder.
+    # The order of two targets in the sort only depends on their deps and
+    # keys. A name for share may be of several targets, the last one in the
+    # deps of |target| is used, not the last one of all targets loaded.
+    workspace = GetWorkspace()
+    share_map = {}
+    for key in workspace.GetSymbols(target.recursive_library_list_with_sub):
+        i, dep_library_for_share = position_map[key]
+        if share_map.get(dep_library_for_share, -1) < i:
+            share_map[dep_library_for_share] = i
+    def GetPosition(dep_library):
+        i = share_map.get(dep_library)
+        if i == None:
+            i = dep_library_map[dep_library]
+        return i
+    target.dep_library_list = array.array('i', sorted(target.dep_library_list,
+            key=GetPosition, reverse=True))
+    target.prebuilt_library_list = array.array('i', sorted(target.prebuilt_library_list,
+            key=GetPosition, reverse=True))
+    target.prebuilt_static_library_list = array.array('i', sorted(target.prebuilt_static_library_list,
+            key=GetPosition, reverse=True))
 
 # Generate link all symbols by dep library list.
-def GenerateLinkAllSymbolsList():
+def GenerateLinkAllSymbolsList(targets):
     global _target_pool
-    flame_root_dir = GetFlameRootDir()
-    for target_key in _target_pool:
-        target = _target_pool[target_key]
+    workspace = GetWorkspace()
+    for target in targets:
         # Only binary and test need link all symbols.
         if target.type != 'cc_binary' and target.type != 'cc_test':
             continue
 
-        link_all_symbols_list = []
-        for sub_target_key in target.recursive_library_list_with_sub:
-            relative_dir = GetRelativeDir(sub_target_key, flame_root_dir)
-            dep_library = RemoveSpecialChar(relative_dir)
+        link_all_symbols_list = array.array('i')
+        for sub_target_key in workspace.GetSymbols(target.recursive_library_list_with_sub):
             sub_target = _target_pool[sub_target_key]
             if sub_target.data.get('link_all_symbols') == 1:
-                link_all_symbols_list.append(dep_library)
-        not_link_all_symbols_list = [i for i in target.dep_library_list if i not in link_all_symbols_list]
-        target.dep_library_list = not_link_all_symbols_list
+                relative_dir = workspace.GetRelativeDir(sub_target_key)
+                dep_library = workspace.MangleName(relative_dir)
+                link_all_symbols_list.append(workspace.Intern(dep_library))
+        link_all_symbols_set = set(link_all_symbols_list)
+        not_link_all_symbols_list = [i for i in target.dep_library_list if i not in link_all_symbols_set]
+        target.dep_library_list = array.array('i', not_link_all_symbols_list)
         target.link_all_symbols_lib_list = link_all_symbols_list
-
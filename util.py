@@ -6,9 +6,11 @@
 Flame utility.
 '''
 
+import hashlib
 import os
+import shutil
 import sys
-import multiprocessing
+from workspace import GetWorkspace
 
 # Global color enabled or not
 _color_enabled = (sys.stdout.isatty() and
@@ -26,6 +28,17 @@ _colors['white']  = '\033[1;37m'
 _colors['gray']   = '\033[1;38m'
 _colors['end']    = '\033[0m'
 
+# Memory a compile and a link may take, it limits the default jobs and holds
+# new jobs when the memory is low.
+_job_memory = {'compile': 512 << 20, 'link': 2 << 30}
+
+def SetColorEnabled(enabled):
+    global _color_enabled
+    _color_enabled = enabled
+
+def IsColorEnabled():
+    return _color_enabled
+
 def Colors(name):
     """Return ansi console control sequence from color name"""
     if _color_enabled:
@@ -74,64 +87,116 @@ def GetRelativeDir(dir1, dir2):
     return os.path.relpath(dir1, dir2)
 
 def GetFlameRootDir():
-    flame_root = 'FLAME_ROOT'
-    current_dir = GetCurrentDir()
-    flame_root_dir = ''
-    while not os.path.isfile(flame_root):
-        if GetCurrentDir() == '/':
-            break
-        parent_dir = os.path.join(GetCurrentDir(), '..')
-        os.chdir(parent_dir)
-
-    if os.path.isfile(flame_root):
-        flame_root_dir = GetCurrentDir()
-    os.chdir(current_dir)
-    return flame_root_dir
+    return GetWorkspace().root_dir
+
+def GetFlameRootFileName():
+    return os.path.join(GetFlameRootDir(), 'FLAME_ROOT')
+
+_flame_root_config = None
+
+def GetFlameRootConfig():
+    '''Variables defined in FLAME_ROOT, evaluated once.'''
+    global _flame_root_config
+    if _flame_root_config == None:
+        _flame_root_config = {}
+        execfile(GetFlameRootFileName(), _flame_root_config)
+    return _flame_root_config
+
+def GetCacheDir():
+    '''Directory of flame's persistent caches, set by cache_dir in FLAME_ROOT.'''
+    cache_dir = GetFlameRootConfig().get('cache_dir')
+    if not cache_dir:
+        return os.path.join(GetBuildRootDir(), '.cache')
+    return os.path.join(GetFlameRootDir(), cache_dir)
 
 def GetSconsFileName(scons_dir):
     return os.path.join(scons_dir, 'SConstruct')
 
-def GetBuildName():
-    return os.path.join(GetCurrentDir(), 'BUILD')
-
 def GetBuildDirName():
-    return 'flame-bin'
+    return GetWorkspace().build_dir_name
 
 def GetBuildRootDir():
-    flame_root = GetFlameRootDir()
-    return os.path.join(flame_root, GetBuildDirName())
+    return GetWorkspace().build_root_dir
 
 def GetBuildDebugRootDir():
-    flame_root = GetFlameRootDir()
-    return os.path.join(flame_root, 'build_debug')
+    return GetWorkspace().build_debug_root_dir
 
 def GetBuildReleaseRootDir():
-    flame_root = GetFlameRootDir()
-    return os.path.join(flame_root, 'build_release')
+    return GetWorkspace().build_release_root_dir
 
 def GetCpuCount():
+    import multiprocessing
     return multiprocessing.cpu_count()
 
+def GetAvailableMemory():
+    '''Bytes of memory available to new processes, None if unknown.'''
+    try:
+        meminfo = ReadFile('/proc/meminfo')
+    except IOError:
+        return None
+    values = {}
+    for line in meminfo.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[1].isdigit():
+            values[fields[0].rstrip(':')] = int(fields[1]) * 1024
+    if 'MemAvailable' in values:
+        return values['MemAvailable']
+    # Kernels before 3.14.
+    if 'MemFree' in values:
+        return values['MemFree'] + values.get('Cached', 0)
+    return None
+
+def GetJobMemory(pool):
+    '''Memory a job of |pool|, compile or link, may take.'''
+    return _job_memory[pool]
+
 def RemoveDuplicate(item_list):
+    return MergeUnique([item_list])
+
+def MergeUnique(item_lists):
+    '''Concatenate |item_lists|, keep the first one of duplicate items.'''
     result_list = []
-    for item in item_list:
-        if item not in result_list:
-            result_list.append(item)
+    item_set = set()
+    for item_list in item_lists:
+        for item in item_list:
+            if item not in item_set:
+                item_set.add(item)
+                result_list.append(item)
     return result_list
 
+def ReadFile(file_name):
+    f = open(file_name, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def WriteFileAtomically(file_name, content):
+    '''Write by renaming a temporary file, readers never see a partial file.
+
+    |content| is a string or a list of strings.
+    '''
+    MkdirIfNotExists(os.path.dirname(file_name))
+    tmp_file_name = '%s.tmp.%d' % (file_name, os.getpid())
+    f = open(tmp_file_name, 'wb')
+    try:
+        if isinstance(content, str):
+            f.write(content)
+        else:
+            f.writelines(content)
+    finally:
+        f.close()
+    os.rename(tmp_file_name, file_name)
+
+def Digest(content):
+    return hashlib.sha1(content).hexdigest()
+
 def VarToList(var):
     var_list = var
     if isinstance(var, str):
         var_list = [var]
     return var_list
 
-def ParseReleasePrefix(args):
-    release_prefix = ''
-    prefix_list = filter(lambda x:('-prefix=' in x), args)
-    if len(prefix_list) > 0:
-        release_prefix = prefix_list[0].split('=')[1]
-    return release_prefix
-
 def MkdirIfNotExists(dirname):
     if not os.path.isdir(dirname):
         os.makedirs(dirname)
@@ -139,32 +204,106 @@ def MkdirIfNotExists(dirname):
 def Symlink(source, link_name):
     if os.path.isfile(link_name) or os.path.islink(link_name):
         os.remove(link_name)
+    elif os.path.isdir(link_name):
+        # Left by an older flame which created the dir instead of the link.
+        Warning('%s is a directory, replace it with a link to %s.' % (
+                link_name, source))
+        shutil.rmtree(link_name)
     os.symlink(source, link_name)
 
-def ProtoBuilderRules():
+def GetProtocCommand(source):
+    '''Command generating the c++ files of the proto file |source|.'''
     protoc_bin = 'thirdparty/protobuf/bin/protoc'
     protobuf_incs = 'thirdparty'
+    return ('%s --proto_path=. -I. -I%s -I=`dirname %s` --cpp_out=%s %s' % (
+            protoc_bin, protobuf_incs, source, GetBuildDirName(), source))
+
+def ProtoBuilderRules():
     builder_list = []
     scons_rules = []
     scons_rules.append(
             'proto_builder = Builder('
-            'action = SCons.Action.Action("%s --proto_path=. -I. -I%s'
-            ' -I=`dirname $SOURCE` --cpp_out=%s $SOURCE"))\n\n' % (
-                protoc_bin, protobuf_incs, GetBuildDirName()))
+            'action = SCons.Action.Action("%s"))\n\n' % GetProtocCommand(
+                    '$SOURCE'))
     builder_list.append('BUILDERS = {"Proto" : proto_builder}')
     for builder in builder_list:
         scons_rules.append('env.Append(%s)\n\n' % builder)
     return scons_rules
 
+def ActionLoaderRules():
+    '''LoadActions(file_name) creates the nodes of the actions in a file.
+
+    Targets with the same flags share an environment, env is cloned once for
+    the same appends. Nodes are saved by name for the actions after them.
+    '''
+    whole_archive = '-Wl,--whole-archive'
+    no_whole_archive = '-Wl,--no-whole-archive'
+    if Platform() == 'darwin':
+        whole_archive = '-Wl,-all_load'
+        no_whole_archive = '-Wl,-noall_load'
+    return [
+            'import marshal\n\n'
+            'shared_envs = {}\n\n'
+            'def SharedEnv(appends):\n'
+            '    if not appends:\n'
+            '        return env\n'
+            '    key = repr(sorted(appends.items()))\n'
+            '    if key not in shared_envs:\n'
+            '        shared_envs[key] = env.Clone()\n'
+            '        shared_envs[key].Append(**appends)\n'
+            '    return shared_envs[key]\n\n'
+            'nodes = {}\n\n'
+            'def Nodes(names):\n'
+            '    return [nodes[name] for name in names]\n\n'
+            'def ReadActions(file_name):\n'
+            '    f = open(file_name, "rb")\n'
+            '    try:\n'
+            '        while True:\n'
+            '            try:\n'
+            '                action = marshal.load(f)\n'
+            '            except EOFError:\n'
+            '                return\n'
+            '            yield action\n'
+            '    finally:\n'
+            '        f.close()\n\n'
+            'def LoadActions(file_name):\n'
+            '    target_env = env\n'
+            '    for action in ReadActions(file_name):\n'
+            '        kind = action[0]\n'
+            '        if kind == "env":\n'
+            '            target_env = SharedEnv(action[1])\n'
+            '        elif kind == "object":\n'
+            '            nodes[action[1]] = target_env.SharedObject(\n'
+            '                    target = action[2], source = action[3])\n'
+            '        elif kind == "link":\n'
+            '            (builder, name, full_name, objs, library_nodes, libraries,\n'
+            '                    lib_paths, link_all_symbols_list) = action[1:]\n'
+            '            overrides = {}\n'
+            '            if library_nodes or libraries:\n'
+            '                overrides["LIBS"] = Nodes(library_nodes) + libraries\n'
+            '            if lib_paths != None:\n'
+            '                overrides["LIBPATH"] = lib_paths\n'
+            '            if link_all_symbols_list:\n'
+            '                overrides["LINKFLAGS"] = target_env["LINKFLAGS"] + [\n'
+            '                        "%s"] + Nodes(link_all_symbols_list) + [\n'
+            '                        "%s"]\n'
+            '            nodes[name] = getattr(target_env, builder)(full_name,\n'
+            '                    Nodes(objs), **overrides)\n'
+            '        elif kind == "depends":\n'
+            '            target_env.Depends(nodes[action[1]], Nodes(action[2]))\n'
+            '        elif kind == "proto":\n'
+            '            target_env.Proto(action[1], action[2])\n'
+            '        elif kind == "prebuilt":\n'
+            '            Command(action[2], action[3], Copy("$TARGET", "$SOURCE"))\n'
+            '            nodes[action[1]] = env.File(action[2])\n'
+            '        elif kind == "install":\n'
+            '            env.Alias("install", env.Install(action[1], nodes[action[2]]))\n'
+            '        elif kind == "install_as":\n'
+            '            env.Alias("install", env.InstallAs(action[1], action[2]))\n\n'
+            % (whole_archive, no_whole_archive)]
+
 def RemoveSpecialChar(name):
-    magic_str = '_mAgIc_'
-    name = name.replace('/', magic_str)
-    name = name.replace('\\', magic_str)
-    name = name.replace('-', magic_str)
-    name = name.replace('.', magic_str)
-    name = name.replace(':', magic_str)
-    name = name.replace('+', magic_str)
-    return name
+    return GetWorkspace().MangleName(name)
 
 def Platform():
     return sys.platform
@@ -0,0 +1,313 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Flame watch.
+
+flame watch build|test watches the dirs of the requested targets, their
+sources, headers and testdata, and builds again after a burst of saves is
+over. The analysis is kept until a BUILD file changes or a file is added or
+removed, scons rebuilds only what depends on the changed files, and only the
+tests whose binaries or testdata changed are run again.
+'''
+
+import copy
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from analysis_cache import GetStamp
+from cmd_parser import GetCmdParser
+from util import *
+
+# Seconds without changes before a burst of saves is over.
+_DEBOUNCE_SECONDS = 0.3
+
+# Seconds between two scans of the polling watcher.
+_POLL_SECONDS = 1.0
+
+# Changes of these files need a new analysis.
+_ANALYSIS_FILE_NAMES = ['BUILD', 'FLAME_ROOT', '.flameignore']
+
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+
+_INOTIFY_MASK = (_IN_CLOSE_WRITE | _IN_ATTRIB | _IN_MOVED_FROM |
+        _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+def IsIgnoredName(dir_name, name):
+    '''Editor temporary files and the files written by the build.'''
+    if name in _ANALYSIS_FILE_NAMES:
+        return False
+    if name.startswith('.') or name.endswith('~') or name.startswith('#'):
+        return True
+    if dir_name == GetFlameRootDir():
+        return name in ['SConstruct', GetBuildDirName(),
+                os.path.basename(GetBuildDebugRootDir()),
+                os.path.basename(GetBuildReleaseRootDir())]
+    return False
+
+def ListDir(dir_name):
+    try:
+        names = os.listdir(dir_name)
+    except OSError:
+        return []
+    return [os.path.join(dir_name, name) for name in names
+            if not IsIgnoredName(dir_name, name)]
+
+class InotifyWatcher(object):
+    '''Watch dirs and files with inotify.'''
+    def __init__(self, paths):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.paths = {}
+        for path in paths:
+            wd = self.libc.inotify_add_watch(self.fd, path, _INOTIFY_MASK)
+            if wd >= 0:
+                self.paths[wd] = path
+
+    def Close(self):
+        os.close(self.fd)
+
+    def Wait(self, timeout):
+        '''Changed paths, an empty set if nothing changed in |timeout|.'''
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return set()
+            raise
+        if not readable:
+            return set()
+        content = os.read(self.fd, 1 << 16)
+        changed_paths = set()
+        offset = 0
+        while offset < len(content):
+            wd, mask, _, name_len = _EVENT_HEADER.unpack_from(content, offset)
+            offset += _EVENT_HEADER.size
+            name = content[offset:offset + name_len].rstrip('\0')
+            offset += name_len
+            if mask & _IN_Q_OVERFLOW:
+                # Events are lost, check everything.
+                changed_paths.update(self.paths.values())
+                continue
+            path = self.paths.get(wd)
+            if path == None or mask & _IN_IGNORED:
+                continue
+            if not name:
+                changed_paths.add(path)
+            elif not IsIgnoredName(path, name):
+                changed_paths.add(os.path.join(path, name))
+        return changed_paths
+
+class PollingWatcher(object):
+    '''Watch dirs and files by comparing their stamps.'''
+    def __init__(self, paths):
+        self.paths = paths
+        self.stamps = self.Scan()
+
+    def Close(self):
+        pass
+
+    def Scan(self):
+        stamps = {}
+        for path in self.paths:
+            if os.path.isdir(path):
+                for sub_path in ListDir(path):
+                    stamps[sub_path] = GetStamp(sub_path)
+            else:
+                stamps[path] = GetStamp(path)
+        return stamps
+
+    def Wait(self, timeout):
+        deadline = None
+        if timeout != None:
+            deadline = time.time() + timeout
+        while True:
+            stamps = self.Scan()
+            changed_paths = set()
+            for path in set(stamps.keys()) | set(self.stamps.keys()):
+                if stamps.get(path) != self.stamps.get(path):
+                    changed_paths.add(path)
+            self.stamps = stamps
+            if changed_paths:
+                return changed_paths
+            if deadline != None and time.time() >= deadline:
+                return changed_paths
+            seconds = _POLL_SECONDS
+            if deadline != None:
+                seconds = min(seconds, max(deadline - time.time(), 0))
+            time.sleep(seconds)
+
+def CreateWatcher(paths):
+    if not GetCmdParser().options.poll:
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError, TypeError):
+            Warning('inotify is not available, poll for changes.')
+    return PollingWatcher(paths)
+
+def GetWatchedPaths(loader, targets):
+    '''Package dirs, dirs of sources and headers, testdata and FLAME_ROOT.'''
+    paths = set(loader.packages.keys())
+    paths.add(GetFlameRootDir())
+    for target in targets:
+        for src_with_path in getattr(target, 'srcs_with_path', []):
+            paths.add(os.path.dirname(src_with_path))
+        for inc in target.incs:
+            inc_dir = os.path.join(target.current_dir, inc)
+            if os.path.isdir(inc_dir):
+                paths.add(os.path.normpath(inc_dir))
+        if target.type == 'cc_test':
+            for source_name, _ in target.testdata_copy_pair:
+                if os.path.exists(source_name):
+                    paths.add(source_name)
+    return sorted(paths)
+
+class WatchSession(object):
+    def __init__(self, command):
+        self.command = command
+        self.current_dir = GetCurrentDir()
+        self.result = None
+        self.scons_content = ''
+        self.watcher = None
+        self.known_paths = set()
+        self.testdata = {}
+        self.test_stamps = {}
+
+    def Analyze(self):
+        import flame
+        from analysis_cache import GetAnalysisCache
+        import build_cache
+        import target_pool
+        target_pool.ResetTargetPool()
+        build_cache.GetBuildCache().Refresh()
+        loader = flame.LoadBuildFiles()
+        flame.GenerateBuildRules(self.command)
+        GetAnalysisCache().Save()
+        targets = target_pool.GetAllTargets()
+        self.result = flame.AnalysisResult(targets)
+        self.scons_content = None
+        if flame.IsSconsBackend():
+            self.scons_content = ReadFile(GetSconsFileName(GetFlameRootDir()))
+        self.testdata = {}
+        for target in targets:
+            if target.type == 'cc_test':
+                self.testdata[target.test_case] = [source_name for
+                        source_name, _ in target.testdata_copy_pair]
+        paths = GetWatchedPaths(loader, targets)
+        self.known_paths = set(paths)
+        for path in paths:
+            if os.path.isdir(path):
+                self.known_paths.update(ListDir(path))
+        if self.watcher != None:
+            self.watcher.Close()
+        self.watcher = CreateWatcher(paths)
+
+    def NeedAnalysis(self, changed_paths):
+        for path in changed_paths:
+            if os.path.basename(path) in _ANALYSIS_FILE_NAMES:
+                return True
+            # Added or removed files may be matched by srcs.
+            if (path in self.known_paths) != os.path.exists(path):
+                return True
+        return False
+
+    def Build(self):
+        '''Run the build, return the test cases whose binaries changed.'''
+        import flame
+        if self.scons_content != None:
+            # Other command lines may have written the SConstruct since.
+            from sconscript import WriteSconstruct
+            WriteSconstruct([self.scons_content])
+        try:
+            flame.RunBuild(self.command, self.result)
+        except SystemExit:
+            return None
+        finally:
+            os.chdir(self.current_dir)
+        changed_test_cases = set()
+        for test_case, _, _ in self.result.test_cases:
+            stamp = GetStamp(test_case)
+            if self.test_stamps.get(test_case) != stamp:
+                changed_test_cases.add(test_case)
+            self.test_stamps[test_case] = stamp
+        return changed_test_cases
+
+    def RunTests(self, test_cases):
+        import flame
+        result = copy.copy(self.result)
+        result.test_cases = [test_case for test_case in self.result.test_cases
+                if test_case[0] in test_cases]
+        if not result.test_cases:
+            Info('No test binaries changed.')
+            return
+        flame.RunTestCases(result)
+
+    def GetChangedTestCases(self, changed_paths):
+        '''Test cases whose testdata changed.'''
+        test_cases = set()
+        for test_case, source_names in self.testdata.items():
+            for source_name in source_names:
+                prefix = source_name.rstrip('/') + '/'
+                for path in changed_paths:
+                    if path == source_name or path.startswith(prefix):
+                        test_cases.add(test_case)
+        return test_cases
+
+    def WaitForChanges(self):
+        '''Wait for a burst of changes and return the changed paths.'''
+        changed_paths = set()
+        while not changed_paths:
+            changed_paths = self.watcher.Wait(None)
+        while True:
+            more_paths = self.watcher.Wait(_DEBOUNCE_SECONDS)
+            if not more_paths:
+                return changed_paths
+            changed_paths |= more_paths
+
+    def Run(self):
+        self.Analyze()
+        changed_paths = set()
+        need_analysis = False
+        while True:
+            if need_analysis:
+                try:
+                    self.Analyze()
+                except SystemExit:
+                    os.chdir(self.current_dir)
+                    Error('Analysis failed, fix the BUILD files.')
+                    changed_paths = self.WaitForChanges()
+                    continue
+            test_cases = self.Build()
+            if test_cases != None and self.command == 'test':
+                test_cases |= self.GetChangedTestCases(changed_paths)
+                self.RunTests(test_cases)
+            Info('Watching for changes, press Ctrl-C to stop.')
+            changed_paths = self.WaitForChanges()
+            need_analysis = self.NeedAnalysis(changed_paths)
+            Info('%d files changed.' % len(changed_paths))
+
+def Watch():
+    command = GetCmdParser().options.watch_command
+    session = WatchSession(command)
+    try:
+        session.Run()
+    except KeyboardInterrupt:
+        Info('Stop watching.')
+    return 0
@@ -0,0 +1,88 @@
+# Copyright (c) 2014, The Flame Authors.
+# All rights reserved.
+# Author: Chao Xiong <fancysimon@gmail.com>
+
+'''
+Workspace context.
+
+The flame root dir and the dirs derived from it are found once per process.
+Relative dirs and mangled names are asked for many times by every target, so
+they are memoized and interned. Strings in the dependency lists of targets are
+numbered in a symbol table, the lists keep the numbers.
+'''
+
+import os
+
+_workspace = None
+
+_SPECIAL_CHARS = ['/', '\\', '-', '.', ':', '+']
+
+class Workspace(object):
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.build_dir_name = 'flame-bin'
+        self.build_root_dir = os.path.join(root_dir, self.build_dir_name)
+        self.build_debug_root_dir = os.path.join(root_dir, 'build_debug')
+        self.build_release_root_dir = os.path.join(root_dir, 'build_release')
+        self.relative_dirs = {}
+        self.mangled_names = {}
+        self.symbols = []
+        self.symbol_ids = {}
+
+    def GetRelativeDir(self, path):
+        '''Path relative to the flame root dir.'''
+        relative_dir = self.relative_dirs.get(path)
+        if relative_dir == None:
+            relative_dir = intern(os.path.relpath(path, self.root_dir))
+            self.relative_dirs[path] = relative_dir
+        return relative_dir
+
+    def MangleName(self, name):
+        '''Replace chars which can not be in a python identifier.'''
+        mangled_name = self.mangled_names.get(name)
+        if mangled_name == None:
+            mangled_name = name
+            for char in _SPECIAL_CHARS:
+                mangled_name = mangled_name.replace(char, '_mAgIc_')
+            mangled_name = intern(mangled_name)
+            self.mangled_names[name] = mangled_name
+        return mangled_name
+
+    def Intern(self, symbol):
+        '''Number of |symbol| in the symbol table.'''
+        symbol_id = self.symbol_ids.get(symbol)
+        if symbol_id == None:
+            symbol_id = len(self.symbols)
+            self.symbols.append(intern(symbol))
+            self.symbol_ids[self.symbols[symbol_id]] = symbol_id
+        return symbol_id
+
+    def LoadSymbols(self, symbols):
+        '''Start the symbol table with |symbols|, False if it is not empty.'''
+        if self.symbols:
+            return False
+        for symbol in symbols:
+            self.Intern(symbol)
+        return True
+
+    def GetSymbols(self, symbol_ids):
+        '''Strings of |symbol_ids|.'''
+        symbols = self.symbols
+        return [symbols[symbol_id] for symbol_id in symbol_ids]
+
+def FindFlameRootDir(current_dir):
+    '''The nearest dir containing FLAME_ROOT, '' if there is none.'''
+    dir_name = current_dir
+    while not os.path.isfile(os.path.join(dir_name, 'FLAME_ROOT')):
+        parent_dir = os.path.dirname(dir_name)
+        if parent_dir == dir_name:
+            return ''
+        dir_name = parent_dir
+    return dir_name
+
+def GetWorkspace():
+    '''Get Workspace singleton.'''
+    global _workspace
+    if _workspace == None:
+        _workspace = Workspace(FindFlameRootDir(os.getcwd()))
+    return _workspace